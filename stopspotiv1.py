@@ -1,37 +1,473 @@
-import psutil
 import time
+_IMPORT_STARTED = time.perf_counter()
+import psutil
 import os
 import ctypes
-from comtypes import *
-import pycaw.pycaw as pycaw
-import pythoncom
 # from threading import Lock
 from threading import RLock
 import sys
 import signal
 import atexit
 import threading
-import customtkinter as ctk
-from PIL import Image
-import pystray
+import queue
 import gc
+import random
+import functools
+import json
+import struct
+import bisect
+import math
+import re
+import fnmatch
+import logging
+import logging.handlers
+from collections import deque
+from array import array
 
 # Add audio session state constants
 AUDCLNT_SESSIONSTATE_ACTIVE = 1
 AUDCLNT_SESSIONSTATE_INACTIVE = 2
 AUDCLNT_SESSIONSTATE_EXPIRED = 3
 
-from comtypes import CLSCTX_ALL  # Ensure CLSCTX_ALL is imported
-
 # Add audio session state constants
 AUDCLNT_SESSIONSTATE_ACTIVE = 1
 AUDCLNT_SESSIONSTATE_INACTIVE = 2
 AUDCLNT_SESSIONSTATE_EXPIRED = 3
 
-from comtypes import CLSCTX_ALL  # Ensure CLSCTX_ALL is imported
+from collections import namedtuple, OrderedDict
 
-class AudioSessionManager:
-    def __init__(self, peak_threshold=0.0005, cache_timeout=2, log_interval=5, debug=True, ignored_processes=None):
+# pycaw/comtypes/pythoncom and the GUI libraries are imported on first use,
+# so headless runs never load the GUI and import does no Windows work
+def _load_com():
+    """Import the COM libraries into the module namespace; returns pycaw."""
+    global pycaw, pythoncom, CLSCTX_ALL
+    if 'pycaw' not in globals():
+        import pythoncom as _pythoncom
+        import pycaw.pycaw as _pycaw
+        from comtypes import CLSCTX_ALL as _clsctx_all
+        pythoncom, CLSCTX_ALL = _pythoncom, _clsctx_all
+        pycaw = _pycaw  # Last, as it marks the set as loaded
+    return pycaw
+
+def _load_gui():
+    """Import customtkinter, PIL and pystray into the module namespace."""
+    global ctk, Image, pystray
+    if 'ctk' not in globals():
+        from PIL import Image as _image
+        import pystray as _pystray
+        import customtkinter as _ctk
+        Image, pystray = _image, _pystray
+        ctk = _ctk
+    return ctk
+
+def _load_async():
+    """Import asyncio and concurrent.futures.Future, which only AsyncMonitor needs."""
+    global asyncio, Future
+    if 'asyncio' not in globals():
+        from concurrent.futures import Future as _future
+        import asyncio as _asyncio
+        Future = _future
+        asyncio = _asyncio
+    return asyncio
+
+_LAZY_COM = ('pycaw', 'pythoncom', 'CLSCTX_ALL')
+_LAZY_GUI = ('ctk', 'Image', 'pystray')
+_LAZY_ASYNC = ('asyncio', 'Future')
+
+def __getattr__(name):
+    # Reached only while a lazy name is not loaded yet
+    if name in _LAZY_COM:
+        _load_com()
+        return globals()[name]
+    if name in _LAZY_GUI:
+        _load_gui()
+        return globals()[name]
+    if name in _LAZY_ASYNC:
+        _load_async()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Define identifiers for Spotify and Spotify Premium
+SPOTIFY_IDENTIFIERS = ('spotify', 'spotify premium')
+
+# Processes whose audio never pauses Spotify
+DEFAULT_IGNORED_PROCESSES = (
+    'system idle process', 'system', 'explorer.exe',
+    'FxSound.exe',  # Names match in any case, with or without .exe
+    'obs64.exe', 'obs32.exe', 'obs.exe', 'obs-browser-page.exe',
+    'SnippingTool.exe', 'ScreenClipping*.exe',
+    'audiodg.exe',  # Windows Audio Device Graph - proxy for all audio, ignore it
+)
+
+# Immutable result of one pass over the audio sessions
+AudioSnapshot = namedtuple('AudioSnapshot', [
+    'spotify_active', 'spotify_peak',
+    'other_active', 'other_peak',
+    'other_process', 'other_pid',  # The other app that made other_active true
+    'session_count',
+    'spotify_playing',  # Spotify's session is in the active state, whatever its peak
+], defaults=(False,))
+
+EMPTY_SNAPSHOT = AudioSnapshot(False, 0.0, False, 0.0, None, None, 0)
+
+logger = logging.getLogger('stopspoti')
+
+# Per-category rate limiting; pass as extra= to tag a record
+_INIT_LOG = {'category': 'init'}
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most one record per category every interval seconds.
+
+    Records without a category, and categories without an interval, always pass.
+    """
+    def __init__(self):
+        super().__init__()
+        self._intervals = {}
+        self._last_emit = {}
+        self.suppressed = {}
+
+    def set_interval(self, category, seconds):
+        self._intervals[category] = seconds
+
+    def filter(self, record):
+        category = getattr(record, 'category', None)
+        interval = self._intervals.get(category)
+        if not interval:
+            return True
+        now = time.monotonic()
+        if now - self._last_emit.get(category, float('-inf')) < interval:
+            self.suppressed[category] = self.suppressed.get(category, 0) + 1
+            return False
+        self._last_emit[category] = now
+        return True
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the most recent records in memory; formatting happens only when read."""
+    def __init__(self, capacity=2000):
+        super().__init__()
+        self.records = deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def lines(self):
+        return [self.format(record) for record in list(self.records)]
+
+class CallbackHandler(logging.Handler):
+    """Hands formatted debug records to a callback such as the GUI log.
+
+    Records at INFO and above are left out, as the GUI reports those
+    itself. Silent until set_debug_mode() turns debug mode on.
+    """
+    quiet_level = logging.CRITICAL + 1
+
+    def __init__(self, callback):
+        super().__init__(self.quiet_level)
+        self.callback = callback
+        self.addFilter(lambda record: record.levelno < logging.INFO)
+
+    def emit(self, record):
+        try:
+            self.callback(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+log_rate_limiter = RateLimitFilter()
+logger.addFilter(log_rate_limiter)
+log_ring = None  # RingBufferHandler installed by configure_logging()
+
+def configure_logging(log_file=None, ring_capacity=2000, console_level=logging.INFO):
+    """Install the console, in-memory ring buffer and optional buffered file sinks.
+
+    Whether debug records are produced at all is decided by the debug flags
+    of the components. They always reach the ring buffer and the file, and
+    the console only while set_debug_mode() has debug mode on.
+    """
+    global log_ring
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+
+    formatter = logging.Formatter('%(asctime)s - %(message)s', '%H:%M:%S')
+    log_ring = RingBufferHandler(ring_capacity)
+    log_ring.setFormatter(formatter)
+    logger.addHandler(log_ring)
+
+    console = logging.StreamHandler(sys.stdout)
+    console.setLevel(console_level)
+    console.quiet_level = console_level  # Restored when debug mode is switched off
+    console.setFormatter(formatter)
+    logger.addHandler(console)
+
+    if log_file:
+        file_handler = logging.FileHandler(log_file, encoding='utf-8', delay=True)
+        file_handler.setFormatter(formatter)
+        # Written in batches; warnings and shutdown flush immediately
+        logger.addHandler(logging.handlers.MemoryHandler(256, flushLevel=logging.WARNING, target=file_handler))
+    return log_ring
+
+def release_com(com_object):
+    """Release a COM pointer exactly once.
+
+    comtypes calls Release() again when a pointer object is collected, so
+    after releasing explicitly the pointer is nulled to make that a no-op.
+    """
+    if not com_object:
+        return
+    try:
+        com_object.Release()
+    except Exception:
+        return  # Silently handle release errors
+    try:
+        ctypes.memset(ctypes.addressof(com_object), 0, ctypes.sizeof(ctypes.c_void_p))
+    except TypeError:
+        pass  # Not a ctypes pointer
+
+class ComScope:
+    """Context manager that releases the COM pointers it tracks when the block exits."""
+    __slots__ = ('_objects',)
+
+    def __init__(self):
+        self._objects = []
+
+    def __enter__(self):
+        return self
+
+    def track(self, com_object):
+        if com_object:
+            self._objects.append(com_object)
+        return com_object
+
+    def keep(self, com_object):
+        """Stop tracking com_object so it outlives the scope; the caller now owns it."""
+        for i in range(len(self._objects) - 1, -1, -1):
+            if self._objects[i] is com_object:
+                del self._objects[i]
+                break
+        return com_object
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        objects = self._objects
+        while objects:
+            release_com(objects.pop())
+        return False
+
+class GcPolicy:
+    """Optional rate-limited generational collection.
+
+    Reference counting frees released COM wrappers immediately, so this is
+    only a safety net for reference cycles; interval None disables it.
+    """
+    def __init__(self, interval=None, generation=1):
+        self.interval = interval
+        self.generation = generation
+        self._last_collect = time.monotonic()
+        self.collections = 0
+        self.collected = 0
+        self.total_time = 0.0
+        self.profiler = None  # PhaseProfiler that also gets each collection's time
+
+    def maybe_collect(self):
+        if self.interval is None:
+            return 0
+        now = time.monotonic()
+        if now - self._last_collect < self.interval:
+            return 0
+        self._last_collect = now
+        start = time.perf_counter()
+        collected = gc.collect(self.generation)
+        elapsed = time.perf_counter() - start
+        self.total_time += elapsed
+        if self.profiler is not None:
+            self.profiler.record('gc', elapsed)
+        self.collections += 1
+        self.collected += collected
+        return collected
+
+    def stats(self):
+        return {'collections': self.collections, 'collected': self.collected, 'total_time': self.total_time}
+
+LeakReport = namedtuple('LeakReport', ['t', 'reasons', 'rss_growth', 'object_growth', 'grown_types', 'grown_allocations'])
+
+class LeakWatchdog:
+    """Samples memory now and then and resets the audio backend only when it has grown.
+
+    Each check reads the process RSS and the number of gc-tracked objects;
+    the first is the baseline. When either grows past its limit, the
+    per-type object counts (and, if tracemalloc_frames is set, the
+    allocation sites) are compared with the baseline, a LeakReport of what
+    grew is kept, and check() returns it so the caller can reset. The next
+    check after a reset takes a fresh baseline.
+    """
+    def __init__(self, interval=60.0, rss_limit=64 * 1024 * 1024, object_limit=100000, top=5,
+                 tracemalloc_frames=0, clock=time.monotonic, rss=None, history=20):
+        self.interval = interval
+        self.rss_limit = rss_limit
+        self.object_limit = object_limit
+        self.top = top
+        self.tracemalloc_frames = tracemalloc_frames
+        self._clock = clock
+        self._rss = rss or psutil.Process(os.getpid()).memory_info  # Must return something with .rss
+        self._next_check = None
+        self._baseline = None  # (rss, object count, counts by type, tracemalloc snapshot)
+        self.checks = 0
+        self.resets = 0
+        self.last_rss = 0
+        self.last_objects = 0
+        self.reports = deque(maxlen=history)
+        if tracemalloc_frames:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(tracemalloc_frames)
+
+    @staticmethod
+    def _type_counts(tracked):
+        counts = {}
+        for obj in tracked:
+            name = type(obj).__name__
+            counts[name] = counts.get(name, 0) + 1
+        return counts
+
+    def _take_baseline(self, rss, tracked):
+        traced = None
+        if self.tracemalloc_frames:
+            import tracemalloc
+            traced = tracemalloc.take_snapshot()
+        self._baseline = (rss, len(tracked), self._type_counts(tracked), traced)
+
+    def check(self, now=None):
+        """Sample if the interval has passed; return a LeakReport when a limit was crossed."""
+        now = self._clock() if now is None else now
+        if self._next_check is not None and now < self._next_check:
+            return None
+        self._next_check = now + self.interval
+        self.checks += 1
+        rss = self.last_rss = self._rss().rss
+        tracked = gc.get_objects()  # One scan per check; the type breakdown reuses it
+        objects = self.last_objects = len(tracked)
+        if self._baseline is None:
+            self._take_baseline(rss, tracked)
+            return None
+
+        base_rss, base_objects, base_types, base_traced = self._baseline
+        reasons = []
+        if rss - base_rss > self.rss_limit:
+            reasons.append('rss')
+        if objects - base_objects > self.object_limit:
+            reasons.append('objects')
+        if not reasons:
+            return None
+
+        grown = [(name, count - base_types.get(name, 0)) for name, count in self._type_counts(tracked).items()]
+        del tracked
+        grown = sorted((item for item in grown if item[1] > 0), key=lambda item: item[1], reverse=True)[:self.top]
+        allocations = []
+        if base_traced is not None:
+            import tracemalloc
+            for stat in tracemalloc.take_snapshot().compare_to(base_traced, 'lineno')[:self.top]:
+                if stat.size_diff > 0:
+                    allocations.append((str(stat.traceback[0]), stat.size_diff))
+        report = LeakReport(now, tuple(reasons), rss - base_rss, objects - base_objects, grown, allocations)
+        self.reports.append(report)
+        self.resets += 1
+        self._baseline = None
+        logger.warning("Memory grew by %.1f MiB and %s objects; resetting audio sessions. Grown types: %s%s",
+                       report.rss_growth / 1048576, report.object_growth,
+                       ', '.join(f"{name} +{count}" for name, count in grown) or 'none',
+                       ''.join(f"; {site} +{size} B" for site, size in allocations))
+        return report
+
+    def stats(self):
+        return {'checks': self.checks, 'resets': self.resets, 'rss': self.last_rss, 'objects': self.last_objects}
+
+class ProcessSource:
+    """Resolves PIDs to process identities; the default asks psutil."""
+    def process_identity(self, pid):
+        """Return (name, create_time); raises psutil.NoSuchProcess if the process is gone."""
+        process = psutil.Process(pid)
+        return process.name(), process.create_time()
+
+    def process_create_time(self, pid):
+        return psutil.Process(pid).create_time()
+
+    def process_exe(self, pid):
+        """Return the executable path, or None where it cannot be read."""
+        return psutil.Process(pid).exe() or None
+
+class AudioBackend(ProcessSource):
+    """Where AudioSessionManager reads the audio sessions from.
+
+    A walk is begin_walk(), which returns the session count, followed by
+    open_session(index) for each index. The handle it returns (or None for
+    a session to skip) goes to session_pid/session_state/session_peak and
+    back to release_session() once the manager is done with it. Any call
+    may raise; the manager then calls invalidate() and reports silence.
+    """
+    debug = False
+
+    def configure(self, debug=None, **options):
+        """Apply settings changed at runtime; None leaves a setting as it is."""
+        if debug is not None:
+            self.debug = debug
+
+    def begin_walk(self):
+        raise NotImplementedError
+
+    def open_session(self, index):
+        raise NotImplementedError
+
+    def session_pid(self, handle):
+        raise NotImplementedError
+
+    def session_state(self, handle):
+        raise NotImplementedError
+
+    def session_peak(self, handle):
+        raise NotImplementedError
+
+    def release_session(self, handle):
+        pass
+
+    def device_peak(self):
+        """Peak of the default render endpoint, or None if it cannot be read."""
+        return None
+
+    def send_media_command(self, command):
+        """Post 'play', 'pause' or 'toggle' to Spotify without waiting; returns whether it was posted."""
+        raise NotImplementedError
+
+    def invalidate(self, cause):
+        """Drop any cached state so the next walk starts fresh."""
+        pass
+
+    def cache_stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+class _ComSession:
+    """One session of a COM walk; the meter is only queried when a peak is needed."""
+    __slots__ = ('session', 'control', 'meter')
+
+    def __init__(self, session, control, meter=None):
+        self.session = session
+        self.control = control
+        self.meter = meter
+
+    def release(self):
+        # Reverse order of creation; each pointer is released exactly once
+        release_com(self.meter)
+        release_com(self.control)
+        release_com(self.session)
+        self.meter = self.control = self.session = None
+
+class ComAudioBackend(AudioBackend):
+    """Audio sessions of the default render endpoint, read through pycaw/comtypes."""
+    def __init__(self, cache_timeout=2, cache_sessions=False, debug=True):
+        _load_com()
         self._lock = RLock()  # Initialize RLock
         self._devices = None
         self._interface = None
@@ -39,475 +475,3691 @@ class AudioSessionManager:
         self._sessions = None
         self._last_check = 0
         self._cache_timeout = cache_timeout
-        self._debug = debug
-        self._peak_threshold = peak_threshold
+        self._cache_sessions = cache_sessions  # Keep the COM graph alive across ticks
+        self._session_count = None
+        self._pending_cause = None  # Why the next rebuild happens
+        self._cache_stats = {'hits': 0, 'rebuilds': 0, 'refreshes': 0, 'causes': {}}
+        self._device = None
+        self._device_meter = None
         self._initialized = False
-        self._com_initialized = False
-        self._last_log_time = 0
-        self._log_interval = log_interval
-        self._last_reset_time = time.time()
-        self._ignored_processes = set(proc.lower() for proc in (ignored_processes or [
-            'system idle process', 'system', 'explorer.exe',
-            'FxSound.exe', 'FxSound', 'fxsound.exe', 
-            'obs64.exe', 'obs32.exe', 'obs.exe', 'obs-browser-page.exe',
-            'SnippingTool.exe', 'ScreenClippingHost.exe',
-            'ScreenClipping.exe',
-            'audiodg.exe',  # Windows Audio Device Graph - proxy for all audio, ignore it
-        ]))
+        self.debug = debug
+        self.profiler = None  # Set by ProfilingBackend to time the individual COM steps
+
+    def configure(self, debug=None, cache_sessions=None, cache_timeout=None, **options):
+        super().configure(debug=debug)
+        if cache_sessions is not None:
+            self._cache_sessions = cache_sessions
+        if cache_timeout is not None:
+            self._cache_timeout = cache_timeout
 
     def _safe_release(self, com_object):
-        if com_object:
-            try:
-                com_object.Release()
-            except Exception:
-                pass  # Silently handle release errors
+        release_com(com_object)
 
-    def _initialize_if_needed(self):
-        """Always rebuild session enumerator to avoid stale COM pointers."""
-        with self._lock:
-            try:
-                current_time = time.time()
-                
-                # Force reset every 5 minutes (300 seconds)
-                if current_time - self._last_reset_time > 300:
-                    if self._debug:
-                        print(f"{time.strftime('%H:%M:%S')} - Performing 5-minute periodic COM reset...", flush=True)
-                    self._cleanup()
-                    self._last_reset_time = current_time
-
-                if self._debug and (current_time - self._last_log_time) > self._log_interval:
-                    print(f"{time.strftime('%H:%M:%S')} - Initializing audio session manager...", flush=True)
-                    self._last_log_time = current_time
-                self._cleanup()
-                # Retry COM initialization up to 3 times
-                for attempt in range(3):
-                    try:
-                        if self._debug and (current_time - self._last_log_time) > self._log_interval:
-                            print(f"{time.strftime('%H:%M:%S')} - Initialization attempt {attempt + 1}", flush=True)
-                            self._last_log_time = current_time
-                        self._devices = pycaw.AudioUtilities.GetSpeakers()
-                        if self._debug and (current_time - self._last_log_time) > self._log_interval:
-                            print(f"{time.strftime('%H:%M:%S')} - Retrieved speakers: {self._devices}", flush=True)
-                            self._last_log_time = current_time
-                        
-                        self._interface = self._devices.Activate(
-                            pycaw.IAudioSessionManager2._iid_, 
-                            CLSCTX_ALL, 
-                            None
-                        )
-                        if self._debug and (current_time - self._last_log_time) > self._log_interval:
-                            print(f"{time.strftime('%H:%M:%S')} - Activated IAudioSessionManager2 interface: {self._interface}", flush=True)
-                            self._last_log_time = current_time
-                        
-                        self._session_manager = cast(self._interface, POINTER(pycaw.IAudioSessionManager2))
-                        if self._debug and (current_time - self._last_log_time) > self._log_interval:
-                            print(f"{time.strftime('%H:%M:%S')} - Casted to IAudioSessionManager2: {self._session_manager}", flush=True)
-                            self._last_log_time = current_time
-                        
-                        self._sessions = self._session_manager.GetSessionEnumerator()
-                        if self._debug and (current_time - self._last_log_time) > self._log_interval:
-                            print(f"{time.strftime('%H:%M:%S')} - Retrieved session enumerator: {self._sessions}", flush=True)
-                            self._last_log_time = current_time
-                        
-                        self._last_check = current_time
-                        self._initialized = True
-                        if self._debug and (current_time - self._last_log_time) > self._log_interval:
-                            print(f"{time.strftime('%H:%M:%S')} - Initialization successful", flush=True)
-                            self._last_log_time = current_time
-                        break
-                    except Exception as e:
-                        if self._debug and (current_time - self._last_log_time) > self._log_interval:
-                            print(f"{time.strftime('%H:%M:%S')} - Initialization attempt {attempt + 1} failed: {e}", flush=True)
-                            self._last_log_time = current_time
-                        time.sleep(0.1)
-                
-                if not self._initialized:
-                    raise Exception("Failed to initialize COM objects after 3 attempts")
-            except Exception as e:
-                if self._debug and (current_time - self._last_log_time) > self._log_interval:
-                    print(f"{time.strftime('%H:%M:%S')} - Critical initialization error: {e}", flush=True)
-                    self._last_log_time = current_time
-                self._cleanup()
-                raise
+    def _count_rebuild(self, kind, cause):
+        self._cache_stats[kind] += 1
+        causes = self._cache_stats['causes']
+        causes[cause] = causes.get(cause, 0) + 1
 
-    def _cleanup(self):
+    def cache_stats(self):
+        """Return a copy of the session cache counters."""
         with self._lock:
-            try:
-                if self._sessions:
-                    for i in range(self._sessions.GetCount()):
-                        try:
-                            session = self._sessions.GetSession(i)
-                            self._safe_release(session)
-                        except Exception:
-                            pass
-
-                self._safe_release(self._sessions)
-                self._safe_release(self._session_manager)
-                self._safe_release(self._interface)
-            finally:
-                # Force Python to delete variables
-                if self._sessions: del self._sessions
-                if self._session_manager: del self._session_manager
-                if self._interface: del self._interface
-                if self._devices: del self._devices
-                
-                self._sessions = None
-                self._session_manager = None
-                self._interface = None
-                self._devices = None
-                self._initialized = False
-                
-                gc.collect() # Force hard garbage collection here to clean dangling STDMETHOD structs
+            stats = dict(self._cache_stats)
+            stats['causes'] = dict(stats['causes'])
+            return stats
 
-    def close(self):
-        try:
+    def invalidate(self, cause):
+        """Drop the cached COM objects so the next check rebuilds them."""
+        with self._lock:
+            self._pending_cause = cause
+            self._drop_meters()
             self._cleanup()
-            if self._com_initialized:
-                pythoncom.CoUninitialize()
-        except Exception:
-            pass  # Silently ignore exceptions during cleanup
 
-    def check_audio_sessions(self, check_spotify=False):
-        # We assume CoInitialize is handled correctly by the caller / current thread now
+    def _drop_meters(self):
+        self._safe_release(self._device_meter)
+        self._safe_release(self._device)
+        self._device_meter = None
+        self._device = None
 
+    def device_peak(self):
         try:
-            if self._debug:
-                print(f"{time.strftime('%H:%M:%S')} - Initializing audio sessions...", flush=True)
-            self._initialize_if_needed()
-            if not self._initialized or not self._sessions:
-                if self._debug:
-                    print(f"{time.strftime('%H:%M:%S')} - Audio sessions not initialized properly", flush=True)
-                return False
+            if self._device_meter is None:
+                self._device = pycaw.AudioUtilities.GetSpeakers()
+                with ComScope() as scope:
+                    interface = scope.track(self._device.Activate(pycaw.IAudioMeterInformation._iid_, CLSCTX_ALL, None))
+                    # QueryInterface hands back an owned reference, unlike cast()
+                    self._device_meter = interface.QueryInterface(pycaw.IAudioMeterInformation)
+            return self._device_meter.GetPeakValue()
+        except Exception as e:
+            if self.debug:
+                logger.debug("Failed to read device peak: %s", e)
+            self._drop_meters()
+            return None
 
-            # Only ignore system processes
-            count = self._sessions.GetCount()
-            if self._debug:
-                print(f"{time.strftime('%H:%M:%S')} - Number of audio sessions: {count}", flush=True)
-            found_active = False
-            
-            # Define identifiers for Spotify and Spotify Premium
-            SPOTIFY_IDENTIFIERS = ['spotify', 'spotify premium']
-            
-            if self._debug:
-                print(f"\n{'=' * 50}", flush=True)
-                print(f"Checking {'Spotify' if check_spotify else 'other apps'} audio:", flush=True)
-            
-            for i in range(count):
-                if self._debug:
-                    print(f"{time.strftime('%H:%M:%S')} - Checking session {i+1}/{count}", flush=True)
-                session = None
-                audio_session = None
-                volume = None
-                meter = None
-                
-                try:
-                    session = self._sessions.GetSession(i)
-                    if self._debug:
-                        print(f"{time.strftime('%H:%M:%S')} - Retrieved session object for session {i+1}", flush=True)
-                    if not session:
-                        if self._debug:
-                            print(f"{time.strftime('%H:%M:%S')} - Session {i+1} is None", flush=True)
-                        continue
+    def _initialize_if_needed(self):
+        """Fetch a fresh session enumerator, rebuilding the COM graph when needed.
 
-                    try:
-                        audio_session = session.QueryInterface(pycaw.IAudioSessionControl2)
-                        if self._debug:
-                            print(f"{time.strftime('%H:%M:%S')} - Queried IAudioSessionControl2 for session {i+1}", flush=True)
-                    except Exception as e:
-                        if self._debug:
-                            print(f"{time.strftime('%H:%M:%S')} - Failed to query IAudioSessionControl2 for session {i+1}: {e}", flush=True)
-                        continue
+        An enumerator is a fixed snapshot of the session list, so with
+        caching on only the device and IAudioSessionManager2 are reused and
+        every tick asks the cached manager for a new enumerator. The whole
+        graph is rebuilt after cache_timeout seconds or a COM error.
+        """
+        with self._lock:
+            current_time = time.monotonic()
 
-                    if not audio_session:
-                        if self._debug:
-                            print(f"{time.strftime('%H:%M:%S')} - audio_session is None for session {i+1}", flush=True)
-                        continue
+            if self._cache_sessions and self._initialized and self._session_manager:
+                if current_time - self._last_check < self._cache_timeout:
+                    if self.profiler is None:
+                        refreshed = self._refresh_enumerator()
+                    else:
+                        start = time.perf_counter()
+                        refreshed = self._refresh_enumerator()
+                        self.profiler.record('enumerator_refresh', time.perf_counter() - start)
+                    if refreshed:
+                        self._cache_stats['hits'] += 1
+                        return
+                elif not self._pending_cause:
+                    self._pending_cause = 'timeout'
 
-                    try:
-                        volume = session.QueryInterface(pycaw.ISimpleAudioVolume)
-                        if self._debug:
-                            print(f"{time.strftime('%H:%M:%S')} - Queried ISimpleAudioVolume for session {i+1}", flush=True)
-                    except Exception as e:
-                        if self._debug:
-                            print(f"{time.strftime('%H:%M:%S')} - Failed to query ISimpleAudioVolume for session {i+1}: {e}", flush=True)
+            if self._pending_cause:
+                cause = self._pending_cause
+            elif not self._cache_sessions and self._cache_stats['rebuilds']:
+                cause = 'uncached'  # Always rebuild to avoid stale COM pointers
+            else:
+                cause = 'initial'
+            self._pending_cause = None
+            if self.profiler is None:
+                self._rebuild(current_time, cause)
+                return
+            start = time.perf_counter()
+            try:
+                self._rebuild(current_time, cause)
+            finally:
+                self.profiler.record('com_rebuild', time.perf_counter() - start)
 
-                    try:
-                        meter = session.QueryInterface(pycaw.IAudioMeterInformation)
-                        if self._debug:
-                            print(f"{time.strftime('%H:%M:%S')} - Queried IAudioMeterInformation for session {i+1}", flush=True)
-                    except Exception as e:
-                        if self._debug:
-                            print(f"{time.strftime('%H:%M:%S')} - Failed to query IAudioMeterInformation for session {i+1}: {e}", flush=True)
-                    
-                    try:
-                        process_id = audio_session.GetProcessId()
-                        if self._debug:
-                            print(f"{time.strftime('%H:%M:%S')} - Process ID: {process_id}", flush=True)
-                    except Exception as e:
-                        if self._debug:
-                            print(f"{time.strftime('%H:%M:%S')} - Failed to get Process ID for session {i+1}: {e}", flush=True)
-                        # Restart enumerator on fatal COM errors to avoid stale pointers
-                        self._cleanup()
-                        return False
+    def _refresh_enumerator(self):
+        """Swap in a fresh enumerator from the cached session manager."""
+        try:
+            sessions = self._session_manager.GetSessionEnumerator()
+        except Exception as e:
+            if self.debug:
+                logger.debug("Enumerator refresh failed: %s", e)
+            self.invalidate('com_error')
+            return False
 
-                    try:
-                        process = psutil.Process(process_id)
-                        if self._debug:
-                            print(f"{time.strftime('%H:%M:%S')} - Retrieved process for PID {process_id}", flush=True)
-                        process_name = process.name().lower()
-                        if self._debug:
-                            print(f"{time.strftime('%H:%M:%S')} - Process name: {process_name}", flush=True)
-                    except psutil.NoSuchProcess:
-                        if self._debug:
-                            print(f"{time.strftime('%H:%M:%S')} - No such process with PID: {process_id}", flush=True)
-                        continue
-                    except Exception as e:
-                        if self._debug:
-                            print(f"{time.strftime('%H:%M:%S')} - Error retrieving process for PID {process_id}: {e}", flush=True)
-                        continue
-                    
-                    if process_name in self._ignored_processes:
-                        if self._debug:
-                            print(f"{time.strftime('%H:%M:%S')} - Ignored process: {process_name}", flush=True)
-                        continue
-                        
-                    # Check for both Spotify and Spotify Premium
-                    is_spotify = any(identifier in process_name for identifier in SPOTIFY_IDENTIFIERS)
-                    
-                    if check_spotify != is_spotify:
-                        if self._debug:
-                            print(f"{time.strftime('%H:%M:%S')} - Skipping {'Spotify' if not is_spotify else 'other app'}: {process_name}", flush=True)
-                        continue
-                        
-                    try:
-                        state = audio_session.GetState()
-                        peak = meter.GetPeakValue() if meter else 0
-                        if self._debug:
-                            print(f"{time.strftime('%H:%M:%S')} - State: {state}, Peak: {peak:.6f}", flush=True)
-                    except Exception as e:
-                        if self._debug:
-                            print(f"{time.strftime('%H:%M:%S')} - Failed to get state or peak for session {i+1}: {e}", flush=True)
-                        continue
+        self._safe_release(self._sessions)
+        self._sessions = sessions
+        return True
+
+    def _rebuild(self, current_time, cause):
+        """Build the device, IAudioSessionManager2 and enumerator from scratch."""
+        try:
+            if self.debug:
+                logger.debug("Initializing audio session manager (%s)...", cause, extra=_INIT_LOG)
+            self._cleanup()
+            self._count_rebuild('rebuilds', cause)
+            # Retry COM initialization up to 3 times
+            for attempt in range(3):
+                try:
+                    if self.debug:
+                        logger.debug("Initialization attempt %s", attempt + 1, extra=_INIT_LOG)
+                    self._devices = pycaw.AudioUtilities.GetSpeakers()
+                    if self.debug:
+                        logger.debug("Retrieved speakers: %s", self._devices, extra=_INIT_LOG)
                     
-                    if self._debug and (peak > self._peak_threshold or state == AUDCLNT_SESSIONSTATE_ACTIVE):
-                        print(f"{time.strftime('%H:%M:%S')} - {process_name}:", flush=True)
-                        print(f"  Peak: {peak:.6f} | State: {state}", flush=True)
+                    self._interface = self._devices.Activate(
+                        pycaw.IAudioSessionManager2._iid_, 
+                        CLSCTX_ALL, 
+                        None
+                    )
+                    if self.debug:
+                        logger.debug("Activated IAudioSessionManager2 interface: %s", self._interface, extra=_INIT_LOG)
                     
-                    # Simplified audio detection - just check state and peak
-                    if state == AUDCLNT_SESSIONSTATE_ACTIVE and peak > self._peak_threshold:
-                        found_active = True
-                        if self._debug:
-                            print(f"  ** ACTIVE AUDIO **", flush=True)
-                        break
-                        
-                finally:
-                    for obj in (meter, volume, audio_session, session):
-                        self._safe_release(obj)
+                    # QueryInterface hands back an owned reference, unlike cast()
+                    self._session_manager = self._interface.QueryInterface(pycaw.IAudioSessionManager2)
+                    if self.debug:
+                        logger.debug("Queried IAudioSessionManager2: %s", self._session_manager, extra=_INIT_LOG)
                     
-                    if meter: del meter
-                    if volume: del volume
-                    if audio_session: del audio_session
-                    if session: del session
+                    self._sessions = self._session_manager.GetSessionEnumerator()
+                    if self.debug:
+                        logger.debug("Retrieved session enumerator: %s", self._sessions, extra=_INIT_LOG)
                     
-                    if self._debug:
-                        print(f"{time.strftime('%H:%M:%S')} - Released COM objects for session {i+1}", flush=True)
-            
-            gc.collect() # Ensure session variables get completely garbage collected each loop
-            
-            if self._debug:
-                print(f"\nFound active audio: {found_active}", flush=True)
-                print('=' * 50, flush=True)
-            return found_active
+                    self._session_count = None
+                    self._last_check = current_time
+                    self._initialized = True
+                    if self.debug:
+                        logger.debug("Initialization successful", extra=_INIT_LOG)
+                    break
+                except Exception as e:
+                    if self.debug:
+                        logger.debug("Initialization attempt %s failed: %s", attempt + 1, e, extra=_INIT_LOG)
+                    time.sleep(0.1)
             
+            if not self._initialized:
+                raise Exception("Failed to initialize COM objects after 3 attempts")
         except Exception as e:
-            if self._debug:
-                print(f"{time.strftime('%H:%M:%S')} - Error checking audio sessions: {e}", flush=True)
+            if self.debug:
+                logger.debug("Critical initialization error: %s", e, extra=_INIT_LOG)
+            self._pending_cause = 'com_error'
             self._cleanup()
+            raise
+
+    def _cleanup(self):
+        with self._lock:
+            # Release in reverse order of creation; each pointer is released exactly once
+            for com_object in (self._sessions, self._session_manager, self._interface, self._devices):
+                self._safe_release(com_object)
+            self._sessions = None
+            self._session_manager = None
+            self._interface = None
+            self._devices = None
+            self._initialized = False
+
+    def begin_walk(self):
+        if self.debug:
+            logger.debug("Initializing audio sessions...")
+        self._initialize_if_needed()
+        if not self._initialized or not self._sessions:
+            if self.debug:
+                logger.debug("Audio sessions not initialized properly")
+            return 0
+        count = self._sessions.GetCount()
+        if self._session_count is not None and count != self._session_count:
+            # Seen through the fresh enumerator; only counted, no rebuild is needed
+            self._count_rebuild('refreshes', 'session_count_changed')
+            if self.debug:
+                logger.debug("Session count changed to %s", count, extra=_INIT_LOG)
+        self._session_count = count
+        return count
+
+    def open_session(self, index):
+        profiler = self.profiler
+        if profiler is not None:
+            start = time.perf_counter()
+        session = self._sessions.GetSession(index)
+        if profiler is not None:
+            queried = time.perf_counter()
+            profiler.record('get_session', queried - start)
+        if not session:
+            if self.debug:
+                logger.debug("Session %s is None", index + 1)
+            return None
+        try:
+            control = session.QueryInterface(pycaw.IAudioSessionControl2)
+            if profiler is not None:
+                profiler.record('query_control', time.perf_counter() - queried)
+        except Exception as e:
+            if self.debug:
+                logger.debug("Failed to query IAudioSessionControl2 for session %s: %s", index + 1, e)
+            control = None
+        if not control:
+            release_com(session)
+            return None
+        return _ComSession(session, control)
+
+    def session_pid(self, handle):
+        return handle.control.GetProcessId()
+
+    def session_state(self, handle):
+        return handle.control.GetState()
+
+    def session_peak(self, handle):
+        if handle.meter is None:
+            try:
+                if self.profiler is None:
+                    handle.meter = handle.session.QueryInterface(pycaw.IAudioMeterInformation)
+                else:
+                    start = time.perf_counter()
+                    handle.meter = handle.session.QueryInterface(pycaw.IAudioMeterInformation)
+                    self.profiler.record('query_meter', time.perf_counter() - start)
+            except Exception as e:
+                if self.debug:
+                    logger.debug("Failed to query IAudioMeterInformation: %s", e)
+                return 0
+            if not handle.meter:
+                return 0
+        return handle.meter.GetPeakValue()
+
+    def release_session(self, handle):
+        handle.release()
+
+    def send_media_command(self, command):
+        return post_media_command(command)
+
+    def close(self):
+        self._drop_meters()
+        self._cleanup()
+
+class SimulatedComError(Exception):
+    """Raised by SimulatedAudioBackend where the COM backend would raise a COMError."""
+
+class _SimulatedSession:
+    __slots__ = ('pid', 'name', 'create_time', 'state', 'level')
+
+    def __init__(self, pid, name, create_time, state, level):
+        self.pid = pid
+        self.name = name
+        self.create_time = create_time
+        self.state = state
+        self.level = level  # Peak reported while the session is active
+
+class SimulatedAudioBackend(AudioBackend):
+    """Deterministic in-process stand-in for the Windows audio stack.
+
+    Models any number of sessions, churn between walks, random call
+    failures and per-call latencies, so the manager and the loops built on
+    it can be exercised and timed on any machine. The same seed always
+    gives the same sessions, churn and failures. session_count is the
+    number of sessions besides Spotify's; latencies maps a method name to
+    the seconds each call of it takes.
+    """
+    APP_NAMES = ('chrome.exe', 'firefox.exe', 'msedge.exe', 'Discord.exe', 'Teams.exe',
+                 'Zoom.exe', 'vlc.exe', 'steam.exe', 'explorer.exe', 'audiodg.exe')
+
+    def __init__(self, session_count=0, seed=0, spotify=True, active_ratio=0.2, churn_rate=0.0,
+                 failure_rate=0.0, latencies=None, sleep=time.sleep):
+        self._random = random.Random(seed)
+        self._sessions = []
+        self._by_pid = {}
+        self._walk = []
+        self._next_pid = 1000
+        self.churn_rate = churn_rate
+        self.failure_rate = failure_rate
+        self.latencies = dict(latencies or {})
+        self._sleep = sleep
+        self.calls = {}
+        self.failures = 0
+        self.churned = 0
+        self.commands = []  # Media commands received, in order
+        self.unresponsive = False  # Receive commands without acting on them, like a hung Spotify window
+        self.spotify_pid = None
+        if spotify:
+            self.spotify_pid = self.add_session('Spotify.exe', AUDCLNT_SESSIONSTATE_ACTIVE, 0.3)
+        for _ in range(session_count):
+            self._add_random_session(active_ratio)
+
+    def _add_random_session(self, active_ratio=0.2):
+        rng = self._random
+        state = AUDCLNT_SESSIONSTATE_ACTIVE if rng.random() < active_ratio else AUDCLNT_SESSIONSTATE_INACTIVE
+        return self.add_session(rng.choice(self.APP_NAMES), state, round(rng.uniform(0.01, 0.8), 4))
+
+    def add_session(self, name, state=AUDCLNT_SESSIONSTATE_INACTIVE, level=0.0):
+        """Start a process with one audio session and return its PID."""
+        pid = self._next_pid
+        self._next_pid += 4
+        session = _SimulatedSession(pid, name, float(pid), state, level)
+        self._sessions.append(session)
+        self._by_pid[pid] = session
+        return pid
+
+    def set_session(self, pid, state=None, level=None):
+        session = self._by_pid[pid]
+        if state is not None:
+            session.state = state
+        if level is not None:
+            session.level = level
+
+    def remove_session(self, pid):
+        """End the process behind a session."""
+        session = self._by_pid.pop(pid)
+        self._sessions.remove(session)
+
+    def _call(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        latency = self.latencies.get(name)
+        if latency:
+            self._sleep(latency)
+        if self.failure_rate and self._random.random() < self.failure_rate:
+            self.failures += 1
+            raise SimulatedComError(name)
+
+    def _churn(self):
+        rng = self._random
+        for session in list(self._sessions):
+            if session.pid != self.spotify_pid and rng.random() < self.churn_rate:
+                self.remove_session(session.pid)
+                self._add_random_session()
+                self.churned += 1
+
+    def begin_walk(self):
+        self._call('begin_walk')
+        if self.churn_rate:
+            self._churn()
+        self._walk = list(self._sessions)
+        return len(self._walk)
+
+    def open_session(self, index):
+        self._call('open_session')
+        walk = self._walk
+        return walk[index] if index < len(walk) else None
+
+    def session_pid(self, handle):
+        self._call('session_pid')
+        return handle.pid
+
+    def session_state(self, handle):
+        self._call('session_state')
+        return handle.state
+
+    def session_peak(self, handle):
+        self._call('session_peak')
+        return handle.level if handle.state == AUDCLNT_SESSIONSTATE_ACTIVE else 0.0
+
+    def device_peak(self):
+        try:
+            self._call('device_peak')
+        except SimulatedComError:
+            return None
+        # The endpoint mixes every active session, ignored processes included
+        total = 0.0
+        for session in self._sessions:
+            if session.state == AUDCLNT_SESSIONSTATE_ACTIVE:
+                total += session.level
+        return min(total, 1.0)
+
+    def send_media_command(self, command):
+        if command not in ('play', 'pause', 'toggle'):
+            raise ValueError("Unknown media command: %r" % (command,))
+        self.calls['send_media_command'] = self.calls.get('send_media_command', 0) + 1
+        self.commands.append(command)
+        session = self._by_pid.get(self.spotify_pid)
+        if session is None:
             return False
+        if self.unresponsive:
+            return True
+        if command == 'toggle':
+            command = 'pause' if session.state == AUDCLNT_SESSIONSTATE_ACTIVE else 'play'
+        session.state = AUDCLNT_SESSIONSTATE_ACTIVE if command == 'play' else AUDCLNT_SESSIONSTATE_INACTIVE
+        return True
 
-# Modify to store all Spotify PIDs at the start
-def get_spotify_processes():
-    # Define identifiers for Spotify and Spotify Premium
-    SPOTIFY_IDENTIFIERS = ['spotify', 'spotify premium', 'spotify.exe', 'Spotify.exe', 'Spotify Premium']
-    
-    spotify_processes = []
-    for proc in psutil.process_iter(['pid', 'name']):
-        if proc.info['name']:
-            proc_name_lower = proc.info['name'].lower()
-            if any(identifier in proc_name_lower for identifier in SPOTIFY_IDENTIFIERS):
-                spotify_processes.append(proc)
-    return spotify_processes
+    def process_identity(self, pid):
+        self.calls['process_identity'] = self.calls.get('process_identity', 0) + 1
+        session = self._by_pid.get(pid)
+        if session is None:
+            raise psutil.NoSuchProcess(pid)
+        return session.name, session.create_time
+
+    def process_create_time(self, pid):
+        return self.process_identity(pid)[1]
+
+    def process_exe(self, pid):
+        return None
+
+    def call_stats(self):
+        """Return the per-method call counts plus injected failures and churn."""
+        return {'calls': dict(self.calls), 'failures': self.failures, 'churned': self.churned,
+                'sessions': len(self._sessions)}
+
+# Actions taken by the monitor loop on a tick
+ACTION_NONE = 0
+ACTION_PAUSE = 1
+ACTION_RESUME = 2
+
+# Session trace file layout, little endian:
+#   header  magic, version, wall-clock start time, options length, then the
+#           manager options of the recording as UTF-8 JSON (from version 2)
+#   'N'     pid, create_time, name length, then the UTF-8 name; written once per process
+#   'T'     seconds since the first tick, device peak, flags, action, walk count,
+#           entry count, then one entry per session observed on that tick:
+#           pid, state (-1 if not read), peak (NaN if not read)
+TRACE_MAGIC = b'SSTR'
+TRACE_VERSION = 2
+TRACE_OPTIONS = ('peak_threshold', 'device_gate', 'cache_sessions', 'cache_timeout')  # Kept in the header
+TRACE_SPOTIFY_RUNNING = 0x01
+TRACE_WALKED = 0x02  # The session list was enumerated
+TRACE_DEVICE = 0x04  # The endpoint meter was read
+TRACE_FAILED = 0x08  # A backend error invalidated the walk
+_TRACE_HEADER = struct.Struct('<4sHd')
+_TRACE_OPTIONS = struct.Struct('<H')
+_TRACE_NAME = struct.Struct('<cIdH')
+_TRACE_TICK = struct.Struct('<cdfBBHH')
+_TRACE_ENTRY = struct.Struct('<Ibf')
+_NAN = float('nan')
+
+TraceTick = namedtuple('TraceTick', ['t', 'device_peak', 'flags', 'action', 'walk_count', 'entries'])
+
+class TraceRecorder:
+    """Appends what the monitor observed on each tick to a binary trace file.
+
+    Observations are collected by a RecordingBackend; end_tick() packs them
+    into an in-memory buffer that is written out every flush_bytes, so
+    recording costs a few dict updates per session and no syscalls per tick.
+    options holds the TRACE_OPTIONS the recording manager runs with, so a
+    replay walks the sessions on the same ticks.
+    """
+    def __init__(self, path, flush_bytes=64 * 1024, options=None):
+        self._file = open(path, 'wb')
+        encoded = json.dumps({name: value for name, value in (options or {}).items() if name in TRACE_OPTIONS},
+                             sort_keys=True).encode('utf-8')
+        self._buffer = bytearray(_TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, time.time()))
+        self._buffer += _TRACE_OPTIONS.pack(len(encoded)) + encoded
+        self._flush_bytes = flush_bytes
+        self._names = set()  # (pid, create_time) already written
+        self._start = None
+        self._reset_tick()
+        self.ticks = 0
+
+    def _reset_tick(self):
+        self._entries = {}  # pid -> [state, peak], in order of first observation
+        self._device_peak = _NAN
+        self._flags = 0
+        self._walk_count = 0
+
+    def _entry(self, pid):
+        entry = self._entries.get(pid)
+        if entry is None:
+            entry = self._entries[pid] = [-1, _NAN]
+        return entry
+
+    def observe_walk(self, count):
+        self._flags |= TRACE_WALKED
+        self._walk_count = count
+
+    def observe_pid(self, pid):
+        self._entry(pid)
+
+    def observe_state(self, pid, state):
+        self._entry(pid)[0] = state
+
+    def observe_peak(self, pid, peak):
+        self._entry(pid)[1] = peak
+
+    def observe_device(self, peak):
+        if peak is not None:
+            self._flags |= TRACE_DEVICE
+            self._device_peak = peak
+
+    def observe_failure(self):
+        self._flags |= TRACE_FAILED
+
+    def observe_process(self, pid, name, create_time):
+        key = (pid, create_time)
+        if key in self._names:
+            return
+        self._names.add(key)
+        encoded = name.encode('utf-8')
+        self._buffer += _TRACE_NAME.pack(b'N', pid, create_time, len(encoded))
+        self._buffer += encoded
+
+    def end_tick(self, now, action=ACTION_NONE, spotify_running=True):
+        """Write out the observations gathered since the previous end_tick()."""
+        if self._start is None:
+            self._start = now
+        flags = self._flags | (TRACE_SPOTIFY_RUNNING if spotify_running else 0)
+        entries = self._entries
+        buffer = self._buffer
+        buffer += _TRACE_TICK.pack(b'T', now - self._start, self._device_peak, flags, action,
+                                   min(self._walk_count, 0xFFFF), len(entries))
+        for pid, (state, peak) in entries.items():
+            buffer += _TRACE_ENTRY.pack(pid, state, peak)
+        self.ticks += 1
+        self._reset_tick()
+        if len(buffer) >= self._flush_bytes:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._file.write(self._buffer)
+            self._buffer = bytearray()
+        self._file.flush()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+
+class RecordingBackend(AudioBackend):
+    """Passes every call through to another backend and reports what it returned to a TraceRecorder."""
+    def __init__(self, backend, recorder):
+        self.backend = backend
+        self.recorder = recorder
+        self._pids = {}  # id(handle) -> pid for handles still open
+
+    def configure(self, debug=None, **options):
+        self.backend.configure(debug=debug, **options)
+
+    def begin_walk(self):
+        count = self.backend.begin_walk()
+        self.recorder.observe_walk(count)
+        return count
+
+    def open_session(self, index):
+        return self.backend.open_session(index)
+
+    def session_pid(self, handle):
+        pid = self.backend.session_pid(handle)
+        self._pids[id(handle)] = pid
+        self.recorder.observe_pid(pid)
+        return pid
+
+    def session_state(self, handle):
+        state = self.backend.session_state(handle)
+        pid = self._pids.get(id(handle))
+        if pid is not None:
+            self.recorder.observe_state(pid, state)
+        return state
+
+    def session_peak(self, handle):
+        peak = self.backend.session_peak(handle)
+        pid = self._pids.get(id(handle))
+        if pid is not None:
+            self.recorder.observe_peak(pid, peak)
+        return peak
+
+    def release_session(self, handle):
+        self._pids.pop(id(handle), None)
+        self.backend.release_session(handle)
+
+    def device_peak(self):
+        peak = self.backend.device_peak()
+        self.recorder.observe_device(peak)
+        return peak
+
+    def send_media_command(self, command):
+        return self.backend.send_media_command(command)
+
+    def process_identity(self, pid):
+        name, create_time = self.backend.process_identity(pid)
+        self.recorder.observe_process(pid, name, create_time)
+        return name, create_time
+
+    def process_create_time(self, pid):
+        return self.backend.process_create_time(pid)
+
+    def process_exe(self, pid):
+        return self.backend.process_exe(pid)
+
+    def invalidate(self, cause):
+        if cause == 'com_error':
+            self.recorder.observe_failure()
+        self.backend.invalidate(cause)
+
+    def cache_stats(self):
+        return self.backend.cache_stats()
+
+    def close(self):
+        self.backend.close()
+
+# Quarter-decade buckets from 100 nanoseconds to 1 second
+PROFILE_BUCKETS = tuple(round(10 ** (exponent / 4) * 1e-6, 12) for exponent in range(-4, 25))
+
+class PhaseProfiler:
+    """Aggregates the time spent in each phase of the monitor tick into histograms.
+
+    Phases are the AudioBackend calls timed by ProfilingBackend, the
+    finer COM steps timed by ComAudioBackend, the whole snapshot and
+    garbage collection. record() is all the hot path pays.
+    """
+    # Report order; phases not listed here follow alphabetically
+    PHASES = (
+        'snapshot', 'device_peak', 'begin_walk', 'com_rebuild', 'enumerator_refresh',
+        'open_session', 'get_session', 'query_control', 'session_pid', 'process_identity',
+        'process_create_time', 'process_exe', 'session_state', 'session_peak', 'query_meter', 'release_session',
+        'gc', 'send_media_command',
+    )
+
+    def __init__(self, buckets=PROFILE_BUCKETS):
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.maxima = {}
+
+    def record(self, phase, seconds):
+        with self._lock:
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                histogram = self.histograms[phase] = Histogram(self._buckets)
+                self.maxima[phase] = 0.0
+            histogram.observe(seconds)
+            if seconds > self.maxima[phase]:
+                self.maxima[phase] = seconds
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.maxima.clear()
+
+    def quantile(self, phase, q):
+        """Upper bucket bound below which a fraction q of the phase's samples fall."""
+        with self._lock:
+            histogram = self.histograms[phase]
+            target = q * histogram.count
+            for bound, total in histogram.cumulative():
+                if total >= target:
+                    return self.maxima[phase] if bound == '+Inf' else min(bound, self.maxima[phase])
+        return None
+
+    def report(self):
+        with self._lock:
+            phases = [phase for phase in self.PHASES if phase in self.histograms]
+            phases += sorted(set(self.histograms) - set(self.PHASES))
+        lines = [f"{'Phase':<22}{'Calls':>9}{'Total ms':>11}{'Mean us':>10}{'p50 us':>10}{'p95 us':>10}{'Max us':>10}"]
+        for phase in phases:
+            histogram = self.histograms[phase]
+            lines.append(f"{phase:<22}{histogram.count:>9}{histogram.sum * 1e3:>11.2f}"
+                         f"{histogram.sum / histogram.count * 1e6:>10.1f}{self.quantile(phase, 0.5) * 1e6:>10.1f}"
+                         f"{self.quantile(phase, 0.95) * 1e6:>10.1f}{self.maxima[phase] * 1e6:>10.1f}")
+        return '\n'.join(lines)
+
+class ProfilingBackend(AudioBackend):
+    """Times every call into another backend and records it with a PhaseProfiler under the method name."""
+    def __init__(self, backend, profiler):
+        self.backend = backend
+        self.profiler = profiler
+        if hasattr(backend, 'profiler'):
+            backend.profiler = profiler  # Finer COM steps
+
+    def _timed(self, phase, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self.profiler.record(phase, time.perf_counter() - start)
+
+    def configure(self, debug=None, **options):
+        self.backend.configure(debug=debug, **options)
+
+    def begin_walk(self):
+        return self._timed('begin_walk', self.backend.begin_walk)
+
+    def open_session(self, index):
+        return self._timed('open_session', self.backend.open_session, index)
+
+    def session_pid(self, handle):
+        return self._timed('session_pid', self.backend.session_pid, handle)
+
+    def session_state(self, handle):
+        return self._timed('session_state', self.backend.session_state, handle)
+
+    def session_peak(self, handle):
+        return self._timed('session_peak', self.backend.session_peak, handle)
+
+    def release_session(self, handle):
+        return self._timed('release_session', self.backend.release_session, handle)
+
+    def device_peak(self):
+        return self._timed('device_peak', self.backend.device_peak)
+
+    def send_media_command(self, command):
+        return self._timed('send_media_command', self.backend.send_media_command, command)
+
+    def process_identity(self, pid):
+        return self._timed('process_identity', self.backend.process_identity, pid)
+
+    def process_create_time(self, pid):
+        return self._timed('process_create_time', self.backend.process_create_time, pid)
+
+    def process_exe(self, pid):
+        return self._timed('process_exe', self.backend.process_exe, pid)
+
+    def invalidate(self, cause):
+        self.backend.invalidate(cause)
+
+    def cache_stats(self):
+        return self.backend.cache_stats()
+
+    def close(self):
+        self.backend.close()
+
+class TraceReader:
+    """Iterates the ticks of a trace file; names maps each PID to its latest (name, create_time).
+
+    options are the manager options the trace was recorded with; version 1
+    traces did not store them.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._data = f.read()
+        magic, version, self.started = _TRACE_HEADER.unpack_from(self._data, 0)
+        if magic != TRACE_MAGIC or version not in (1, TRACE_VERSION):
+            raise ValueError("Not a version %s session trace: %s" % (TRACE_VERSION, path))
+        self._body = _TRACE_HEADER.size
+        self.options = {}
+        if version >= 2:
+            length, = _TRACE_OPTIONS.unpack_from(self._data, self._body)
+            self._body += _TRACE_OPTIONS.size
+            self.options = json.loads(self._data[self._body:self._body + length].decode('utf-8'))
+            self._body += length
+        self.names = {}
+
+    def __iter__(self):
+        data = self._data
+        offset = self._body
+        end = len(data)
+        names = self.names
+        names.clear()
+        while offset < end:
+            kind = data[offset:offset + 1]
+            if kind == b'N':
+                _, pid, create_time, length = _TRACE_NAME.unpack_from(data, offset)
+                offset += _TRACE_NAME.size
+                names[pid] = (data[offset:offset + length].decode('utf-8'), create_time)
+                offset += length
+            elif kind == b'T':
+                _, t, device_peak, flags, action, walk_count, count = _TRACE_TICK.unpack_from(data, offset)
+                offset += _TRACE_TICK.size
+                entries = tuple(_TRACE_ENTRY.iter_unpack(data[offset:offset + count * _TRACE_ENTRY.size]))
+                offset += count * _TRACE_ENTRY.size
+                yield TraceTick(t, device_peak, flags, action, walk_count, entries)
+            else:
+                raise ValueError("Corrupt session trace at offset %s" % offset)
+
+class ReplayedComError(Exception):
+    """Raised by TraceReplayBackend on ticks where the recorded walk failed."""
+
+class TraceReplayBackend(AudioBackend):
+    """Serves the sessions of one recorded tick at a time; advance() moves to the next tick.
+
+    Values the recording never read, such as the state of an ignored
+    process, replay as an inactive, silent session.
+    """
+    def __init__(self, reader):
+        self.reader = reader
+        self._ticks = iter(reader)
+        self._by_pid = {}
+        self.tick = None
+        self.commands = []
+
+    def advance(self):
+        self.tick = tick = next(self._ticks, None)
+        if tick is not None:
+            self._by_pid = {entry[0]: entry for entry in tick.entries}
+        return tick
+
+    def begin_walk(self):
+        tick = self.tick
+        if tick.flags & TRACE_FAILED:
+            raise ReplayedComError("Walk failed in the recording")
+        return tick.walk_count if tick.flags & TRACE_WALKED else len(tick.entries)
+
+    def open_session(self, index):
+        entries = self.tick.entries
+        return entries[index] if index < len(entries) else None
+
+    def session_pid(self, handle):
+        return handle[0]
+
+    def session_state(self, handle):
+        # A handle kept from an earlier tick reads the current values
+        state = self._by_pid.get(handle[0], handle)[1]
+        return state if state >= 0 else AUDCLNT_SESSIONSTATE_INACTIVE
+
+    def session_peak(self, handle):
+        peak = self._by_pid.get(handle[0], handle)[2]
+        return 0.0 if peak != peak else peak
+
+    def device_peak(self):
+        tick = self.tick
+        return tick.device_peak if tick.flags & TRACE_DEVICE else None
+
+    def send_media_command(self, command):
+        self.commands.append(command)
+        return True
+
+    def process_identity(self, pid):
+        identity = self.reader.names.get(pid)
+        if identity is None:
+            raise psutil.NoSuchProcess(pid)
+        return identity
+
+    def process_create_time(self, pid):
+        return self.process_identity(pid)[1]
+
+    def process_exe(self, pid):
+        return None
+
+ReplayStats = namedtuple('ReplayStats', ['ticks', 'trace_seconds', 'elapsed', 'pauses', 'resumes', 'mismatches'])
+
+def replay_trace(path, decide=None, on_tick=None, **manager_options):
+    """Run a recorded trace through an AudioSessionManager as fast as it will go.
+
+    decide(t, snapshot, tick) returns the action for a tick; without it the
+    recorded actions are replayed. Ticks on which Spotify was not running
+    get snapshot None, as in the monitor loop. on_tick(tick, snapshot,
+    action) sees every tick. mismatches counts ticks whose action differs
+    from the recorded one. Options stored in the trace, such as
+    device_gate, apply unless manager_options overrides them.
+    """
+    reader = TraceReader(path)
+    backend = TraceReplayBackend(reader)
+    for name, value in reader.options.items():
+        manager_options.setdefault(name, value)
+    manager_options.setdefault('debug', False)
+    manager = AudioSessionManager(backend=backend, **manager_options)
+    ticks = pauses = resumes = mismatches = 0
+    t = 0.0
+    start = time.perf_counter()
+    try:
+        while True:
+            tick = backend.advance()
+            if tick is None:
+                break
+            t = tick.t
+            snapshot = manager.snapshot() if tick.flags & TRACE_SPOTIFY_RUNNING else None
+            action = decide(t, snapshot, tick) if decide is not None else tick.action
+            if action == ACTION_PAUSE:
+                pauses += 1
+            elif action == ACTION_RESUME:
+                resumes += 1
+            if action != tick.action:
+                mismatches += 1
+            if on_tick is not None:
+                on_tick(tick, snapshot, action)
+            ticks += 1
+    finally:
+        manager.close()
+    return ReplayStats(ticks, t, time.perf_counter() - start, pauses, resumes, mismatches)
+
+class _SessionLevel:
+    __slots__ = ('ring', 'index', 'count', 'sum_squares', 'ema', 'active', 'pending_since', 'last_seen')
+
+    def __init__(self, window):
+        self.ring = array('f', bytes(4 * window))
+        self.index = 0
+        self.count = 0
+        self.sum_squares = 0.0
+        self.ema = 0.0
+        self.active = False
+        self.pending_since = None  # When the level first crossed towards the other state
+        self.last_seen = 0.0
+
+class ActivityDetector:
+    """Per-session smoothing and hysteresis for the active-audio test.
+
+    Each session keeps its last window peaks in a fixed-size float array.
+    A session starts playing once its peaks stay above the on threshold for
+    min_on seconds, and stops once its smoothed level (windowed 'rms' or
+    'ema') stays below the off threshold, peak_threshold * off_ratio, for
+    min_off seconds. Notification blips and gaps in speech therefore do
+    not flip the result.
+    """
+    def __init__(self, peak_threshold=0.0005, off_ratio=0.5, window=4, mode='rms', alpha=0.5,
+                 min_on=0.0, min_off=1.0, max_idle=30.0):
+        if mode not in ('ema', 'rms'):
+            raise ValueError("mode must be 'ema' or 'rms'")
+        self.window = window
+        self.mode = mode
+        self.alpha = alpha
+        self.off_ratio = off_ratio
+        self.min_on = min_on
+        self.min_off = min_off
+        self.max_idle = max_idle  # Sessions not seen for this long are forgotten
+        self.set_threshold(peak_threshold)
+        self._levels = {}
+        self._last_prune = 0.0
+        self._last_walk = float('-inf')  # Sessions not updated since then are not counted as playing
+
+    def set_threshold(self, peak_threshold):
+        self.on_threshold = peak_threshold
+        self.off_threshold = peak_threshold * self.off_ratio
+
+    def update(self, key, now, peak):
+        """Add one peak sample for a session and return whether it counts as playing."""
+        level = self._levels.get(key)
+        if level is None:
+            level = self._levels[key] = _SessionLevel(self.window)
+        level.last_seen = now
+
+        ring = level.ring
+        index = level.index
+        old = ring[index]
+        ring[index] = peak
+        level.index = (index + 1) % len(ring)
+        if level.count < len(ring):
+            level.count += 1
+        level.sum_squares = max(0.0, level.sum_squares + peak * peak - old * old)
+        level.ema += self.alpha * (peak - level.ema)
+
+        if level.active:
+            smoothed = level.ema if self.mode == 'ema' else math.sqrt(level.sum_squares / level.count)
+            crossing = smoothed < self.off_threshold
+            hold = self.min_off
+        else:
+            crossing = peak > self.on_threshold
+            hold = self.min_on
+        if not crossing:
+            level.pending_since = None
+        elif level.pending_since is None and hold > 0:
+            level.pending_since = now
+        elif hold <= 0 or now - level.pending_since >= hold:
+            level.active = not level.active
+            level.pending_since = None
+        return level.active
+
+    def end_walk(self, now):
+        """Mark the end of a session walk whose updates used now.
+
+        Sessions that walk did not update, because they closed or because
+        their side was already decided, no longer count for any_active().
+        """
+        self._last_walk = now
+
+    def any_active(self):
+        last_walk = self._last_walk
+        for level in self._levels.values():
+            if level.active and level.last_seen >= last_walk:
+                return True
+        return False
+
+    def prune(self, now):
+        """Forget sessions that have not been updated for max_idle seconds; runs at most once per max_idle."""
+        if now - self._last_prune < self.max_idle:
+            return 0
+        self._last_prune = now
+        stale = [key for key, level in self._levels.items() if now - level.last_seen >= self.max_idle]
+        for key in stale:
+            del self._levels[key]
+        return len(stale)
+
+    def reset(self):
+        self._levels.clear()
+
+    def __len__(self):
+        return len(self._levels)
+
+class AudioSessionManager:
+    def __init__(self, peak_threshold=0.0005, cache_timeout=2, log_interval=5, debug=True, ignored_processes=None, cache_sessions=False, event_source=None, device_gate=False, gc_interval=None, backend=None, detector=None, profiler=None, watchdog=None):
+        # The COM graph and its caching live in the backend
+        self._backend = backend or ComAudioBackend(cache_timeout=cache_timeout, cache_sessions=cache_sessions, debug=debug)
+        self._profiler = profiler  # PhaseProfiler timing every backend call of a tick
+        if profiler is not None:
+            self._backend = ProfilingBackend(self._backend, profiler)
+        self._session_count = None
+        self._event_tracker = SessionEventTracker(event_source) if event_source else None
+        self._ignored = ProcessMatcher(ignored_processes or DEFAULT_IGNORED_PROCESSES)
+        self._process_cache = ProcessInfoCache(self._ignored, process_source=self._backend)
+        self._device_gate = device_gate  # Skip the session walk when the endpoint meter says silence
+        self._detector = detector  # ActivityDetector replacing the instantaneous peak test
+        self._gate_max_reuse = 2  # Full walks forced after this many Spotify-only gated ticks
+        self._gate_reuse = 0
+        self._spotify_session = None  # Spotify session seen playing in the last full walk
+        self._gate_stats = {'checks': 0, 'silent': 0, 'spotify_only': 0, 'full_walks': 0}
+        self._gc_policy = GcPolicy(gc_interval)
+        self._gc_policy.profiler = profiler
+        self._watchdog = watchdog  # LeakWatchdog deciding when the COM objects are reset
+        self._debug = debug
+        self._peak_threshold = peak_threshold
+        self._com_initialized = False
+        self._log_interval = log_interval
+        log_rate_limiter.set_interval('init', log_interval)
+
+    @property
+    def backend(self):
+        return self._backend
+
+    def configure(self, peak_threshold=None, device_gate=None, debug=None, ignored_processes=None, **backend_options):
+        """Apply settings changed at runtime; None leaves a setting as it is.
+
+        ignored_processes is recompiled only when the rules differ from the
+        current ones. Other keyword arguments, such as cache_sessions and
+        cache_timeout, are passed on to the backend.
+        """
+        if ignored_processes is not None and tuple(ignored_processes) != self._ignored.rules:
+            self._ignored = ProcessMatcher(ignored_processes)
+            self._process_cache.set_ignored(self._ignored)
+        if peak_threshold is not None:
+            self._peak_threshold = peak_threshold
+            if self._detector is not None:
+                self._detector.set_threshold(peak_threshold)
+        if device_gate is not None:
+            self._device_gate = device_gate
+        if debug is not None:
+            self._debug = debug
+        self._backend.configure(debug=debug, **backend_options)
+
+    def cache_stats(self):
+        """Return a copy of the backend's session cache counters."""
+        return self._backend.cache_stats()
+
+    def invalidate(self, cause):
+        """Drop the cached sessions so the next check rebuilds them."""
+        self._release_spotify_session()
+        self._backend.invalidate(cause)
+
+    def _release_spotify_session(self):
+        if self._spotify_session is not None:
+            self._backend.release_session(self._spotify_session)
+            self._spotify_session = None
+
+    def send_media_command(self, command):
+        """Send 'play' or 'pause' to Spotify through the backend."""
+        return self._backend.send_media_command(command)
+
+    def _gated_snapshot(self):
+        """Answer from the endpoint meter alone when it can; None means walk the sessions."""
+        device_peak = self._backend.device_peak()
+        if device_peak is None:
+            return None
+        self._gate_stats['checks'] += 1
+        # Sessions still held active by the detector need a walk to decay
+        if device_peak <= self._peak_threshold and (self._detector is None or not self._detector.any_active()):
+            self._gate_stats['silent'] += 1
+            self._gate_reuse = 0
+            return AudioSnapshot(False, 0.0, False, 0.0, None, None, self._session_count or 0)
+
+        # Spotify was the only thing playing last time; if its own meter
+        # explains the endpoint level, nothing else has started
+        if self._spotify_session is not None and self._gate_reuse < self._gate_max_reuse:
+            try:
+                spotify_peak = self._backend.session_peak(self._spotify_session)
+            except Exception:
+                self._release_spotify_session()
+                return None
+            if spotify_peak > self._peak_threshold and device_peak <= spotify_peak * 1.05 + self._peak_threshold:
+                self._gate_stats['spotify_only'] += 1
+                self._gate_reuse += 1
+                return AudioSnapshot(True, spotify_peak, False, 0.0, None, None, self._session_count or 0, True)
+        return None
+
+    def gate_stats(self):
+        """Return the device peak gate counters."""
+        return dict(self._gate_stats)
+
+    def watchdog_stats(self):
+        """Return the leak watchdog counters, or {} without a watchdog."""
+        return self._watchdog.stats() if self._watchdog is not None else {}
+
+    def gc_stats(self):
+        """Return the collection policy counters."""
+        return self._gc_policy.stats()
+
+    def close(self):
+        try:
+            if self._event_tracker is not None:
+                self._event_tracker.stop()
+            self._release_spotify_session()
+            self._backend.close()
+            if self._com_initialized:
+                pythoncom.CoUninitialize()
+        except Exception:
+            pass  # Silently ignore exceptions during cleanup
+
+    def _process_info(self, process_id):
+        """Return the cached ProcessInfo for a PID, or None for ignored or vanished processes."""
+        try:
+            info = self._process_cache.lookup(process_id)
+        except psutil.NoSuchProcess:
+            if self._debug:
+                logger.debug("No such process with PID: %s", process_id)
+            return None
+        except Exception as e:
+            if self._debug:
+                logger.debug("Error retrieving process for PID %s: %s", process_id, e)
+            return None
+
+        if info.is_ignored:
+            if self._debug:
+                logger.debug("Ignored process: %s", info.name_lower)
+            return None
+        return info
+
+    def _is_active(self, process_id, state, peak, now):
+        if self._detector is None:
+            # Simplified audio detection - just check state and peak
+            return state == AUDCLNT_SESSIONSTATE_ACTIVE and peak > self._peak_threshold
+        return self._detector.update(process_id, now, peak if state == AUDCLNT_SESSIONSTATE_ACTIVE else 0.0)
+
+    def process_cache_stats(self):
+        """Return the PID cache counters."""
+        return self._process_cache.stats()
+
+    def check_audio_sessions(self, check_spotify=False):
+        """Return whether Spotify (or any other app) is actively playing audio."""
+        snapshot = self.snapshot()
+        return snapshot.spotify_active if check_spotify else snapshot.other_active
+
+    def snapshot(self):
+        """Enumerate the audio sessions once and summarise Spotify and other-app activity."""
+        if self._watchdog is not None and self._watchdog.check() is not None:
+            self.invalidate('leak_suspected')
+        if self._profiler is None:
+            return self._snapshot()
+        start = time.perf_counter()
+        try:
+            return self._snapshot()
+        finally:
+            self._profiler.record('snapshot', time.perf_counter() - start)
+
+    def _snapshot(self):
+        if self._event_tracker is not None:
+            return self._event_snapshot()
+        if self._device_gate:
+            gated = self._gated_snapshot()
+            if gated is not None:
+                return gated
+            self._gate_stats['full_walks'] += 1
+            self._gate_reuse = 0
+
+        # We assume CoInitialize is handled correctly by the caller / current thread now
+
+        backend = self._backend
+        now = time.monotonic() if self._detector is not None else 0.0
+        try:
+            count = backend.begin_walk()
+            self._session_count = count
+            if self._debug:
+                logger.debug("Number of audio sessions: %s", count)
+            builder = _SnapshotBuilder()
+            self._release_spotify_session()
+
+            if self._debug:
+                logger.debug("Checking Spotify and other apps audio")
+
+            for i in range(count):
+                if self._debug:
+                    logger.debug("Checking session %s/%s", i+1, count)
+                handle = backend.open_session(i)
+                if handle is None:
+                    continue
+
+                # Every handle is released exactly once, unless the gate keeps it
+                try:
+                    try:
+                        process_id = backend.session_pid(handle)
+                        if self._debug:
+                            logger.debug("Process ID: %s", process_id)
+                    except Exception as e:
+                        if self._debug:
+                            logger.debug("Failed to get Process ID for session %s: %s", i+1, e)
+                        # Restart enumerator on fatal COM errors to avoid stale pointers
+                        self.invalidate('com_error')
+                        return EMPTY_SNAPSHOT
+
+                    info = self._process_info(process_id)
+                    if info is None:
+                        continue
+                    process_name = info.name_lower
+                    is_spotify = info.is_spotify
+
+                    # A decided side needs no further backend calls
+                    if not builder.wants(is_spotify):
+                        continue
+
+                    try:
+                        state = backend.session_state(handle)
+                        peak = backend.session_peak(handle)
+                    except Exception as e:
+                        if self._debug:
+                            logger.debug("Failed to get state or peak for session %s: %s", i+1, e)
+                        continue
+
+                    if self._debug and (peak > self._peak_threshold or state == AUDCLNT_SESSIONSTATE_ACTIVE):
+                        logger.debug("%s: Peak: %.6f | State: %s", process_name, peak, state)
+
+                    active = self._is_active(process_id, state, peak, now)
+                    builder.add(is_spotify, process_name, process_id, peak, active,
+                                state == AUDCLNT_SESSIONSTATE_ACTIVE)
+                    if active and self._debug:
+                        logger.debug("** ACTIVE AUDIO ** %s", process_name)
+                    if active and is_spotify and self._device_gate:
+                        # Keep this session alive for the gate
+                        self._release_spotify_session()
+                        self._spotify_session, handle = handle, None
+
+                    if builder.complete():
+                        break
+                finally:
+                    if handle is not None:
+                        backend.release_session(handle)
+
+            self._gc_policy.maybe_collect()
+            if self._detector is not None:
+                self._detector.end_walk(now)
+                self._detector.prune(now)
+
+            result = builder.build(count)
+            if result.other_active:
+                self._release_spotify_session()  # Spotify alone no longer explains the signal
+            if self._debug:
+                logger.debug("Snapshot: %s", result)
+            return result
+
+        except Exception as e:
+            if self._debug:
+                logger.debug("Error checking audio sessions: %s", e)
+            self.invalidate('com_error')
+            return EMPTY_SNAPSHOT
+
+    def _event_snapshot(self):
+        """Summarise only the sessions the event source currently reports as active."""
+        tracker = self._event_tracker
+        try:
+            tracker.start()
+        except Exception as e:
+            if self._debug:
+                logger.debug("Failed to subscribe to session events: %s", e)
+            return EMPTY_SNAPSHOT
+
+        builder = _SnapshotBuilder()
+        now = time.monotonic() if self._detector is not None else 0.0
+        for process_id, meter in tracker.active_sessions():
+            info = self._process_info(process_id)
+            if info is None:
+                continue
+            process_name = info.name_lower
+            is_spotify = info.is_spotify
+            if not builder.wants(is_spotify):
+                continue
+            try:
+                peak = meter.GetPeakValue() if meter else 0
+            except Exception as e:
+                if self._debug:
+                    logger.debug("Failed to get peak for PID %s: %s", process_id, e)
+                continue
+            # Only active sessions are tracked here, so the peak decides
+            builder.add(is_spotify, process_name, process_id, peak,
+                        self._is_active(process_id, AUDCLNT_SESSIONSTATE_ACTIVE, peak, now), True)
+            if builder.complete():
+                break
+
+        result = builder.build(tracker.session_count())
+        if self._debug:
+            logger.debug("Event snapshot: %s", result)
+        return result
+
+    def wait_for_change(self, timeout, idle_timeout=None):
+        """Sleep until the next tick; in event mode return early when a session changes.
+
+        With no active sessions the event mode waits up to idle_timeout instead,
+        since nothing can start playing without raising a state change.
+        """
+        tracker = self._event_tracker
+        if tracker is None:
+            time.sleep(timeout)
+            return False
+        if idle_timeout is not None and not tracker.has_active():
+            timeout = idle_timeout
+        return tracker.wait(timeout)
+
+    @property
+    def event_driven(self):
+        return self._event_tracker is not None
+
+    def wake(self):
+        """Interrupt a pending wait_for_change() in event mode."""
+        if self._event_tracker is not None:
+            self._event_tracker.wake()
+
+ProcessInfo = namedtuple('ProcessInfo', ['pid', 'name', 'name_lower', 'create_time', 'is_spotify', 'is_ignored'])
+
+def is_spotify_name(name_lower):
+    # Check for both Spotify and Spotify Premium
+    return any(identifier in name_lower for identifier in SPOTIFY_IDENTIFIERS)
+
+_GLOB_CHARS = frozenset('*?[')
+# Leading global flags or backreferences, which break or renumber inside a merged alternation
+_UNMERGEABLE_PATTERN = re.compile(r'^\(\?[aiLmsux]+\)|\\[1-9]|\(\?P=')
+
+def _strip_exe(name_lower):
+    return name_lower[:-4] if name_lower.endswith('.exe') else name_lower
+
+def _normalize_path(path):
+    return path.replace('/', '\\').lower()
+
+class ProcessMatcher:
+    """Decides which processes are ignored; compiled once from a list of rules.
+
+    A rule is an exact name ('obs64.exe', matched in any case and with or
+    without '.exe'), a glob ('ScreenClipping*.exe'), a regular expression
+    prefixed with 're:', or, when it contains a path separator, a path
+    prefix ending in a separator or a path glob matched against the
+    executable path. Exact names sit in a set and the patterns of each
+    kind are merged into one expression, so a match usually costs a hash
+    lookup and at most two regex matches. Expressions that would change
+    meaning or fail once merged (inline global flags, backreferences,
+    group names used twice) are matched on their own. Invalid patterns
+    are logged and skipped.
+    """
+    def __init__(self, rules=()):
+        self.rules = tuple(rules)
+        names = set()
+        name_patterns = []
+        prefixes = []
+        path_patterns = []
+        for rule in self.rules:
+            rule = rule.strip()
+            if not rule:
+                continue
+            if rule.startswith('re:'):
+                pattern = rule[3:]
+            elif '\\' in rule or '/' in rule:
+                path = _normalize_path(rule)
+                if path.endswith('\\') and not _GLOB_CHARS.intersection(path):
+                    prefixes.append(path)
+                    continue
+                path_patterns.append(fnmatch.translate(path))
+                continue
+            elif _GLOB_CHARS.intersection(rule):
+                pattern = fnmatch.translate(rule.lower())
+            else:
+                names.add(_strip_exe(rule.lower()))
+                continue
+            try:
+                name_patterns.append(re.compile(pattern, re.IGNORECASE))
+            except re.error as e:
+                logger.warning("Skipping invalid ignore rule %r: %s", rule, e)
+        self._names = frozenset(names)
+        self._name_pattern, self._name_separate = self._merge(name_patterns)
+        self._path_prefixes = tuple(prefixes)
+        self._path_pattern, _ = self._merge([re.compile(pattern, re.IGNORECASE) for pattern in path_patterns])
+        self.needs_path = bool(prefixes or path_patterns)  # Whether matches() can use the exe path
+
+    @staticmethod
+    def _merge(compiled):
+        """Join compiled patterns into one alternation; returns (merged or None, patterns kept separate)."""
+        separate = [pattern for pattern in compiled if _UNMERGEABLE_PATTERN.search(pattern.pattern)]
+        merged = [pattern for pattern in compiled if not _UNMERGEABLE_PATTERN.search(pattern.pattern)]
+        if not merged:
+            return None, tuple(separate)
+        try:
+            return re.compile('|'.join(f'(?:{pattern.pattern})' for pattern in merged), re.IGNORECASE), tuple(separate)
+        except re.error:
+            return None, tuple(compiled)  # e.g. two rules defining the same group name
+
+    @classmethod
+    def of(cls, rules):
+        """Return rules as a ProcessMatcher, compiling them unless they already are one."""
+        return rules if isinstance(rules, cls) else cls(rules or ())
+
+    def __bool__(self):
+        return bool(self._names or self._name_pattern or self._name_separate or self.needs_path)
+
+    def matches(self, name_lower, exe=None):
+        """Whether a process named name_lower (running exe, if known) is ignored."""
+        if _strip_exe(name_lower) in self._names:
+            return True
+        if self._name_pattern is not None and self._name_pattern.fullmatch(name_lower):
+            return True
+        for pattern in self._name_separate:
+            if pattern.fullmatch(name_lower):
+                return True
+        if exe and self.needs_path:
+            path = _normalize_path(exe)
+            if path.startswith(self._path_prefixes):
+                return True
+            if self._path_pattern is not None and self._path_pattern.fullmatch(path):
+                return True
+        return False
+
+class ProcessInfoCache:
+    """Bounded LRU of process names and classification, keyed by PID.
+
+    Entries are revalidated against the process create time at most every
+    validate_interval seconds, so a reused PID is reclassified. The ignore
+    decision is memoised with the entry, so the matcher runs once per PID.
+    """
+    def __init__(self, ignored_processes=None, max_size=256, validate_interval=5.0, process_source=None):
+        self._entries = OrderedDict()  # pid -> [ProcessInfo, last validation time]
+        self._processes = process_source or ProcessSource()
+        self.ignored = ProcessMatcher.of(ignored_processes)
+        self.max_size = max_size
+        self.validate_interval = validate_interval
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0  # Entries dropped because the PID was reused or exited
+
+    def set_ignored(self, ignored_processes):
+        """Switch to a new ProcessMatcher (or rules); the memoised decisions are dropped if it changed."""
+        matcher = ProcessMatcher.of(ignored_processes)
+        changed = matcher.rules != self.ignored.rules
+        self.ignored = matcher
+        if changed:
+            self._entries.clear()
+
+    def clear(self):
+        self._entries.clear()
+
+    def lookup(self, pid):
+        """Return the ProcessInfo for pid; raises psutil.NoSuchProcess if it is gone."""
+        now = time.monotonic()
+        entry = self._entries.get(pid)
+        if entry is not None:
+            info, checked = entry
+            if now - checked < self.validate_interval:
+                self._entries.move_to_end(pid)
+                self.hits += 1
+                return info
+            try:
+                create_time = self._processes.process_create_time(pid)
+            except psutil.NoSuchProcess:
+                del self._entries[pid]
+                self.invalidations += 1
+                raise
+            if create_time == info.create_time:
+                entry[1] = now
+                self._entries.move_to_end(pid)
+                self.hits += 1
+                return info
+            del self._entries[pid]
+            self.invalidations += 1
+
+        self.misses += 1
+        name, create_time = self._processes.process_identity(pid)
+        name_lower = name.lower()
+        info = ProcessInfo(pid, name, name_lower, create_time, is_spotify_name(name_lower),
+                           bool(self.ignored) and self.ignored.matches(name_lower, self._exe(pid)))
+        self._entries[pid] = [info, now]
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return info
+
+    def _exe(self, pid):
+        # Only path rules need the executable path, which costs another system call
+        if not self.ignored.needs_path:
+            return None
+        try:
+            return self._processes.process_exe(pid)
+        except psutil.Error:
+            return None  # Protected processes hide their path; name rules still apply
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'invalidations': self.invalidations}
+
+class _SnapshotBuilder:
+    """Accumulates per-session results into an AudioSnapshot."""
+    __slots__ = ('spotify_active', 'spotify_peak', 'spotify_playing', 'other_active', 'other_peak', 'other_process',
+                 'other_pid')
+
+    def __init__(self):
+        self.spotify_active = False
+        self.spotify_peak = 0.0
+        self.spotify_playing = False
+        self.other_active = False
+        self.other_peak = 0.0
+        self.other_process = None
+        self.other_pid = None
+
+    def wants(self, is_spotify):
+        return not (self.spotify_active if is_spotify else self.other_active)
+
+    def add(self, is_spotify, process_name, process_id, peak, active, playing):
+        if is_spotify:
+            self.spotify_peak = max(self.spotify_peak, peak)
+            self.spotify_active = active
+            self.spotify_playing = self.spotify_playing or playing
+        else:
+            self.other_peak = max(self.other_peak, peak)
+            if active:
+                self.other_active = True
+                self.other_process = process_name
+                self.other_pid = process_id
+
+    def complete(self):
+        return self.spotify_active and self.other_active
+
+    def build(self, session_count):
+        return AudioSnapshot(self.spotify_active, self.spotify_peak, self.other_active, self.other_peak,
+                             self.other_process, self.other_pid, session_count, self.spotify_playing)
+
+class SessionEventSource:
+    """Pushes audio session notifications into a SessionEventTracker.
+
+    Implementations call the tracker's session_created(key, pid, state, meter),
+    state_changed(key, state), volume_changed(key) and session_removed(key)
+    from any thread. meter only needs a GetPeakValue() method.
+    """
+    def start(self, tracker):
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+class SessionEventTracker:
+    """Session table kept current by a SessionEventSource."""
+    def __init__(self, source):
+        self._source = source
+        self._lock = threading.Lock()
+        self._sessions = {}  # key -> (pid, state, meter)
+        self._active = {}  # key -> (pid, meter) for sessions in the active state
+        self._changed = threading.Event()
+        self._started = False
+        self.event_count = 0
+
+    def start(self):
+        if not self._started:
+            try:
+                self._source.start(self)
+            except Exception:
+                with self._lock:
+                    self._sessions.clear()
+                    self._active.clear()
+                raise
+            self._started = True
+
+    def stop(self):
+        if self._started:
+            self._started = False
+            self._source.stop()
+        with self._lock:
+            self._sessions.clear()
+            self._active.clear()
+
+    def session_created(self, key, pid, state, meter):
+        with self._lock:
+            self._sessions[key] = (pid, state, meter)
+            self._update_active(key, pid, state, meter)
+        self._notify()
+
+    def state_changed(self, key, state):
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is None:
+                return
+            pid, _, meter = entry
+            self._sessions[key] = (pid, state, meter)
+            self._update_active(key, pid, state, meter)
+        self._notify()
+
+    def volume_changed(self, key):
+        self._notify()
+
+    def session_removed(self, key):
+        with self._lock:
+            self._sessions.pop(key, None)
+            self._active.pop(key, None)
+        self._notify()
+
+    def _update_active(self, key, pid, state, meter):
+        if state == AUDCLNT_SESSIONSTATE_ACTIVE:
+            self._active[key] = (pid, meter)
+        else:
+            self._active.pop(key, None)
+
+    def _notify(self):
+        with self._lock:
+            self.event_count += 1
+            self._changed.set()
+
+    def active_sessions(self):
+        with self._lock:
+            return list(self._active.values())
+
+    def has_active(self):
+        return bool(self._active)
+
+    def session_count(self):
+        return len(self._sessions)
+
+    def wait(self, timeout):
+        """Block until a notification arrives or the timeout passes; True if woken by an event."""
+        changed = self._changed.wait(timeout)
+        # Set and cleared under the lock, so a notification either lands
+        # before the clear, in the table the caller reads next, or after it
+        with self._lock:
+            self._changed.clear()
+        return changed
+
+    def wake(self):
+        with self._lock:
+            self._changed.set()
+
+class ComSessionEventSource(SessionEventSource):
+    """Session notifications from IAudioSessionManager2 and IAudioSessionEvents.
+
+    Callbacks arrive on COM worker threads, so the owning thread should be
+    initialized as a multithreaded apartment.
+    """
+    def __init__(self):
+        self._session_manager = None
+        self._notification = None
+        self._lock = threading.Lock()  # Guards _registrations against the COM callback threads
+        self._registrations = {}  # key -> (control, events, meter) kept alive until stop()
+
+    def start(self, tracker):
+        """Subscribe to the session notifications; on failure nothing stays registered."""
+        try:
+            self._start(tracker)
+        except Exception:
+            self.stop()
+            raise
+
+    def _start(self, tracker):
+        from comtypes import COMObject
+        _load_com()
+
+        source = self
+
+        class _SessionNotification(COMObject):
+            _com_interfaces_ = [pycaw.IAudioSessionNotification]
+
+            def OnSessionCreated(self, new_session):
+                try:
+                    source._add_session(tracker, new_session, _SessionEvents)
+                except Exception:
+                    pass  # Never raise back into the audio service
+
+        class _SessionEvents(COMObject):
+            _com_interfaces_ = [pycaw.IAudioSessionEvents]
+
+            def __init__(self, key):
+                super().__init__()
+                self._key = key
+
+            def OnStateChanged(self, new_state):
+                if new_state == AUDCLNT_SESSIONSTATE_EXPIRED:
+                    tracker.session_removed(self._key)
+                else:
+                    tracker.state_changed(self._key, new_state)
+
+            def OnSimpleVolumeChanged(self, new_volume, new_mute, event_context):
+                tracker.volume_changed(self._key)
+
+            def OnSessionDisconnected(self, disconnect_reason):
+                tracker.session_removed(self._key)
+
+        with ComScope() as scope:
+            devices = scope.track(pycaw.AudioUtilities.GetSpeakers())
+            interface = scope.track(devices.Activate(pycaw.IAudioSessionManager2._iid_, CLSCTX_ALL, None))
+            self._session_manager = interface.QueryInterface(pycaw.IAudioSessionManager2)
+
+            # Sessions created before we subscribed; enumerating first is also
+            # what makes the manager deliver OnSessionCreated at all
+            sessions = scope.track(self._session_manager.GetSessionEnumerator())
+            for i in range(sessions.GetCount()):
+                try:
+                    with ComScope() as session_scope:
+                        self._add_session(tracker, session_scope.track(sessions.GetSession(i)), _SessionEvents)
+                except Exception:
+                    continue
+
+        self._notification = _SessionNotification()
+        self._session_manager.RegisterSessionNotification(self._notification)
+
+    def _add_session(self, tracker, session, events_class):
+        """Subscribe to one session; its control and meter are owned by the source until stop()."""
+        with ComScope() as scope:
+            control = scope.track(session.QueryInterface(pycaw.IAudioSessionControl2))
+            meter = scope.track(session.QueryInterface(pycaw.IAudioMeterInformation))
+            key = control.GetSessionInstanceIdentifier()
+            events = events_class(key)
+            control.RegisterAudioSessionNotification(events)
+            scope.keep(control)
+            scope.keep(meter)
+        with self._lock:
+            previous = self._registrations.get(key)
+            self._registrations[key] = (control, events, meter)
+        if previous is not None:
+            self._release_registration(*previous)
+        tracker.session_created(key, control.GetProcessId(), control.GetState(), meter)
+
+    @staticmethod
+    def _release_registration(control, events, meter):
+        try:
+            control.UnregisterAudioSessionNotification(events)
+        except Exception:
+            pass
+        release_com(meter)
+        release_com(control)
+
+    def stop(self):
+        with self._lock:
+            registrations, self._registrations = self._registrations, {}
+        for registration in registrations.values():
+            self._release_registration(*registration)
+        if self._session_manager and self._notification:
+            try:
+                self._session_manager.UnregisterSessionNotification(self._notification)
+            except Exception:
+                pass
+        self._notification = None
+        release_com(self._session_manager)
+        self._session_manager = None
+
+class ScriptedEventSource(SessionEventSource):
+    """Replays a scripted list of tracker calls, e.g. to drive event mode off Windows.
+
+    Each script step is (method_name, args), for example
+    ('session_created', ('chrome', 1234, AUDCLNT_SESSIONSTATE_ACTIVE, meter)).
+    """
+    def __init__(self, script=()):
+        self._script = list(script)
+        self._position = 0
+        self._tracker = None
+
+    def start(self, tracker):
+        self._tracker = tracker
+
+    def stop(self):
+        self._tracker = None
+
+    def emit(self, method_name, *args):
+        getattr(self._tracker, method_name)(*args)
+
+    def step(self, count=1):
+        """Deliver the next count scripted events; returns False once the script is exhausted."""
+        for _ in range(count):
+            if self._position >= len(self._script):
+                return False
+            method_name, args = self._script[self._position]
+            self._position += 1
+            self.emit(method_name, *args)
+        return self._position < len(self._script)
+
+# Modify to store all Spotify PIDs at the start
+def get_spotify_processes():
+    # Define identifiers for Spotify and Spotify Premium
+    SPOTIFY_IDENTIFIERS = ['spotify', 'spotify premium', 'spotify.exe', 'Spotify.exe', 'Spotify Premium']
+    
+    spotify_processes = []
+    for proc in psutil.process_iter(['pid', 'name']):
+        if proc.info['name']:
+            proc_name_lower = proc.info['name'].lower()
+            if any(identifier in proc_name_lower for identifier in SPOTIFY_IDENTIFIERS):
+                spotify_processes.append(proc)
+    return spotify_processes
+
+# Filled by spotify_tracker on first use rather than at import
+SPOTIFY_PIDS = []
+
+class SpotifyProcessTracker:
+    """Keeps SPOTIFY_PIDS current without scanning the process table every tick.
+
+    The fast path only checks that the known Spotify PIDs are still alive.
+    The full process table is rescanned every rescan_interval seconds, or
+    at once when every known Spotify process has exited.
+    """
+    def __init__(self, rescan_interval=5.0):
+        self._lock = RLock()
+        self._known = {}  # pid -> create_time
+        self._next_rescan = 0.0
+        self.rescan_interval = rescan_interval
+        self.full_scans = 0
+        self.liveness_checks = 0
+
+    def refresh(self, force=False):
+        """Update the known PIDs; returns True while Spotify is running."""
+        with self._lock:
+            now = time.monotonic()
+            if not force and now < self._next_rescan:
+                if not self._known:
+                    return False
+                if self._check_alive():
+                    return True
+                # The whole known set died (e.g. Spotify restarted), look again now
+            self._rescan(now)
+            return bool(self._known)
+
+    def _check_alive(self):
+        for pid, create_time in list(self._known.items()):
+            self.liveness_checks += 1
+            try:
+                if psutil.Process(pid).create_time() == create_time:
+                    continue
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                pass
+            del self._known[pid]
+        if len(self._known) != len(SPOTIFY_PIDS):
+            SPOTIFY_PIDS[:] = self._known
+        return bool(self._known)
+
+    def _rescan(self, now):
+        self.full_scans += 1
+        known = {}
+        for proc in psutil.process_iter(['pid', 'name', 'create_time']):
+            name = proc.info['name']
+            if name and is_spotify_name(name.lower()):
+                known[proc.info['pid']] = proc.info['create_time']
+        self._known = known
+        # Update in place so every reader of SPOTIFY_PIDS sees the new set
+        SPOTIFY_PIDS[:] = known
+        self._next_rescan = now + self.rescan_interval
+
+    def pids(self):
+        with self._lock:
+            return list(self._known)
+
+# Shared by the monitor loop and the window helpers below
+spotify_tracker = SpotifyProcessTracker()
+
+def get_spotify_process():
+    # Define identifiers for Spotify and Spotify Premium
+    SPOTIFY_IDENTIFIERS = ['spotify', 'spotify premium','spotify.exe','Spotify.exe','Spotify Premium']
+    
+    for proc in psutil.process_iter(['name']):
+        if proc.info['name']:
+            proc_name_lower = proc.info['name'].lower()
+            if any(identifier in proc_name_lower for identifier in SPOTIFY_IDENTIFIERS):
+                return proc
+    return None
+
+# Update focus_spotify to use stored PIDs
+def focus_spotify(debug=False):
+    try:
+        import win32gui
+        import win32process
+        import win32con
+        import win32api  # Ensure win32api is imported
+
+        spotify_tracker.refresh()
+        spotify_hwnd = None
+
+        def callback(hwnd, pid):
+            nonlocal spotify_hwnd
+            if not win32gui.IsWindowVisible(hwnd):
+                return True
+            _, window_pid = win32process.GetWindowThreadProcessId(hwnd)
+            if window_pid in SPOTIFY_PIDS:
+                spotify_hwnd = hwnd
+                return False
+            return True
+
+        for pid in SPOTIFY_PIDS:
+            try:
+                win32gui.EnumWindows(callback, pid)
+                if spotify_hwnd:
+                    fg_window = win32gui.GetForegroundWindow()
+                    current_thread_id = win32api.GetCurrentThreadId()
+                    fg_thread_id, _ = win32process.GetWindowThreadProcessId(fg_window)
+                    target_thread_id = win32process.GetWindowThreadProcessId(spotify_hwnd)[0]
+
+                    win32process.AttachThreadInput(current_thread_id, fg_thread_id, True)
+                    win32process.AttachThreadInput(current_thread_id, target_thread_id, True)
+
+                    win32gui.ShowWindow(spotify_hwnd, win32con.SW_RESTORE)
+                    win32gui.SetForegroundWindow(spotify_hwnd)
+
+                    win32process.AttachThreadInput(current_thread_id, fg_thread_id, False)
+                    win32process.AttachThreadInput(current_thread_id, target_thread_id, False)
+
+                    if debug:
+                        logger.debug("Spotify window focused for PID %s.", pid)
+                    return True
+            except Exception as e:
+                if debug:
+                    logger.debug("EnumWindows failed for PID %s: %s", pid, e)
+        if debug:
+            logger.debug("Spotify windows not found for any stored PIDs.")
+        return False
+
+    except ImportError as e:
+        if debug:
+            logger.debug("Error importing win32 modules: %s. Please install pywin32 and ensure it is correctly configured.", e)
+        return False
+    except Exception as e:
+        if debug:
+            logger.debug("Error focusing Spotify: %s", e)
+        return False
+
+# Longest wait between ticks in event mode while no session is active
+EVENT_IDLE_TIMEOUT = 5.0
+
+# Windows AppCommand constants for media control
+APPCOMMAND_MEDIA_PLAY_PAUSE = 14
+APPCOMMAND_MEDIA_PLAY = 46
+APPCOMMAND_MEDIA_PAUSE = 47
+WM_APPCOMMAND = 0x0319
+
+_debug_mode = False  # Global debug flag for standalone functions
+
+def set_debug_mode(enabled):
+    """Set _debug_mode and let debug records through to the console and GUI log handlers."""
+    global _debug_mode
+    _debug_mode = enabled
+    for handler in logger.handlers:
+        quiet_level = getattr(handler, 'quiet_level', None)
+        if quiet_level is not None:
+            handler.setLevel(logging.DEBUG if enabled else quiet_level)
+
+class WindowBackend:
+    """Window operations needed to find Spotify's window and send it commands."""
+    def find_window(self, pids):
+        """Return the main window owned by one of pids, or None."""
+        raise NotImplementedError
+
+    def is_window(self, hwnd):
+        raise NotImplementedError
+
+    def window_pid(self, hwnd):
+        raise NotImplementedError
+
+    def post_message(self, hwnd, message, wparam, lparam):
+        """Queue a message to the window's thread without waiting for it to be handled."""
+        raise NotImplementedError
+
+class Win32WindowBackend(WindowBackend):
+    def find_window(self, pids):
+        import win32gui
+        import win32process
+        
+        spotify_hwnd = None
+        
+        def callback(hwnd, _):
+            nonlocal spotify_hwnd
+            if not win32gui.IsWindowVisible(hwnd):
+                return True
+            try:
+                _, window_pid = win32process.GetWindowThreadProcessId(hwnd)
+                if window_pid in pids:
+                    # Check if it's the main Spotify window (has a title)
+                    title = win32gui.GetWindowText(hwnd)
+                    if title and 'GDI+' not in title:  # Filter out helper windows
+                        spotify_hwnd = hwnd
+                        return False
+            except:
+                pass
+            return True
+        
+        try:
+            win32gui.EnumWindows(callback, None)
+        except Exception:
+            # EnumWindows reports an error when the callback stops the enumeration early
+            if spotify_hwnd is None:
+                raise
+        return spotify_hwnd
+
+    def is_window(self, hwnd):
+        import win32gui
+        return bool(win32gui.IsWindow(hwnd))
+
+    def window_pid(self, hwnd):
+        import win32process
+        return win32process.GetWindowThreadProcessId(hwnd)[1]
+
+    def post_message(self, hwnd, message, wparam, lparam):
+        import win32api
+        win32api.PostMessage(hwnd, message, wparam, lparam)
+
+class SpotifyWindowCache:
+    """Remembers Spotify's main window and only enumerates windows when it goes stale."""
+    def __init__(self, backend=None):
+        self.backend = backend or Win32WindowBackend()
+        self._hwnd = None
+        self.hits = 0
+        self.enumerations = 0
+        self.invalidations = 0
+
+    def get(self):
+        hwnd = self._hwnd
+        if hwnd is not None:
+            try:
+                # Still a window and still owned by a running Spotify process
+                if self.backend.is_window(hwnd) and self.backend.window_pid(hwnd) in SPOTIFY_PIDS:
+                    self.hits += 1
+                    return hwnd
+            except Exception:
+                pass
+            self.invalidate()
+        self.enumerations += 1
+        self._hwnd = self.backend.find_window(SPOTIFY_PIDS)
+        return self._hwnd
+
+    def invalidate(self):
+        if self._hwnd is not None:
+            self.invalidations += 1
+        self._hwnd = None
+
+    def stats(self):
+        return {'hits': self.hits, 'enumerations': self.enumerations, 'invalidations': self.invalidations}
+
+spotify_window = SpotifyWindowCache()
+
+def get_spotify_hwnd():
+    """Get Spotify's main window handle without focusing it"""
+    try:
+        spotify_tracker.refresh()  # Cheap liveness check unless a rescan is due
+        return spotify_window.get()
+    except Exception as e:
+        if _debug_mode:
+            logger.debug("Error getting Spotify hwnd: %s", e)
+        return None
+
+def send_appcommand_to_spotify(command):
+    """Post a media command to Spotify's window without stealing focus.
+
+    The message is queued rather than sent, so a hung Spotify window cannot
+    block the caller; whether Spotify acted on it shows in its audio session.
+    """
+    try:
+        hwnd = get_spotify_hwnd()
+        if hwnd:
+            # WM_APPCOMMAND: wParam = hwnd, lParam = command << 16
+            lparam = command << 16
+            try:
+                spotify_window.backend.post_message(hwnd, WM_APPCOMMAND, hwnd, lparam)
+            except Exception:
+                spotify_window.invalidate()  # Re-find the window on the next command
+                raise
+            return True
+        else:
+            if _debug_mode:
+                logger.debug("Spotify window not found")
+            return False
+    except Exception as e:
+        if _debug_mode:
+            logger.debug("Error sending appcommand: %s", e)
+        return False
+
+def pause_spotify():
+    """Pause Spotify by sending APPCOMMAND directly to its window"""
+    try:
+        if send_appcommand_to_spotify(APPCOMMAND_MEDIA_PAUSE):
+            if _debug_mode:
+                logger.debug("Paused Spotify via AppCommand")
+            return True
+        # Fallback: try play/pause toggle
+        if send_appcommand_to_spotify(APPCOMMAND_MEDIA_PLAY_PAUSE):
+            if _debug_mode:
+                logger.debug("Paused Spotify via Play/Pause toggle")
+            return True
+        return False
+    except Exception as e:
+        if _debug_mode:
+            logger.debug("Error pausing Spotify: %s", e)
+        return False
+
+def play_spotify():
+    """Resume Spotify by sending APPCOMMAND directly to its window"""
+    try:
+        if send_appcommand_to_spotify(APPCOMMAND_MEDIA_PLAY):
+            if _debug_mode:
+                logger.debug("Resumed Spotify via AppCommand")
+            return True
+        # Fallback: try play/pause toggle
+        if send_appcommand_to_spotify(APPCOMMAND_MEDIA_PLAY_PAUSE):
+            if _debug_mode:
+                logger.debug("Resumed Spotify via Play/Pause toggle")
+            return True
+        return False
+    except Exception as e:
+        if _debug_mode:
+            logger.debug("Error resuming Spotify: %s", e)
+        return False
+
+def post_media_command(command):
+    """Post 'pause', 'play' or 'toggle' to Spotify; returns whether the message was queued."""
+    if command == 'pause':
+        return pause_spotify()
+    if command == 'play':
+        return play_spotify()
+    if command == 'toggle':
+        return send_appcommand_to_spotify(APPCOMMAND_MEDIA_PLAY_PAUSE)
+    raise ValueError("Unknown media command: %r" % (command,))
+
+# How often queued GUI log lines are written to the textbox
+LOG_FLUSH_INTERVAL_MS = 250
+# How often control requests are picked up on the Tk thread
+CONTROL_POLL_INTERVAL_MS = 100
+
+class LogBuffer:
+    """Bounded log model shared by the monitor thread and the Tk thread.
+
+    Lines are appended from any thread and drained by the UI in batches;
+    at most max_lines are kept, so a hidden window cannot grow memory.
+    """
+    def __init__(self, max_lines=500):
+        self._lock = threading.Lock()
+        self.max_lines = max_lines
+        self._pending = deque(maxlen=max_lines)  # Not yet written to the UI
+        self.dropped = 0
+
+    def append(self, line):
+        with self._lock:
+            if len(self._pending) == self._pending.maxlen:
+                self.dropped += 1
+            self._pending.append(line)
+
+    def drain(self):
+        with self._lock:
+            lines = list(self._pending)
+            self._pending.clear()
+            return lines
+
+    def set_max_lines(self, max_lines):
+        if max_lines == self.max_lines:
+            return
+        with self._lock:
+            self.max_lines = max_lines
+            self._pending = deque(self._pending, maxlen=max_lines)
+
+class PauseDecider:
+    """Pause/resume state machine of the monitor loop.
+
+    step() takes one tick's observations and returns ACTION_NONE,
+    ACTION_PAUSE or ACTION_RESUME. The caller performs the action and
+    reports through action_result() whether it worked; until then the
+    state is unchanged, so a failed action is retried on a later tick.
+    Nothing is allocated per step.
+    """
+    __slots__ = ('action_cooldown', 'silence_threshold', 'paused_by_us', 'last_action_time',
+                 'silence_start', '_pending', '_pending_time')
+
+    def __init__(self, action_cooldown=2.0, silence_threshold=1.5):
+        self.action_cooldown = action_cooldown
+        self.silence_threshold = silence_threshold  # Seconds of silence before resuming
+        self.reset()
+
+    def reset(self):
+        self.paused_by_us = False  # Tracks if WE paused Spotify
+        self.last_action_time = float('-inf')
+        self.silence_start = None  # When other audio stopped
+        self._pending = ACTION_NONE
+        self._pending_time = 0.0
+
+    @property
+    def silence_pending(self):
+        return self.silence_start is not None
+
+    def step(self, now, spotify_active, other_active):
+        """Decide what to do on a tick where Spotify is running."""
+        # Respect cooldown to prevent rapid switching
+        if now - self.last_action_time < self.action_cooldown:
+            return ACTION_NONE
+        if other_active:
+            # Other audio is playing, so any silence so far is over
+            self.silence_start = None
+            if not self.paused_by_us and spotify_active:
+                self._pending = ACTION_PAUSE
+                self._pending_time = now
+                return ACTION_PAUSE
+            return ACTION_NONE
+        if not self.paused_by_us:
+            return ACTION_NONE
+        # Wait for sustained silence before resuming
+        if self.silence_start is None:
+            self.silence_start = now
+        elif now - self.silence_start >= self.silence_threshold:
+            self._pending = ACTION_RESUME
+            self._pending_time = now
+            return ACTION_RESUME
+        return ACTION_NONE
+
+    def action_result(self, succeeded):
+        """Report whether the action returned by the last step() was carried out."""
+        pending = self._pending
+        self._pending = ACTION_NONE
+        if not succeeded:
+            return
+        if pending == ACTION_PAUSE:
+            self.paused_by_us = True
+            self.last_action_time = self._pending_time
+        elif pending == ACTION_RESUME:
+            self.paused_by_us = False
+            self.last_action_time = self._pending_time
+            self.silence_start = None
+
+    def action_reverted(self, action):
+        """Undo a pause reported as carried out that Spotify never followed, so it is decided again.
+
+        A resume that never took is left alone: retrying it could restart
+        playback the user stopped on purpose.
+        """
+        if action == ACTION_PAUSE and self.paused_by_us:
+            self.paused_by_us = False
+
+    def decide(self, now, snapshot, tick=None):
+        """step() for a snapshot, or None when Spotify is not running, assuming every action succeeds.
+
+        Matches the decide signature of replay_trace().
+        """
+        if snapshot is None:
+            return ACTION_NONE
+        action = self.step(now, snapshot.spotify_active, snapshot.other_active)
+        if action:
+            self.action_result(True)
+        return action
+
+# Per-tick inputs of a parameter sweep. spotify_level is inf while the
+# recording had Spotify paused by us, since it would have been playing.
+SweepTimeline = namedtuple('SweepTimeline', ['t', 'spotify_level', 'other_peak'])
+
+# One entry per parameter combination; latencies are means in seconds, NaN without events
+SweepResult = namedtuple('SweepResult', [
+    'peak_threshold', 'action_cooldown', 'silence_threshold',
+    'pauses', 'resumes', 'toggles', 'false_pauses',
+    'pause_latency', 'resume_latency',
+])
+
+def load_sweep_timeline(path, ignored_processes=None):
+    """Reduce a session trace to the per-tick peaks a sweep needs.
+
+    Ticks on which Spotify was not running are dropped, as the monitor loop
+    makes no decision on them. Sessions the recording never read count as
+    silent, so a trace recorded with a lower peak_threshold sweeps best.
+    """
+    import numpy as np
+
+    ignored = ProcessMatcher(ignored_processes or DEFAULT_IGNORED_PROCESSES)
+    reader = TraceReader(path)
+    classes = {}  # (name, create_time) -> True for Spotify, False for others, None if ignored
+    times = []
+    spotify_levels = []
+    other_peaks = []
+    paused = False
+    for tick in reader:
+        # The action is taken after the tick's observations
+        was_paused = paused
+        if tick.action == ACTION_PAUSE:
+            paused = True
+        elif tick.action == ACTION_RESUME:
+            paused = False
+        if not tick.flags & TRACE_SPOTIFY_RUNNING:
+            continue
+        spotify_level = 0.0
+        other_peak = 0.0
+        for pid, state, peak in tick.entries:
+            # A peak read without the state comes from the device gate's Spotify check
+            if peak != peak or (state != AUDCLNT_SESSIONSTATE_ACTIVE and state != -1):
+                continue
+            identity = reader.names.get(pid)
+            if identity is None:
+                continue
+            kind = classes.get(identity, 0)
+            if kind == 0:
+                name_lower = identity[0].lower()
+                kind = classes[identity] = None if ignored.matches(name_lower) else is_spotify_name(name_lower)
+            if kind is None:
+                continue
+            if kind:
+                spotify_level = max(spotify_level, peak)
+            else:
+                other_peak = max(other_peak, peak)
+        times.append(tick.t)
+        spotify_levels.append(float('inf') if was_paused else spotify_level)
+        other_peaks.append(other_peak)
+    return SweepTimeline(np.array(times), np.array(spotify_levels), np.array(other_peaks))
+
+def _sweep_chunk(timeline, peak_thresholds, action_cooldowns, silence_thresholds, min_event):
+    """Run PauseDecider for every combination at once, one tick at a time, assuming every action succeeds."""
+    import numpy as np
+
+    count = len(peak_thresholds)
+    paused = np.zeros(count, dtype=bool)
+    last_action = np.full(count, -np.inf)
+    silence_start = np.full(count, np.nan)
+    was_other = np.zeros(count, dtype=bool)
+    episode_start = np.zeros(count)  # When the current run of other audio began
+    episode_paused = np.zeros(count, dtype=bool)  # Whether that run caused a pause
+    quiet_since = np.full(count, np.nan)  # When other audio last stopped while paused
+    pauses = np.zeros(count, dtype=np.int64)
+    resumes = np.zeros(count, dtype=np.int64)
+    false_pauses = np.zeros(count, dtype=np.int64)
+    pause_latency = np.zeros(count)
+    resume_latency = np.zeros(count)
+
+    for t, spotify_level, other_peak in zip(timeline.t.tolist(), timeline.spotify_level.tolist(),
+                                            timeline.other_peak.tolist()):
+        other = other_peak > peak_thresholds
+        spotify = ~paused & (spotify_level > peak_thresholds)
+
+        started = other & ~was_other
+        episode_start[started] = t
+        episode_paused[started] = False
+        quiet_since[started] = np.nan
+        stopped = was_other & ~other
+        false_pauses += stopped & episode_paused & (t - episode_start < min_event)
+        quiet_since[stopped & paused] = t
+        was_other = other
+
+        # Same branches as PauseDecider.step()
+        ready = t - last_action >= action_cooldowns
+        silence_start[ready & other] = np.nan
+        pause = ready & other & ~paused & spotify
+        waiting = ready & ~other & paused
+        resume = waiting & (t - silence_start >= silence_thresholds)  # NaN compares False
+        silence_start[waiting & np.isnan(silence_start)] = t
+
+        if pause.any():
+            pauses += pause
+            pause_latency[pause] += t - episode_start[pause]
+            episode_paused |= pause
+            paused |= pause
+            last_action[pause] = t
+        if resume.any():
+            resumes += resume
+            resume_latency[resume] += t - quiet_since[resume]
+            paused &= ~resume
+            last_action[resume] = t
+            silence_start[resume] = np.nan
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (pauses, resumes, false_pauses,
+                np.where(pauses > 0, pause_latency / pauses, np.nan),
+                np.where(resumes > 0, resume_latency / resumes, np.nan))
+
+def sweep_parameters(timeline, peak_thresholds, action_cooldowns, silence_thresholds,
+                     min_event=1.0, workers=None, chunk_size=4096):
+    """Evaluate every combination of the three parameter lists against a timeline.
+
+    A pause counts as false when the other audio that caused it lasted less
+    than min_event seconds. Grids larger than chunk_size are split across a
+    process pool of workers processes (default: one per core); workers=1
+    keeps everything in this process.
+    """
+    import numpy as np
+
+    grid = np.meshgrid(np.asarray(peak_thresholds, dtype=float), np.asarray(action_cooldowns, dtype=float),
+                       np.asarray(silence_thresholds, dtype=float), indexing='ij')
+    thresholds, cooldowns, silences = (axis.ravel() for axis in grid)
+    bounds = [(start, min(start + chunk_size, len(thresholds))) for start in range(0, len(thresholds), chunk_size)]
+
+    if len(bounds) > 1 and workers != 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_sweep_chunk, timeline, thresholds[a:b], cooldowns[a:b], silences[a:b], min_event)
+                       for a, b in bounds]
+            parts = [future.result() for future in futures]
+    else:
+        parts = [_sweep_chunk(timeline, thresholds[a:b], cooldowns[a:b], silences[a:b], min_event) for a, b in bounds]
+
+    pauses, resumes, false_pauses, pause_latency, resume_latency = (
+        np.concatenate([part[i] for part in parts]) for i in range(5))
+    return SweepResult(thresholds, cooldowns, silences, pauses, resumes, pauses + resumes,
+                       false_pauses, pause_latency, resume_latency)
+
+def rank_sweep(result, top=10):
+    """Indices of the best combinations: fewest false pauses, then fastest, then fewest toggles.
+
+    Combinations that never pause rank last among those with as many false pauses.
+    """
+    import numpy as np
+
+    latency = np.nan_to_num(result.pause_latency, nan=np.inf) + np.nan_to_num(result.resume_latency, nan=0.0)
+    order = np.lexsort((result.toggles, latency, result.false_pauses))
+    return order[:top]
+
+class PollScheduler:
+    """Picks the next monitor tick deadline from the current state.
+
+    Polls slowly while nothing or only Spotify is playing and quickly while a
+    pause or resume is pending or silence is being confirmed. Deadlines use
+    the monotonic clock so wall-clock adjustments cannot stretch or skip ticks.
+    """
+    INTERVALS = {
+        'idle': 2.0,    # Spotify is not running
+        'slow': 1.0,    # Nothing, or only Spotify, is playing
+        'normal': 0.5,  # Other audio playing while Spotify is paused by us
+        'fast': 0.1,    # Pause/resume pending or silence being confirmed
+        'error': 2.0,   # Back off after an error in the loop
+    }
+
+    def __init__(self, intervals=None, clock=None):
+        self.intervals = dict(self.INTERVALS)
+        if intervals:
+            self.intervals.update(intervals)
+        self._clock = clock or time.monotonic
+        self.ticks = dict.fromkeys(self.intervals, 0)
+        self.total_interval = 0.0
+        self.last_mode = None
+        self.last_interval = None
+
+    def choose_mode(self, spotify_running, snapshot, paused_by_us, silence_pending):
+        if not spotify_running or snapshot is None:
+            return 'idle'
+        if silence_pending:
+            return 'fast'
+        if snapshot.other_active:
+            if snapshot.spotify_active and not paused_by_us:
+                return 'fast'  # Pause pending, e.g. held back by the cooldown
+            return 'normal'
+        if paused_by_us:
+            return 'fast'  # Other audio stopped, resume pending
+        return 'slow'
+
+    def next_deadline(self, now, mode):
+        interval = self.intervals[mode]
+        self.ticks[mode] += 1
+        self.total_interval += interval
+        self.last_mode = mode
+        self.last_interval = interval
+        return now + interval
+
+    def remaining(self, deadline):
+        return max(0.0, deadline - self._clock())
+
+    def metrics(self):
+        total_ticks = sum(self.ticks.values())
+        return {
+            'ticks': dict(self.ticks),
+            'last_mode': self.last_mode,
+            'last_interval': self.last_interval,
+            'average_interval': self.total_interval / total_ticks if total_ticks else None,
+        }
+
+class Histogram:
+    """Bucketed observations in the Prometheus layout; bounds are upper limits in seconds."""
+    DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.DEFAULT_BUCKETS)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Return [(bound, observations <= bound)], ending with ('+Inf', count)."""
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+# Outcome of a media command once its effect was seen or it was given up on
+CommandOutcome = namedtuple('CommandOutcome', ['command', 'succeeded', 'latency', 'attempts'])
+
+# Seconds from request to Spotify following it
+COMMAND_EFFECT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+class _PendingCommand:
+    __slots__ = ('command', 'requested', 'attempts', 'escalated', 'deadline', 'retry_at')
+
+    def __init__(self, command, requested):
+        self.command = command
+        self.requested = requested
+        self.attempts = 0
+        self.escalated = False
+        self.deadline = requested
+        self.retry_at = requested
+
+class MediaCommandDispatcher:
+    """Sends play/pause to Spotify without waiting on it and checks that Spotify followed.
+
+    request() hands a command to send, which must only post it, unless the
+    same command is still outstanding; a newer opposite command replaces
+    it. observe() is fed every tick: Spotify going quiet confirms a pause,
+    Spotify's session turning active confirms a play, since a playing track
+    can be silent. Without an effect after verify_timeout the command is
+    posted again after an exponential backoff and given up after
+    max_attempts. A pause that went unheeded escalate_after times is sent
+    once as the play/pause toggle; a play never is, as Spotify may already
+    be playing and the toggle would stop it.
+    """
+    def __init__(self, send, verify_timeout=1.0, max_attempts=4, backoff=0.25, escalate_after=2):
+        self._send = send
+        self.verify_timeout = verify_timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.escalate_after = escalate_after
+        self.pending = None
+        self.counts = dict.fromkeys(('requested', 'posted', 'coalesced', 'replaced', 'retried', 'escalated',
+                                     'post_failures', 'confirmed', 'failed', 'cancelled'), 0)
+        self.latencies = {'pause': Histogram(COMMAND_EFFECT_BUCKETS), 'play': Histogram(COMMAND_EFFECT_BUCKETS)}
+
+    def request(self, command, now):
+        """Queue command; returns False only when it could not even be posted."""
+        if command not in self.latencies:
+            raise ValueError("Unknown media command: %r" % (command,))
+        pending = self.pending
+        if pending is not None:
+            if pending.command == command:
+                self.counts['coalesced'] += 1
+                return True
+            self.counts['replaced'] += 1
+        self.counts['requested'] += 1
+        self.pending = _PendingCommand(command, now)
+        return self._post(now)
+
+    def _post(self, now):
+        pending = self.pending
+        pending.attempts += 1
+        command = pending.command
+        if pending.attempts > 1:
+            self.counts['retried'] += 1
+        if command == 'pause' and not pending.escalated and pending.attempts > self.escalate_after:
+            # A second toggle could undo the first once Spotify catches up
+            command = 'toggle'
+            pending.escalated = True
+            self.counts['escalated'] += 1
+        try:
+            posted = self._send(command)
+        except Exception as e:
+            logger.debug("Posting %s failed: %s", command, e)
+            posted = False
+        self.counts['posted' if posted else 'post_failures'] += 1
+        pending.deadline = now + self.verify_timeout
+        pending.retry_at = pending.deadline + self.backoff * (2 ** (pending.attempts - 1) - 1)
+        return posted
+
+    def observe(self, now, spotify_active, spotify_playing=None):
+        """Check the outstanding command against a tick; returns a CommandOutcome once it is settled.
+
+        spotify_playing is whether Spotify's session is active; without it a
+        play is confirmed by spotify_active.
+        """
+        pending = self.pending
+        if pending is None:
+            return None
+        if pending.command == 'play':
+            followed = spotify_active if spotify_playing is None else spotify_playing
+        else:
+            followed = not spotify_active
+        if followed:
+            latency = now - pending.requested
+            self.latencies[pending.command].observe(latency)
+            self.counts['confirmed'] += 1
+            self.pending = None
+            return CommandOutcome(pending.command, True, latency, pending.attempts)
+        if now < pending.retry_at:
+            return None
+        if pending.attempts >= self.max_attempts:
+            self.counts['failed'] += 1
+            self.pending = None
+            return CommandOutcome(pending.command, False, None, pending.attempts)
+        self._post(now)
+        return None
+
+    def cancel(self):
+        """Forget the outstanding command, e.g. because Spotify exited."""
+        if self.pending is not None:
+            self.counts['cancelled'] += 1
+            self.pending = None
+
+class MonitorMetrics:
+    """Tick and phase timings of a HeadlessMonitor, rendered in the Prometheus text format."""
+    PHASES = ('spotify_check', 'snapshot', 'decide', 'command')
+    PREFIX = 'stopspoti_'
+
+    def __init__(self, buckets=None):
+        self._lock = threading.Lock()
+        self.tick = Histogram(buckets)
+        self.phases = {phase: Histogram(buckets) for phase in self.PHASES}
+
+    def observe_tick(self, total, spotify_check, snapshot, decide, command):
+        with self._lock:
+            self.tick.observe(total)
+            phases = self.phases
+            if spotify_check is not None:
+                phases['spotify_check'].observe(spotify_check)
+            if snapshot is not None:
+                phases['snapshot'].observe(snapshot)
+                phases['decide'].observe(decide)
+            if command is not None:
+                phases['command'].observe(command)
+
+    def observe_phase(self, phase, seconds):
+        """Record one phase that ran outside observe_tick, e.g. on its own task."""
+        with self._lock:
+            self.phases[phase].observe(seconds)
+
+    def _histogram_lines(self, lines, name, help_text, histograms):
+        name = self.PREFIX + name
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, histogram in histograms:
+            prefix = labels + ',' if labels else ''
+            for bound, total in histogram.cumulative():
+                lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {total}')
+            label_set = '{' + labels + '}' if labels else ''
+            lines.append(f"{name}_sum{label_set} {histogram.sum!r}")
+            lines.append(f"{name}_count{label_set} {histogram.count}")
+
+    def _sample_lines(self, lines, name, kind, help_text, samples):
+        name = self.PREFIX + name
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_set = '{' + labels + '}' if labels else ''
+            lines.append(f"{name}{label_set} {value}")
+
+    def render(self, monitor=None):
+        lines = []
+        with self._lock:
+            self._histogram_lines(lines, 'tick_duration_seconds', 'Duration of one monitor tick.',
+                                  [('', self.tick)])
+            self._histogram_lines(lines, 'phase_duration_seconds', 'Duration of each phase of a monitor tick.',
+                                  [(f'phase="{phase}"', histogram) for phase, histogram in self.phases.items()])
+        if monitor is not None:
+            self._monitor_lines(lines, monitor)
+        return '\n'.join(lines) + '\n'
+
+    def _monitor_lines(self, lines, monitor):
+        counter = lambda name, help_text, value: self._sample_lines(lines, name, 'counter', help_text, [('', value)])
+        gauge = lambda name, help_text, value: self._sample_lines(lines, name, 'gauge', help_text, [('', value)])
+        manager = monitor.manager
+        decider = monitor.decider
+        snapshot = monitor.last_snapshot
+
+        counter('ticks_total', 'Monitor ticks run.', monitor.ticks)
+        counter('loop_errors_total', 'Monitor ticks that raised.', monitor.errors)
+        counter('pauses_total', 'Times Spotify was paused.', monitor.pauses)
+        counter('resumes_total', 'Times Spotify was resumed.', monitor.resumes)
+        counter('pause_failures_total', 'Pause commands that did not reach Spotify.', monitor.pause_failures)
+        counter('resume_failures_total', 'Resume commands that did not reach Spotify.', monitor.resume_failures)
+        gauge('paused_by_us', 'Whether Spotify is currently paused by the monitor.', int(decider.paused_by_us))
+        gauge('silence_pending', 'Whether the monitor is waiting out the silence window.', int(decider.silence_pending))
+        gauge('spotify_running', 'Whether Spotify was running on the last tick.', int(snapshot is not None))
+        gauge('spotify_active', 'Whether Spotify was playing on the last tick.', int(bool(snapshot and snapshot.spotify_active)))
+        gauge('other_active', 'Whether another app was playing on the last tick.', int(bool(snapshot and snapshot.other_active)))
+        gauge('sessions', 'Audio sessions seen on the last walk.', snapshot.session_count if snapshot else 0)
+
+        cache = manager.cache_stats()
+        if cache:
+            counter('session_cache_hits_total', 'Ticks that reused the cached audio session manager.', cache['hits'])
+            self._sample_lines(lines, 'com_rebuilds_total', 'counter', 'COM graph rebuilds and session count changes by kind.',
+                               [('kind="rebuild"', cache['rebuilds']), ('kind="refresh"', cache['refreshes'])])
+            self._sample_lines(lines, 'com_rebuild_causes_total', 'counter', 'COM graph rebuilds and session count changes by cause.',
+                               [(f'cause="{cause}"', count) for cause, count in sorted(cache['causes'].items())])
+        processes = manager.process_cache_stats()
+        if processes:
+            counter('process_lookups_total', 'Process name lookups that went to psutil.', processes['misses'])
+            counter('process_cache_hits_total', 'Process name lookups answered from the cache.', processes['hits'])
+        gate = manager.gate_stats()
+        if gate:
+            self._sample_lines(lines, 'device_gate_total', 'counter', 'Device peak gate outcomes.',
+                               [(f'outcome="{outcome}"', gate[outcome]) for outcome in ('silent', 'spotify_only', 'full_walks')])
+        watchdog = manager.watchdog_stats()
+        if watchdog:
+            counter('leak_resets_total', 'Audio session resets triggered by memory growth.', watchdog['resets'])
+            gauge('resident_memory_bytes', 'Process RSS at the last watchdog check.', watchdog['rss'])
+            gauge('gc_objects', 'Objects tracked by the garbage collector at the last watchdog check.', watchdog['objects'])
+        dispatcher = getattr(monitor, 'dispatcher', None)
+        if dispatcher is not None:
+            self._sample_lines(lines, 'media_commands_total', 'counter', 'Media command dispatcher events.',
+                               [(f'event="{event}"', count) for event, count in dispatcher.counts.items()])
+            self._histogram_lines(lines, 'command_effect_seconds', 'Seconds from a media command to Spotify following it.',
+                                  [(f'command="{command}"', histogram) for command, histogram in dispatcher.latencies.items()])
+        if isinstance(manager, ProbeSupervisor):
+            probe = manager.probe_stats()
+            self._sample_lines(lines, 'probe_restarts_total', 'counter', 'Audio probe worker restarts by reason.',
+                               [('reason="crash"', probe['crashes']), ('reason="hang"', probe['hangs'])])
+
+def _load_http():
+    """Import http.server, which only MetricsServer needs, and define the request handler on it."""
+    global http, _MetricsHandler
+    if '_MetricsHandler' not in globals():
+        import http.server
+
+        class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                try:
+                    body = self.server.render().encode('utf-8')
+                except Exception as e:
+                    logger.warning("Failed to render metrics: %s", e)
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("Metrics request: " + format, *args)
+
+    return _MetricsHandler
+
+class MetricsServer:
+    """Serves render() at http://127.0.0.1:port/metrics from a background thread.
+
+    Always bound to the loopback interface; port 0 picks a free port.
+    """
+    def __init__(self, render, port):
+        handler = _load_http()
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self._server.daemon_threads = True
+        self._server.render = render
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        if self._thread.is_alive():
+            self._server.shutdown()
+        self._server.server_close()
+
+class HeadlessMonitor:
+    """The monitor loop without a window, for --daemon and other unattended runs.
+
+    spotify_running is called once per tick and returns whether Spotify is
+    up; media commands go through the manager's backend, so the whole loop
+    runs against a SimulatedAudioBackend as well as against COM.
+    """
+    def __init__(self, manager, decider=None, scheduler=None, spotify_running=None, started=None, metrics=None,
+                 dispatcher=None):
+        self.manager = manager
+        self.metrics = metrics  # MonitorMetrics fed with the phase timings of every tick
+        self.dispatcher = dispatcher  # MediaCommandDispatcher confirming commands; None trusts the send
+        self.decider = decider or PauseDecider()
+        self.scheduler = scheduler or PollScheduler()
+        self._spotify_running = spotify_running or spotify_tracker.refresh
+        self._stop = threading.Event()
+        self.enabled = True  # Cleared by the control channel's stop command
+        self.started = time.perf_counter() if started is None else started
+        self.first_tick_seconds = None
+        self.last_snapshot = None
+        self.ticks = 0
+        self.pauses = 0
+        self.resumes = 0
+        self.pause_failures = 0
+        self.resume_failures = 0
+        self.errors = 0
+
+    def tick(self, now=None):
+        """Observe once and act on the decision; returns the action taken."""
+        if now is None:
+            now = time.monotonic()
+        clock = time.perf_counter
+        decider = self.decider
+        started = clock()
+        if not self.enabled:
+            self.last_snapshot = None
+            return ACTION_NONE
+        spotify_running = self._spotify_running()
+        checked = clock()
+        snapshot = self.manager.snapshot() if spotify_running else None
+        observed = clock()
+        self.last_snapshot = snapshot
+        self.ticks += 1
+        action = ACTION_NONE
+        dispatcher = self.dispatcher
+        if snapshot is not None:
+            if dispatcher is not None:
+                self._settle(dispatcher.observe(now, snapshot.spotify_active, snapshot.spotify_playing))
+            action = decider.step(now, snapshot.spotify_active, snapshot.other_active)
+        elif dispatcher is not None and not spotify_running:
+            dispatcher.cancel()  # No snapshot while Spotify runs is a stale probe; wait for the next one
+        decided = clock()
+        commanded = action != ACTION_NONE
+        if action == ACTION_PAUSE:
+            succeeded = self._send('pause', now)
+            decider.action_result(succeeded)
+            if succeeded:
+                self.pauses += 1
+                logger.info("Paused Spotify (other audio detected: %s)", snapshot.other_process)
+            else:
+                self.pause_failures += 1
+                action = ACTION_NONE
+        elif action == ACTION_RESUME:
+            succeeded = self._send('play', now)
+            decider.action_result(succeeded)
+            if succeeded:
+                self.resumes += 1
+                logger.info("Resumed Spotify (other audio stopped)")
+            else:
+                self.resume_failures += 1
+                action = ACTION_NONE
+        finished = clock()
+        if self.metrics is not None:
+            self.metrics.observe_tick(
+                finished - started, checked - started,
+                observed - checked if snapshot is not None else None, decided - observed,
+                finished - decided if commanded else None)
+        if self.first_tick_seconds is None:
+            self.first_tick_seconds = clock() - self.started
+            logger.info("First tick after %.1f ms", self.first_tick_seconds * 1000)
+        return action
+
+    def _send(self, command, now):
+        if self.dispatcher is not None:
+            return self.dispatcher.request(command, now)
+        return self.manager.send_media_command(command)
+
+    def _settle(self, outcome):
+        if outcome is None:
+            return
+        if outcome.succeeded:
+            logger.debug("Spotify followed %s after %.0f ms (%s attempts)",
+                         outcome.command, outcome.latency * 1000, outcome.attempts)
+            return
+        logger.warning("Spotify did not %s after %s attempts", outcome.command, outcome.attempts)
+        if outcome.command == 'pause':
+            self.decider.action_reverted(ACTION_PAUSE)
+
+    def run(self, max_ticks=None):
+        """Tick until stop() is called or max_ticks ticks have run."""
+        scheduler = self.scheduler
+        manager = self.manager
+        while not self._stop.is_set():
+            now = time.monotonic()
+            try:
+                self.tick(now)
+                mode = scheduler.choose_mode(self.last_snapshot is not None, self.last_snapshot,
+                                             self.decider.paused_by_us, self.decider.silence_pending)
+            except Exception as e:
+                self.errors += 1
+                logger.warning("Error in monitoring loop: %s", e)
+                mode = 'error'
+            if max_ticks is not None and self.ticks >= max_ticks:
+                break
+            remaining = scheduler.remaining(scheduler.next_deadline(now, mode))
+            if manager.event_driven and mode != 'error':
+                manager.wait_for_change(remaining,
+                                        idle_timeout=None if self.decider.paused_by_us else EVENT_IDLE_TIMEOUT)
+            else:
+                self._stop.wait(remaining)
+
+    def stop(self):
+        self._stop.set()
+        self.manager.wake()
+
+    def configure(self, **settings):
+        """Apply CONTROL_SETTINGS to the running loop."""
+        settings = control_settings(settings)
+        for name in ('action_cooldown', 'silence_threshold'):
+            if name in settings:
+                setattr(self.decider, name, settings.pop(name))
+        if 'debug' in settings:
+            set_debug_mode(settings['debug'])
+        self.manager.configure(**settings)
+        self.manager.wake()
+
+    def status(self):
+        snapshot = self.last_snapshot
+        return {
+            'pid': os.getpid(), 'mode': 'daemon', 'monitoring': self.enabled, 'ticks': self.ticks,
+            'pauses': self.pauses, 'resumes': self.resumes, 'paused_by_us': self.decider.paused_by_us,
+            'spotify_active': bool(snapshot and snapshot.spotify_active),
+            'other_active': bool(snapshot and snapshot.other_active),
+            'action_cooldown': self.decider.action_cooldown, 'silence_threshold': self.decider.silence_threshold,
+        }
+
+    def control_commands(self):
+        """The commands this monitor answers on the control channel."""
+        def set_enabled(enabled):
+            self.enabled = enabled
+            self.manager.wake()
+            return enabled
+        return {
+            'status': self.status,
+            'snapshot': lambda: self.last_snapshot._asdict() if self.last_snapshot is not None else None,
+            'start': lambda: set_enabled(True),
+            'stop': lambda: set_enabled(False),
+            'set': lambda **settings: self.configure(**settings) or self.status(),
+            'quit': lambda: self.stop(),
+        }
+
+class AsyncMonitor(HeadlessMonitor):
+    """The monitor loop as asyncio tasks: Spotify tracking, session probing, commands and metrics.
+
+    Each kind of blocking call runs on its own daemon worker thread (with
+    COM initialised when com_init is set) under a timeout, so a slow
+    process scan or a hung Spotify window delays only its own task. A call
+    is not queued behind one that is still stuck, and a call that never
+    returns cannot keep the process from exiting. A pause or
+    resume is queued to the command task while probing carries on, and
+    stop() cancels every task at once instead of waiting for a tick to end.
+    A dispatcher is only touched from the command thread: the probe task
+    queues the latest observation for it while a command is outstanding.
+    before_snapshot, if set, runs on the probe thread ahead of each snapshot.
+    on_action(action, succeeded, snapshot) is called after each command.
+    """
+    def __init__(self, manager, decider=None, scheduler=None, spotify_running=None, started=None, metrics=None,
+                 metrics_port=None, com_init=False, probe_timeout=5.0, command_timeout=2.0, tracker_interval=0.5,
+                 before_snapshot=None, on_action=None, dispatcher=None):
+        _load_async()
+        super().__init__(manager, decider, scheduler, spotify_running, started, metrics, dispatcher)
+        self.metrics_port = metrics_port
+        self.com_init = com_init
+        self.probe_timeout = probe_timeout
+        self.command_timeout = command_timeout
+        self.tracker_interval = tracker_interval
+        self.before_snapshot = before_snapshot
+        self.on_action = on_action
+        self.timeouts = {'spotify_check': 0, 'snapshot': 0, 'command': 0}
+        self.spotify_running = False
+        self.metrics_server = None
+        self._loop = None
+        self._stopping = None
+        self._command_in_flight = False
+        self._observation_queued = False  # At most one dispatcher observation waits in the queue
+
+    def _executor(self, name):
+        return _DaemonWorker(name, initializer=_com_thread_init if self.com_init else None)
+
+    async def _blocking(self, executor, operation, timeout, *args):
+        """Run a blocking call on executor; raises TimeoutError (and leaves it running) after timeout.
+
+        While the previous call on executor is still running, this waits up
+        to timeout for it to return first, so a hang never builds a backlog.
+        """
+        name = getattr(operation, '__name__', operation)
+        previous = executor.last
+        if previous is not None and not previous.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(previous)), timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"{name} skipped, the previous call is still running") from None
+            except Exception:
+                pass  # Its caller has already given up on it
+        future = asyncio.wrap_future(executor.submit(operation, *args))
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"{name} took over {timeout}s") from None
+
+    async def _track(self, executor, tracked):
+        while True:
+            started = time.perf_counter()
+            try:
+                self.spotify_running = bool(await self._blocking(executor, self._spotify_running, self.probe_timeout))
+                if self.metrics is not None:
+                    self.metrics.observe_phase('spotify_check', time.perf_counter() - started)
+            except TimeoutError as e:
+                self.timeouts['spotify_check'] += 1
+                logger.warning("Spotify process check timed out: %s", e)
+            tracked.set()
+            await asyncio.sleep(self.tracker_interval)
+
+    def _take_snapshot(self):
+        if self.before_snapshot is not None:
+            self.before_snapshot()
+        return self.manager.snapshot()
+
+    async def _probe(self, executor, commands, tracked, max_ticks):
+        await tracked.wait()
+        scheduler = self.scheduler
+        decider = self.decider
+        while True:
+            now = time.monotonic()
+            if not self.enabled:
+                self.last_snapshot = None
+                await asyncio.sleep(scheduler.remaining(scheduler.next_deadline(now, 'idle')))
+                continue
+            started = time.perf_counter()
+            mode = None
+            snapshot = None
+            spotify_running = self.spotify_running
+            if spotify_running:
+                try:
+                    snapshot = await self._blocking(executor, self._take_snapshot, self.probe_timeout)
+                except TimeoutError as e:
+                    self.timeouts['snapshot'] += 1
+                    logger.warning("Audio session probe timed out: %s", e)
+                    mode = 'error'
+                except Exception as e:
+                    self.errors += 1
+                    logger.warning("Error in monitoring loop: %s", e)
+                    mode = 'error'
+            observed = time.perf_counter()
+            self.last_snapshot = snapshot
+            self.ticks += 1
+            dispatcher = self.dispatcher
+            # A stale probe (no snapshot while Spotify runs) leaves the pending command alone
+            if dispatcher is not None and dispatcher.pending is not None and not self._observation_queued \
+                    and mode is None and (snapshot is not None or not spotify_running):
+                self._observation_queued = True
+                if snapshot is None:
+                    commands.put_nowait(('observe', now, None, None))
+                else:
+                    commands.put_nowait(('observe', now, snapshot.spotify_active, snapshot.spotify_playing))
+            # While a command is in flight its action_result is still due, so the decider waits
+            if snapshot is not None and not self._command_in_flight:
+                action = decider.step(now, snapshot.spotify_active, snapshot.other_active)
+                if action != ACTION_NONE:
+                    self._command_in_flight = True
+                    commands.put_nowait(('request', now, action, snapshot))
+            decided = time.perf_counter()
+            if self.metrics is not None and mode is None:
+                self.metrics.observe_tick(decided - started, None, observed - started if snapshot is not None else None,
+                                          decided - observed, None)
+            if self.first_tick_seconds is None:
+                self.first_tick_seconds = time.perf_counter() - self.started
+                logger.info("First tick after %.1f ms", self.first_tick_seconds * 1000)
+            if max_ticks is not None and self.ticks >= max_ticks:
+                self._stopping.set()
+                return
+            if mode is None:
+                mode = scheduler.choose_mode(snapshot is not None, snapshot, decider.paused_by_us, decider.silence_pending)
+            remaining = scheduler.remaining(scheduler.next_deadline(now, mode))
+            if self.manager.event_driven and mode != 'error':
+                idle_timeout = None if decider.paused_by_us else EVENT_IDLE_TIMEOUT
+                try:
+                    await self._blocking(executor, self.manager.wait_for_change,
+                                         max(remaining, idle_timeout or 0) + self.probe_timeout, remaining, idle_timeout)
+                except TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(remaining)
+
+    def _observe_command(self, now, spotify_active, spotify_playing):
+        """Feed the dispatcher one tick on the command thread; spotify_active None means Spotify is not running."""
+        if spotify_active is None:
+            self.dispatcher.cancel()
+            return None
+        return self.dispatcher.observe(now, spotify_active, spotify_playing)
+
+    async def _dispatch(self, executor, commands):
+        decider = self.decider
+        while True:
+            kind, now, *item = await commands.get()
+            if kind == 'observe':
+                self._observation_queued = False
+                try:
+                    self._settle(await self._blocking(executor, self._observe_command, self.command_timeout, now, *item))
+                except TimeoutError as e:
+                    self.timeouts['command'] += 1
+                    logger.warning("Media command check timed out: %s", e)
+                continue
+            action, snapshot = item
+            command = 'pause' if action == ACTION_PAUSE else 'play'
+            started = time.perf_counter()
+            try:
+                succeeded = bool(await self._blocking(executor, self._send, self.command_timeout, command, now))
+            except TimeoutError as e:
+                self.timeouts['command'] += 1
+                logger.warning("Media command timed out: %s", e)
+                succeeded = False
+            if self.metrics is not None:
+                self.metrics.observe_phase('command', time.perf_counter() - started)
+            decider.action_result(succeeded)
+            self._command_in_flight = False
+            if action == ACTION_PAUSE:
+                if succeeded:
+                    self.pauses += 1
+                    logger.info("Paused Spotify (other audio detected: %s)", snapshot.other_process)
+                else:
+                    self.pause_failures += 1
+            elif succeeded:
+                self.resumes += 1
+                logger.info("Resumed Spotify (other audio stopped)")
+            else:
+                self.resume_failures += 1
+            if self.on_action is not None:
+                self.on_action(action, succeeded, snapshot)
+
+    async def _serve_metrics(self):
+        self.metrics_server = MetricsServer(lambda: self.metrics.render(self), self.metrics_port).start()
+        logger.info("Serving metrics at http://127.0.0.1:%s/metrics", self.metrics_server.port)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            self.metrics_server.close()
+
+    async def run_async(self, max_ticks=None):
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        if self._stop.is_set():
+            self.manager.close()
+            return
+        executors = {name: self._executor(name) for name in ('spotify-check', 'audio-probe', 'media-command')}
+        tracked = asyncio.Event()
+        commands = asyncio.Queue()
+        tasks = [
+            asyncio.create_task(self._track(executors['spotify-check'], tracked), name='tracker'),
+            asyncio.create_task(self._probe(executors['audio-probe'], commands, tracked, max_ticks), name='probe'),
+            asyncio.create_task(self._dispatch(executors['media-command'], commands), name='commands'),
+        ]
+        if self.metrics is not None and self.metrics_port is not None:
+            tasks.append(asyncio.create_task(self._serve_metrics(), name='metrics'))
+        try:
+            stopping = asyncio.create_task(self._stopping.wait())
+            done, _ = await asyncio.wait(tasks + [stopping], return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is not stopping and not task.cancelled() and task.exception() is not None:
+                    logger.error("Monitor task %s failed: %s", task.get_name(), task.exception())
+            tasks.append(stopping)
+        finally:
+            pending = tasks
+            while pending:
+                # wait_for can swallow a cancellation that races its result, so cancel until done
+                for task in pending:
+                    task.cancel()
+                _, pending = await asyncio.wait(pending, timeout=0.1)
+            # The manager belongs to the probe thread; it is closed there once any stuck call returns
+            executors['audio-probe'].submit(self.manager.close)
+            for executor in executors.values():
+                if self.com_init:
+                    executor.submit(_com_thread_exit)
+                executor.shutdown()
+            self._loop = None
+
+    def run(self, max_ticks=None):
+        """Run the tasks until stop() is called or max_ticks probe ticks have run."""
+        asyncio.run(self.run_async(max_ticks))
+
+    def stop(self):
+        """Cancel the tasks from any thread; returns at once."""
+        self._stop.set()
+        self.manager.wake()
+        loop = self._loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._stopping.set)
+            except RuntimeError:
+                pass  # The loop already closed
+
+class _DaemonWorker:
+    """Runs submitted calls in order on one daemon thread.
+
+    ThreadPoolExecutor joins its workers at interpreter exit, so a COM call
+    that never returns would hold the process open; this thread is not
+    joined. last is the future of the most recent call.
+    """
+    def __init__(self, name, initializer=None):
+        self._calls = queue.SimpleQueue()
+        self._initializer = initializer
+        self.last = None
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, function, *args):
+        future = self.last = Future()
+        self._calls.put((future, function, args))
+        return future
+
+    def shutdown(self):
+        """Let the thread exit once the calls already submitted have run."""
+        self._calls.put(None)
+
+    def _run(self):
+        if self._initializer is not None:
+            self._initializer()
+        while True:
+            call = self._calls.get()
+            if call is None:
+                return
+            future, function, args = call
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+def _com_thread_init():
+    _load_com()
+    try:
+        pythoncom.CoInitialize()
+    except Exception:
+        pass
 
-# Initialize SPOTIFY_PIDS
-SPOTIFY_PIDS = [proc.pid for proc in get_spotify_processes()]
+def _com_thread_exit():
+    try:
+        pythoncom.CoUninitialize()
+    except Exception:
+        pass
 
-def get_spotify_process():
-    # Define identifiers for Spotify and Spotify Premium
-    SPOTIFY_IDENTIFIERS = ['spotify', 'spotify premium','spotify.exe','Spotify.exe','Spotify Premium']
-    
-    for proc in psutil.process_iter(['name']):
-        if proc.info['name']:
-            proc_name_lower = proc.info['name'].lower()
-            if any(identifier in proc_name_lower for identifier in SPOTIFY_IDENTIFIERS):
-                return proc
-    return None
+# Probe block layout, little endian: an 8-byte sequence number, odd while the
+# worker is writing, then the worker's monotonic time, spotify active and
+# peak, other active and peak, other pid (-1 for none), session count, and the
+# other process name as a length byte and up to 63 bytes of UTF-8
+_PROBE_SEQ = struct.Struct('<Q')
+_PROBE_PAYLOAD = struct.Struct('<dBBfBfiIB63s')
+PROBE_BLOCK_SIZE = _PROBE_SEQ.size + _PROBE_PAYLOAD.size
 
-# Update focus_spotify to use stored PIDs
-def focus_spotify(debug=False):
+class ProbeBlock:
+    """A fixed-layout snapshot slot in shared memory, guarded by a sequence lock.
+
+    One writer bumps the sequence to odd, writes the payload and bumps it
+    back to even; readers retry while it is odd or changed under them, so
+    neither side ever takes a lock.
+    """
+    def __init__(self, buffer):
+        self._buffer = buffer
+
+    @property
+    def seq(self):
+        return _PROBE_SEQ.unpack_from(self._buffer, 0)[0]
+
+    def write(self, t, snapshot):
+        name = (snapshot.other_process or '').encode('utf-8')[:63]
+        seq = self.seq
+        _PROBE_SEQ.pack_into(self._buffer, 0, seq + 1)
+        _PROBE_PAYLOAD.pack_into(self._buffer, _PROBE_SEQ.size, t,
+                                 snapshot.spotify_active, snapshot.spotify_playing, snapshot.spotify_peak,
+                                 snapshot.other_active, snapshot.other_peak,
+                                 -1 if snapshot.other_pid is None else snapshot.other_pid,
+                                 snapshot.session_count, len(name), name)
+        _PROBE_SEQ.pack_into(self._buffer, 0, seq + 2)
+
+    def read(self, retries=100):
+        """Return (seq, t, snapshot), or None before the first write or while the writer keeps racing us."""
+        for _ in range(retries):
+            seq = self.seq
+            if seq & 1:
+                continue
+            payload = _PROBE_PAYLOAD.unpack_from(self._buffer, _PROBE_SEQ.size)
+            if self.seq != seq:
+                continue
+            if seq == 0:
+                return None
+            t, spotify_active, spotify_playing, spotify_peak, other_active, other_peak, pid, count, length, name = payload
+            return seq, t, AudioSnapshot(bool(spotify_active), spotify_peak, bool(other_active), other_peak,
+                                         name[:length].decode('utf-8', 'replace') or None,
+                                         None if pid < 0 else pid, count, bool(spotify_playing))
+        return None
+
+def _probe_worker(buffer, conn, backend_factory, interval, manager_options, settings):
+    """Child process body: snapshot every interval into the block and serve commands from conn."""
+    if hasattr(signal, 'SIGINT'):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent decides when we stop
+    backend = backend_factory() if backend_factory is not None else None
+    if backend is None:
+        _load_com()
+        try:
+            pythoncom.CoInitialize()
+        except Exception:
+            pass
+    manager = AudioSessionManager(backend=backend, watchdog=LeakWatchdog(), **manager_options)
+    manager._com_initialized = backend is None
+    if settings:
+        manager.configure(**settings)
+    block = ProbeBlock(buffer)
     try:
-        import win32gui
-        import win32process
-        import win32con
-        import win32api  # Ensure win32api is imported
+        while True:
+            deadline = time.monotonic() + interval
+            try:
+                block.write(time.monotonic(), manager.snapshot())
+            except Exception as e:
+                logger.warning("Probe snapshot failed: %s", e)
+            # Commands are handled between ticks, so the manager stays single-threaded
+            while True:
+                remaining = deadline - time.monotonic()
+                if not conn.poll(max(remaining, 0)):
+                    break
+                request, argument = conn.recv()
+                if request == 'stop':
+                    return
+                if request == 'command':
+                    conn.send(manager.send_media_command(argument))
+                elif request == 'configure':
+                    manager.configure(**argument)
+    except (EOFError, OSError):
+        pass  # The parent went away
+    finally:
+        manager.close()
 
-        spotify_hwnd = None
+class ProbeSupervisor:
+    """Runs the session probe in a child process and reads its snapshots from shared memory.
 
-        def callback(hwnd, pid):
-            nonlocal spotify_hwnd
-            if not win32gui.IsWindowVisible(hwnd):
-                return True
-            _, window_pid = win32process.GetWindowThreadProcessId(hwnd)
-            if window_pid in SPOTIFY_PIDS:
-                spotify_hwnd = hwnd
-                return False
-            return True
+    Stands in for an AudioSessionManager in the monitor loops: snapshot()
+    never blocks on COM, a crash or a hung probe costs a restart rather
+    than the GUI, and the worker is restarted with exponential backoff.
+    While the probe has no fresh snapshot, snapshot() returns None and the
+    loops skip the decision for that tick.
+    backend_factory must be picklable; None means Windows audio.
+    """
+    def __init__(self, backend_factory=None, interval=0.25, hang_timeout=5.0, startup_timeout=15.0,
+                 max_backoff=30.0, **manager_options):
+        import multiprocessing
+        self._context = multiprocessing.get_context('spawn')  # Never fork a process that holds COM or Tk
+        self._backend_factory = backend_factory
+        self.interval = interval
+        self.hang_timeout = hang_timeout
+        self.startup_timeout = startup_timeout
+        self.max_backoff = max_backoff
+        self._manager_options = manager_options
+        self._settings = {}
+        self._buffer = self._context.RawArray('B', PROBE_BLOCK_SIZE)
+        self._block = ProbeBlock(self._buffer)
+        self._conn = None
+        self._conn_lock = threading.Lock()
+        self._process = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        self._last_seq = 0
+        self._last_progress = 0.0
+        self.restarts = 0
+        self.crashes = 0
+        self.hangs = 0
 
-        for pid in SPOTIFY_PIDS:
+    def start(self):
+        self._spawn()
+        self._thread = threading.Thread(target=self._supervise, name='probe-supervisor', daemon=True)
+        self._thread.start()
+        return self
+
+    @property
+    def worker_pid(self):
+        return self._process.pid if self._process is not None else None
+
+    def _spawn(self):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_probe_worker, name='stopspoti-probe', daemon=True,
+            args=(self._buffer, child_conn, self._backend_factory, self.interval,
+                  self._manager_options, dict(self._settings)))
+        process.start()
+        child_conn.close()
+        with self._conn_lock:
+            self._conn = parent_conn
+        self._process = process
+        self._last_seq = self._block.seq
+        self._last_progress = time.monotonic() + self.startup_timeout - self.hang_timeout
+
+    def _stop_worker(self, timeout=2.0):
+        process = self._process
+        if process is None:
+            return
+        with self._conn_lock:
             try:
-                win32gui.EnumWindows(callback, pid)
-                if spotify_hwnd:
-                    fg_window = win32gui.GetForegroundWindow()
-                    current_thread_id = win32api.GetCurrentThreadId()
-                    fg_thread_id, _ = win32process.GetWindowThreadProcessId(fg_window)
-                    target_thread_id = win32process.GetWindowThreadProcessId(spotify_hwnd)[0]
+                self._conn.send(('stop', None))
+            except (OSError, ValueError):
+                pass
+            self._conn.close()
+        process.join(timeout)
+        if process.is_alive():
+            process.terminate()
+            process.join(timeout)
 
-                    win32process.AttachThreadInput(current_thread_id, fg_thread_id, True)
-                    win32process.AttachThreadInput(current_thread_id, target_thread_id, True)
+    def _supervise(self):
+        backoff = self.interval
+        while not self._stop.wait(self.interval):
+            now = time.monotonic()
+            seq = self._block.seq
+            if seq != self._last_seq:
+                self._last_seq = seq
+                self._last_progress = now
+                backoff = self.interval
+                continue
+            if self._process.is_alive():
+                if now - self._last_progress < self.hang_timeout:
+                    continue
+                self.hangs += 1
+                logger.warning("Audio probe (PID %s) made no progress for %.1fs; restarting it",
+                               self._process.pid, now - self._last_progress)
+            else:
+                self.crashes += 1
+                logger.warning("Audio probe (PID %s) exited with code %s; restarting it",
+                               self._process.pid, self._process.exitcode)
+            self._stop_worker(timeout=0.5)
+            if self._stop.wait(backoff):
+                return
+            backoff = min(backoff * 2, self.max_backoff)
+            self.restarts += 1
+            self._spawn()
 
-                    win32gui.ShowWindow(spotify_hwnd, win32con.SW_RESTORE)
-                    win32gui.SetForegroundWindow(spotify_hwnd)
+    def snapshot(self):
+        """The worker's latest snapshot; None if it has none or it is older than hang_timeout."""
+        result = self._block.read()
+        if result is None or time.monotonic() - result[1] > self.hang_timeout:
+            return None  # A hung or restarting probe is not silence
+        return result[2]
 
-                    win32process.AttachThreadInput(current_thread_id, fg_thread_id, False)
-                    win32process.AttachThreadInput(current_thread_id, target_thread_id, False)
+    def _request(self, message, timeout=None):
+        with self._conn_lock:
+            try:
+                while timeout is not None and self._conn.poll():
+                    self._conn.recv()  # A reply that came too late for an earlier request
+                self._conn.send(message)
+                if timeout is None:
+                    return None
+                return self._conn.recv() if self._conn.poll(timeout) else None
+            except (EOFError, OSError, ValueError):
+                return None
 
-                    if debug:
-                        print(f"{time.strftime('%H:%M:%S')} - Spotify window focused for PID {pid}.", flush=True)
-                    return True
-            except Exception as e:
-                if debug:
-                    print(f"{time.strftime('%H:%M:%S')} - EnumWindows failed for PID {pid}: {e}", flush=True)
-        if debug:
-            print(f"{time.strftime('%H:%M:%S')} - Spotify windows not found for any stored PIDs.", flush=True)
-        return False
+    def send_media_command(self, command):
+        """Send 'play' or 'pause' through the worker's backend; False if it does not answer in time."""
+        return bool(self._request(('command', command), timeout=max(self.hang_timeout, self.interval * 4)))
 
-    except ImportError as e:
-        if debug:
-            print(f"Error importing win32 modules: {e}", flush=True)
-            print("Please install pywin32 and ensure it is correctly configured.", flush=True)
+    def configure(self, **settings):
+        """Forward changed settings to the worker; they are replayed to restarted workers too."""
+        if all(self._settings.get(key) == value for key, value in settings.items()):
+            return
+        self._settings.update(settings)
+        self._request(('configure', settings))
+
+    def wait_for_change(self, timeout, idle_timeout=None):
+        self._wake.wait(timeout)
+        self._wake.clear()
         return False
-    except Exception as e:
-        if debug:
-            print(f"Error focusing Spotify: {e}", flush=True)
+
+    @property
+    def event_driven(self):
         return False
 
-# Windows AppCommand constants for media control
-APPCOMMAND_MEDIA_PLAY_PAUSE = 14
-APPCOMMAND_MEDIA_PLAY = 46
-APPCOMMAND_MEDIA_PAUSE = 47
-WM_APPCOMMAND = 0x0319
+    def wake(self):
+        self._wake.set()
 
-_debug_mode = False  # Global debug flag for standalone functions
+    def probe_stats(self):
+        return {'restarts': self.restarts, 'crashes': self.crashes, 'hangs': self.hangs, 'seq': self._block.seq}
 
-def get_spotify_hwnd():
-    """Get Spotify's main window handle without focusing it"""
+    # The caches live in the worker
+    def cache_stats(self):
+        return {}
+
+    def process_cache_stats(self):
+        return {}
+
+    def gate_stats(self):
+        return {}
+
+    def watchdog_stats(self):
+        return {}
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._stop_worker()
+
+# Settings that the control channel may change on a running monitor
+CONTROL_SETTINGS = {
+    'peak_threshold': float,
+    'action_cooldown': float,
+    'silence_threshold': float,
+    'device_gate': bool,
+    'debug': bool,
+}
+CONTROL_MAX_MESSAGE = 64 * 1024
+
+class InstanceAlreadyRunning(RuntimeError):
+    """Another monitor already holds the control address."""
+
+class ControlChannelError(RuntimeError):
+    """The control channel cannot be set up or reached safely."""
+
+def control_address():
+    """The per-user control channel: a named pipe on Windows, a Unix socket elsewhere.
+
+    The socket lives in XDG_RUNTIME_DIR, or else in a stopspoti-<uid>
+    directory under the temp directory that only this user can enter;
+    raises ControlChannelError if that directory belongs to someone else or
+    is open to other users.
+    """
+    if os.name == 'nt':
+        return r'\\.\pipe\stopspoti-' + os.environ.get('USERNAME', 'user')
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], f'stopspoti-{os.getuid()}.sock')
+    import stat
+    import tempfile
+    directory = os.path.join(tempfile.gettempdir(), f'stopspoti-{os.getuid()}')
     try:
-        import win32gui
-        import win32process
-        
-        spotify_hwnd = None
-        
-        def callback(hwnd, _):
-            nonlocal spotify_hwnd
-            if not win32gui.IsWindowVisible(hwnd):
-                return True
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    except OSError as e:
+        raise ControlChannelError(f"cannot create {directory}: {e}") from e
+    info = os.lstat(directory)  # Not stat: a symlink planted there must not be followed
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise ControlChannelError(f"{directory} must be a directory owned by you with mode 0700")
+    return os.path.join(directory, 'control.sock')
+
+def control_key_path(address):
+    """Where the monitor at address keeps the control channel's authentication key."""
+    if os.name == 'nt':
+        # Pipes are open to other users by default; the key sits in the user's profile
+        directory = os.path.join(os.environ.get('LOCALAPPDATA') or os.path.expanduser('~'), 'stopspoti')
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, address.rpartition('\\')[2] + '.key')
+    return address + '.key'
+
+def _read_control_key(address):
+    with open(control_key_path(address), 'rb') as f:
+        return f.read()
+
+def control_settings(settings):
+    """Check and convert settings sent over the control channel; raises ValueError."""
+    converted = {}
+    for name, value in settings.items():
+        if name not in CONTROL_SETTINGS:
+            raise ValueError(f"unknown setting {name!r}")
+        kind = CONTROL_SETTINGS[name]
+        if kind is bool and not isinstance(value, bool):
+            raise ValueError(f"{name} must be true or false")
+        converted[name] = kind(value)
+        if kind is float and not converted[name] >= 0:
+            raise ValueError(f"{name} must be a non-negative number")
+    return converted
+
+class ControlServer:
+    """Holds the single-instance lock and answers control requests from scripts and hotkeys.
+
+    acquire() binds the control address, which only one process can hold;
+    a stale Unix socket left by a crashed monitor is removed first. The
+    socket is created with no group or other access, and clients must also prove they can
+    read a fresh random key, written next to it readable only by this user,
+    which is what guards the Windows named pipe. serve() then answers each
+    request, a JSON object {"cmd": ..., "args": {...}}, with
+    {"ok": true, "result": ...} or {"ok": false, "error": ...} by calling
+    commands[cmd](**args).
+    """
+    def __init__(self, address=None, timeout=2.0):
+        from multiprocessing import connection
+        self._connection = connection
+        self.address = address or control_address()
+        self.timeout = timeout  # Longest wait for a connected client's request
+        self._listener = None
+        self._commands = {}
+        self._thread = None
+        self._closing = False
+        self._authkey = os.urandom(32)
+
+    def acquire(self):
+        """Bind the control address.
+
+        Raises InstanceAlreadyRunning if another monitor answers there and
+        ControlChannelError if the address or its key cannot be set up.
+        """
+        try:
+            self._listener = self._listen()
+        except OSError as e:
+            if self._answers():
+                raise InstanceAlreadyRunning(f"a monitor is already running at {self.address}")
+            if os.name == 'nt':
+                raise ControlChannelError(f"cannot listen at {self.address}: {e}") from e
             try:
-                _, window_pid = win32process.GetWindowThreadProcessId(hwnd)
-                if window_pid in SPOTIFY_PIDS:
-                    # Check if it's the main Spotify window (has a title)
-                    title = win32gui.GetWindowText(hwnd)
-                    if title and 'GDI+' not in title:  # Filter out helper windows
-                        spotify_hwnd = hwnd
-                        return False
-            except:
-                pass
-            return True
-        
-        win32gui.EnumWindows(callback, None)
-        return spotify_hwnd
-    except Exception as e:
-        if _debug_mode:
-            print(f"Error getting Spotify hwnd: {e}", flush=True)
-        return None
+                os.unlink(self.address)  # Left behind by a monitor that did not shut down
+                self._listener = self._listen()
+            except OSError as e:
+                raise ControlChannelError(f"cannot listen at {self.address}: {e}") from e
+        try:
+            self._write_key()
+        except OSError as e:
+            self._listener.close()
+            self._listener = None
+            raise ControlChannelError(f"cannot write the control key for {self.address}: {e}") from e
+        return self
 
-def send_appcommand_to_spotify(command):
-    """Send media command directly to Spotify window without stealing focus"""
-    try:
-        import win32api
-        import win32gui
-        
-        hwnd = get_spotify_hwnd()
-        if hwnd:
-            # WM_APPCOMMAND: wParam = hwnd, lParam = command << 16
-            lparam = command << 16
-            win32api.SendMessage(hwnd, WM_APPCOMMAND, hwnd, lparam)
+    def _listen(self):
+        if os.name == 'nt':
+            return self._connection.Listener(self.address, authkey=self._authkey)
+        previous = os.umask(0o077)  # Bind with no group or other access, with no window before a chmod
+        try:
+            return self._connection.Listener(self.address, authkey=self._authkey)
+        finally:
+            os.umask(previous)
+
+    def _write_key(self):
+        import tempfile
+        path = control_key_path(self.address)
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.stopspoti-key-')  # Mode 0600
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._authkey)
+            os.replace(temporary, path)
+        except OSError:
+            os.unlink(temporary)
+            raise
+
+    def _answers(self):
+        # A plain connect is enough to tell a live monitor from a stale socket
+        try:
+            self._connection.Client(self.address).close()
             return True
-        else:
-            if _debug_mode:
-                print(f"{time.strftime('%H:%M:%S')} - Spotify window not found", flush=True)
+        except OSError:
             return False
-    except Exception as e:
-        if _debug_mode:
-            print(f"Error sending appcommand: {e}", flush=True)
-        return False
 
-def pause_spotify():
-    """Pause Spotify by sending APPCOMMAND directly to its window"""
-    try:
-        if send_appcommand_to_spotify(APPCOMMAND_MEDIA_PAUSE):
-            if _debug_mode:
-                print(f"{time.strftime('%H:%M:%S')} - Paused Spotify via AppCommand", flush=True)
-            return True
-        # Fallback: try play/pause toggle
-        if send_appcommand_to_spotify(APPCOMMAND_MEDIA_PLAY_PAUSE):
-            if _debug_mode:
-                print(f"{time.strftime('%H:%M:%S')} - Paused Spotify via Play/Pause toggle", flush=True)
-            return True
-        return False
-    except Exception as e:
-        if _debug_mode:
-            print(f"Error pausing Spotify: {e}", flush=True)
-        return False
+    def serve(self, commands):
+        self._commands = commands
+        self._thread = threading.Thread(target=self._serve, name='control-server', daemon=True)
+        self._thread.start()
+        logger.info("Listening for control requests at %s", self.address)
+        return self
 
-def play_spotify():
-    """Resume Spotify by sending APPCOMMAND directly to its window"""
+    def _serve(self):
+        while not self._closing:
+            try:
+                conn = self._listener.accept()
+            except (EOFError, ConnectionError, self._connection.AuthenticationError) as e:
+                if self._closing:
+                    return
+                logger.debug("Control client failed the key check: %s", e)
+                continue
+            except OSError as e:
+                if self._closing:
+                    return
+                logger.warning("Control channel accept failed: %s", e)
+                time.sleep(0.1)
+                continue
+            with conn:
+                if self._closing:
+                    return
+                try:
+                    if not conn.poll(self.timeout):
+                        continue
+                    request = conn.recv_bytes(CONTROL_MAX_MESSAGE)
+                    conn.send_bytes(json.dumps(self.dispatch(request), separators=(',', ':')).encode('utf-8'))
+                except (EOFError, OSError) as e:
+                    logger.debug("Control client went away: %s", e)
+
+    def dispatch(self, request):
+        """Answer one encoded request."""
+        try:
+            request = json.loads(request)
+            command = self._commands[request['cmd']]
+        except (ValueError, TypeError, KeyError):
+            return {'ok': False, 'error': 'expected {"cmd": <one of %s>, "args": {...}}' % ', '.join(sorted(self._commands))}
+        try:
+            return {'ok': True, 'result': command(**request.get('args', {}))}
+        except Exception as e:
+            logger.debug("Control request %r failed: %s", request, e)
+            return {'ok': False, 'error': str(e) or type(e).__name__}
+
+    def close(self):
+        if self._listener is None:
+            return
+        self._closing = True
+        if self._thread is not None:
+            self._answers()  # Wake the pending accept()
+            self._thread.join(timeout=2)
+        self._listener.close()
+        self._listener = None
+        try:
+            os.unlink(control_key_path(self.address))
+        except OSError:
+            pass
+
+def control_request(command, address=None, timeout=5.0, **args):
+    """Send one request to the running monitor and return its decoded response."""
+    from multiprocessing import connection
+    address = address or control_address()
     try:
-        if send_appcommand_to_spotify(APPCOMMAND_MEDIA_PLAY):
-            if _debug_mode:
-                print(f"{time.strftime('%H:%M:%S')} - Resumed Spotify via AppCommand", flush=True)
-            return True
-        # Fallback: try play/pause toggle
-        if send_appcommand_to_spotify(APPCOMMAND_MEDIA_PLAY_PAUSE):
-            if _debug_mode:
-                print(f"{time.strftime('%H:%M:%S')} - Resumed Spotify via Play/Pause toggle", flush=True)
-            return True
-        return False
-    except Exception as e:
-        if _debug_mode:
-            print(f"Error resuming Spotify: {e}", flush=True)
-        return False
+        conn = connection.Client(address, authkey=_read_control_key(address))
+    except connection.AuthenticationError as e:
+        raise ControlChannelError(f"the monitor at {address} rejected the control key: {e}") from e
+    with conn:
+        conn.send_bytes(json.dumps({'cmd': command, 'args': args}, separators=(',', ':')).encode('utf-8'))
+        if not conn.poll(timeout):
+            raise TimeoutError(f"no answer to {command!r} within {timeout}s")
+        return json.loads(conn.recv_bytes(CONTROL_MAX_MESSAGE))
 
 class SpotifyControllerGUI:
-    def __init__(self):
+    def __init__(self, trace_path=None, profiler=None, probe_process=False, control=None, async_runtime=False):
+        _load_gui()
+        self.trace_path = trace_path  # Record a session trace of the monitor loop here
+        self.profiler = profiler  # PhaseProfiler for the monitor loop's audio manager
+        self.probe_process = probe_process  # Probe sessions in a supervised child process
+        self.control = control  # Acquired ControlServer to answer requests for this window
+        self.async_runtime = async_runtime  # Monitor with AsyncMonitor instead of monitor_loop
+        self.runtime = None
+        self._control_calls = deque()  # Control requests waiting for the Tk thread
         ctk.set_appearance_mode("dark")
         ctk.set_default_color_theme("dark-blue")  # We'll customize colors
         
@@ -531,23 +4183,36 @@ class SpotifyControllerGUI:
         # Settings
         self.peak_threshold = ctk.DoubleVar(value=0.0005)
         self.cache_timeout = ctk.IntVar(value=2)
+        self.cache_sessions = ctk.BooleanVar(value=False)  # Reuse the COM session manager between ticks
+        self.event_driven = ctk.BooleanVar(value=False)  # Wait for session notifications instead of polling
+        self.device_gate = ctk.BooleanVar(value=False)  # Check the endpoint meter before walking sessions
+        self.smoothing = ctk.BooleanVar(value=False)  # Smoothed levels with on/off hysteresis per session
         self.log_interval = ctk.IntVar(value=5)
         self.action_cooldown = ctk.DoubleVar(value=2.0)  # Increased cooldown to prevent rapid switching
+        self.silence_threshold = ctk.DoubleVar(value=1.5)  # Silence required before resuming
+        self.max_log_lines = ctk.IntVar(value=500)  # Older lines are dropped from the log view
         self.debug = ctk.BooleanVar(value=False)  # Debug mode off by default
-        self.ignored_processes = [
-            'system idle process', 'system', 'explorer.exe',
-            'FxSound.exe', 'FxSound', 'fxsound.exe', 
-            'obs64.exe', 'obs32.exe', 'obs.exe', 'obs-browser-page.exe',
-            'SnippingTool.exe', 'ScreenClippingHost.exe',
-            'ScreenClipping.exe',
-            'audiodg.exe'
-        ]
+        self.ignored_processes = list(DEFAULT_IGNORED_PROCESSES)
         
         self.monitoring = False
         self.monitor_thread = None
         self.audio_manager = None
+        self.monitor_audio_manager = None  # Owned by the monitor thread
+        self.scheduler = None
         
+        self.log_buffer = LogBuffer(self.max_log_lines.get())
+        # Debug records from the library, shown in the log while Debug Mode is on
+        self.debug_log = CallbackHandler(self.log_buffer.append)
+        self.debug_log.setFormatter(logging.Formatter('[%(asctime)s] %(message)s', '%H:%M:%S'))
+        logger.addHandler(self.debug_log)
+        self.last_snapshot = None
+        self.decider = None
+        self.dispatcher = None
         self.create_widgets()
+        self.root.after(LOG_FLUSH_INTERVAL_MS, self._flush_log)
+        if control is not None:
+            control.serve(self.control_commands())
+            self.root.after(CONTROL_POLL_INTERVAL_MS, self._serve_control)
         
     def create_widgets(self):
         # Title
@@ -614,6 +4279,15 @@ class SpotifyControllerGUI:
         cache_entry = ctk.CTkEntry(cache_frame, textvariable=self.cache_timeout, fg_color=self.bg_color, text_color=self.fg_color, border_color=self.accent_color)
         cache_entry.pack(side="right", padx=(10,0))
         
+        cache_check = ctk.CTkCheckBox(self.advanced_frame, text="Cache Audio Session Manager", variable=self.cache_sessions, fg_color=self.accent_color, text_color=self.fg_color)
+        cache_check.pack(pady=5)
+        event_check = ctk.CTkCheckBox(self.advanced_frame, text="Event-Driven Detection", variable=self.event_driven, fg_color=self.accent_color, text_color=self.fg_color)
+        event_check.pack(pady=5)
+        gate_check = ctk.CTkCheckBox(self.advanced_frame, text="Device Peak Gate", variable=self.device_gate, fg_color=self.accent_color, text_color=self.fg_color)
+        gate_check.pack(pady=5)
+        smoothing_check = ctk.CTkCheckBox(self.advanced_frame, text="Smoothed Detection (Hysteresis)", variable=self.smoothing, fg_color=self.accent_color, text_color=self.fg_color)
+        smoothing_check.pack(pady=5)
+        
         # Log Interval
         log_frame = ctk.CTkFrame(self.advanced_frame, fg_color=self.bg_color)
         log_frame.pack(fill="x", padx=10, pady=5)
@@ -628,6 +4302,20 @@ class SpotifyControllerGUI:
         cooldown_entry = ctk.CTkEntry(cooldown_frame, textvariable=self.action_cooldown, fg_color=self.bg_color, text_color=self.fg_color, border_color=self.accent_color)
         cooldown_entry.pack(side="right", padx=(10,0))
         
+        # Silence Window
+        silence_frame = ctk.CTkFrame(self.advanced_frame, fg_color=self.bg_color)
+        silence_frame.pack(fill="x", padx=10, pady=5)
+        ctk.CTkLabel(silence_frame, text="Silence Before Resume (s):", text_color=self.fg_color).pack(side="left")
+        silence_entry = ctk.CTkEntry(silence_frame, textvariable=self.silence_threshold, fg_color=self.bg_color, text_color=self.fg_color, border_color=self.accent_color)
+        silence_entry.pack(side="right", padx=(10,0))
+        
+        # Max Log Lines
+        log_lines_frame = ctk.CTkFrame(self.advanced_frame, fg_color=self.bg_color)
+        log_lines_frame.pack(fill="x", padx=10, pady=5)
+        ctk.CTkLabel(log_lines_frame, text="Max Log Lines:", text_color=self.fg_color).pack(side="left")
+        log_lines_entry = ctk.CTkEntry(log_lines_frame, textvariable=self.max_log_lines, fg_color=self.bg_color, text_color=self.fg_color, border_color=self.accent_color)
+        log_lines_entry.pack(side="right", padx=(10,0))
+        
         # Debug Mode
         debug_check = ctk.CTkCheckBox(self.advanced_frame, text="Debug Mode", variable=self.debug, fg_color=self.accent_color, text_color=self.fg_color)
         debug_check.pack(pady=5)
@@ -640,11 +4328,87 @@ class SpotifyControllerGUI:
         self.ignored_text.insert("0.0", "\n".join(self.ignored_processes))
         
     def log(self, message):
-        timestamp = time.strftime('%H:%M:%S')
-        def _log():
-            self.log_text.insert("end", f"[{timestamp}] {message}\n")
+        # Safe from any thread; the UI picks it up on the next flush
+        self.log_buffer.append(f"[{time.strftime('%H:%M:%S')}] {message}")
+
+    def _flush_log(self):
+        """Insert pending log lines in one batch and trim the textbox to the line limit."""
+        try:
+            try:
+                max_lines = max(1, int(self.max_log_lines.get()))
+            except Exception:
+                max_lines = self.log_buffer.max_lines  # Entry is being edited
+            self.log_buffer.set_max_lines(max_lines)
+
+            # No redraws while nobody can see them; the buffer stays bounded meanwhile
+            if self.root.state() in ("iconic", "withdrawn"):
+                return
+            lines = self.log_buffer.drain()
+            if not lines:
+                return
+            self.log_text.insert("end", "\n".join(lines) + "\n")
+            line_count = int(self.log_text.index("end-1c").split(".")[0]) - 1
+            if line_count > max_lines:
+                self.log_text.delete("1.0", f"{line_count - max_lines + 1}.0")
             self.log_text.see("end")
-        self.root.after(0, _log)
+        except Exception as e:
+            logger.debug("Log flush failed: %s", e)
+        finally:
+            self.root.after(LOG_FLUSH_INTERVAL_MS, self._flush_log)
+
+    def _in_gui(self, function, *args):
+        """Run function on the Tk thread for the control server and return its result."""
+        done = threading.Event()
+        outcome = []
+        self._control_calls.append((function, args, outcome, done))
+        if not done.wait(5.0):
+            raise TimeoutError("the window did not answer")
+        succeeded, value = outcome[0]
+        if not succeeded:
+            raise value
+        return value
+
+    def _serve_control(self):
+        while self._control_calls:
+            function, args, outcome, done = self._control_calls.popleft()
+            try:
+                outcome.append((True, function(*args)))
+            except Exception as e:
+                outcome.append((False, e))
+            done.set()
+        self.root.after(CONTROL_POLL_INTERVAL_MS, self._serve_control)
+
+    def control_status(self):
+        decider = self.decider
+        status = {'pid': os.getpid(), 'mode': 'gui', 'monitoring': self.monitoring,
+                  'paused_by_us': bool(decider and decider.paused_by_us)}
+        status.update((name, getattr(self, name).get()) for name in CONTROL_SETTINGS)
+        return status
+
+    def control_set(self, settings):
+        for name, value in control_settings(settings).items():
+            getattr(self, name).set(value)  # The monitor loop reads them on its next tick
+        return self.control_status()
+
+    def control_quit(self):
+        self.stop_monitoring()
+        self.root.after(0, self.root.destroy)
+
+    def _control_snapshot(self):
+        runtime = self.runtime
+        snapshot = runtime.last_snapshot if runtime is not None else self.last_snapshot
+        return snapshot._asdict() if snapshot is not None else None
+
+    def control_commands(self):
+        """The commands this window answers on the control channel."""
+        return {
+            'status': lambda: self._in_gui(self.control_status),
+            'snapshot': self._control_snapshot,
+            'start': lambda: self._in_gui(self.start_monitoring) or True,
+            'stop': lambda: self._in_gui(self.stop_monitoring) or False,
+            'set': lambda **settings: self._in_gui(self.control_set, settings),
+            'quit': lambda: self._in_gui(self.control_quit),
+        }
 
     def toggle_advanced(self):
         """Toggle visibility of advanced settings panel."""
@@ -669,7 +4433,9 @@ class SpotifyControllerGUI:
             cache_timeout=self.cache_timeout.get(),
             log_interval=self.log_interval.get(),
             debug=self.debug.get(),
-            ignored_processes=self.ignored_processes
+            ignored_processes=self.ignored_processes,
+            cache_sessions=self.cache_sessions.get(),
+            device_gate=self.device_gate.get()
         )
         
         self.monitoring = True
@@ -677,7 +4443,8 @@ class SpotifyControllerGUI:
         self.stop_button.configure(state="normal")
         self.status_label.configure(text="Status: Running")
         
-        self.monitor_thread = threading.Thread(target=self.monitor_loop, daemon=True)
+        self.monitor_thread = threading.Thread(target=self.async_loop if self.async_runtime else self.monitor_loop,
+                                               daemon=True)
         self.monitor_thread.start()
         
         self.log("Monitoring started")
@@ -687,17 +4454,22 @@ class SpotifyControllerGUI:
             return
         
         self.monitoring = False
+        if self.runtime is not None:
+            self.runtime.stop()  # Cancels its tasks, so the join below returns at once
+        if self.monitor_audio_manager:
+            self.monitor_audio_manager.wake()
         if self.monitor_thread and self.monitor_thread.is_alive():
             self.monitor_thread.join(timeout=2)  # Wait up to 2 seconds for thread to finish
-            if self.monitor_thread.is_alive() and self.debug.get():
-                print("Warning: Monitoring thread did not stop gracefully", flush=True)
+            if self.monitor_thread.is_alive():
+                logger.warning("Monitoring thread did not stop gracefully")
+        self.runtime = None
         
         if self.audio_manager:
             try:
                 self.audio_manager.close()
             except Exception as e:
                 if self.debug.get():
-                    print(f"Error closing audio manager: {e}", flush=True)
+                    logger.debug("Error closing audio manager: %s", e)
             self.audio_manager = None
         
         self.start_button.configure(state="normal")
@@ -706,120 +4478,245 @@ class SpotifyControllerGUI:
         
         self.log("Monitoring stopped")
         
+    def async_loop(self):
+        """monitor_loop on AsyncMonitor: probing, Spotify tracking and commands as separate tasks."""
+        set_debug_mode(self.debug.get())
+        if self.trace_path or self.event_driven.get() or self.profiler:
+            self.log("Tracing, profiling and event mode are not available with the async runtime")
+        detector = ActivityDetector(self.peak_threshold.get()) if self.smoothing.get() else None
+        if self.probe_process:
+            manager = ProbeSupervisor(
+                peak_threshold=self.peak_threshold.get(),
+                log_interval=self.log_interval.get(),
+                ignored_processes=list(self.ignored_processes),
+                detector=detector
+            ).start()
+        else:
+            manager = AudioSessionManager(
+                peak_threshold=self.peak_threshold.get(),
+                cache_timeout=self.cache_timeout.get(),
+                log_interval=self.log_interval.get(),
+                debug=self.debug.get(),
+                ignored_processes=self.ignored_processes,
+                cache_sessions=self.cache_sessions.get(),
+                device_gate=self.device_gate.get(),
+                detector=detector,
+                watchdog=LeakWatchdog()
+            )
+        decider = PauseDecider(self.action_cooldown.get(), self.silence_threshold.get())
+
+        def apply_settings():
+            # Runs on the probe thread ahead of each snapshot
+            manager.configure(
+                peak_threshold=self.peak_threshold.get(),
+                device_gate=self.device_gate.get(),
+                debug=self.debug.get(),
+                cache_timeout=self.cache_timeout.get(),
+                cache_sessions=self.cache_sessions.get(),
+            )
+            set_debug_mode(self.debug.get())
+            decider.action_cooldown = self.action_cooldown.get()
+            decider.silence_threshold = self.silence_threshold.get()
+
+        def report(action, succeeded, snapshot):
+            if action == ACTION_PAUSE and succeeded:
+                self.log(f"Paused Spotify (other audio detected: {snapshot.other_process})")
+            elif action == ACTION_RESUME and succeeded:
+                self.log("Resumed Spotify (other audio stopped)")
+            elif self.debug.get():
+                logger.debug("Media command failed, will retry...")
+
+        runtime = AsyncMonitor(manager, decider, com_init=not self.probe_process,
+                               before_snapshot=apply_settings, on_action=report,
+                               dispatcher=MediaCommandDispatcher(manager.send_media_command))
+        self.decider = decider
+        self.dispatcher = runtime.dispatcher
+        self.scheduler = runtime.scheduler
+        self.monitor_audio_manager = manager
+        self.runtime = runtime
+        if not self.monitoring:
+            runtime.stop()  # Stopped before the runtime existed
+        try:
+            runtime.run()
+        except Exception as e:
+            logger.warning("Async monitor failed: %s", e)
+            self.log(f"Error in monitoring loop: {e}")
+        if self.debug.get():
+            logger.debug("Monitoring runtime exited")
+
     def monitor_loop(self):
-        global _debug_mode
-        _debug_mode = self.debug.get()  # Set global debug flag
+        set_debug_mode(self.debug.get())
         
+        event_driven = self.event_driven.get()
+
         # Thread-local COM initialization
+        _load_com()
         try:
-            pythoncom.CoInitialize()
+            if event_driven:
+                # Session callbacks arrive on COM worker threads, which needs the MTA
+                pythoncom.CoInitializeEx(pythoncom.COINIT_MULTITHREADED)
+            else:
+                pythoncom.CoInitialize()
         except:
             pass
 
-        # Create a persistent audio manager for this thread
-        thread_audio_manager = AudioSessionManager(
-            peak_threshold=self.peak_threshold.get(),
-            cache_timeout=self.cache_timeout.get(),
-            log_interval=self.log_interval.get(),
-            debug=self.debug.get(),
-            ignored_processes=self.ignored_processes
-        )
-        thread_audio_manager._com_initialized = True
+        recorder = None
+        backend = None
+        if self.probe_process and (self.trace_path or event_driven or self.profiler):
+            self.log("Tracing, profiling and event mode are not available with the probe process")
+        if self.trace_path and not self.probe_process:
+            # Event-driven snapshots bypass the backend, so only polled ticks carry sessions
+            recorder = TraceRecorder(self.trace_path, options={
+                'peak_threshold': self.peak_threshold.get(),
+                'device_gate': self.device_gate.get(),
+                'cache_sessions': self.cache_sessions.get(),
+                'cache_timeout': self.cache_timeout.get(),
+            })
+            backend = RecordingBackend(ComAudioBackend(
+                cache_timeout=self.cache_timeout.get(),
+                cache_sessions=self.cache_sessions.get(),
+                debug=self.debug.get()), recorder)
+            self.log(f"Recording session trace to {self.trace_path}")
+
+        detector = ActivityDetector(self.peak_threshold.get()) if self.smoothing.get() else None
+        if self.probe_process:
+            thread_audio_manager = ProbeSupervisor(
+                peak_threshold=self.peak_threshold.get(),
+                log_interval=self.log_interval.get(),
+                ignored_processes=list(self.ignored_processes),
+                detector=detector
+            ).start()
+            self.log(f"Probing audio sessions in process {thread_audio_manager.worker_pid}")
+        else:
+            # Create a persistent audio manager for this thread
+            thread_audio_manager = AudioSessionManager(
+                peak_threshold=self.peak_threshold.get(),
+                cache_timeout=self.cache_timeout.get(),
+                log_interval=self.log_interval.get(),
+                debug=self.debug.get(),
+                ignored_processes=self.ignored_processes,
+                cache_sessions=self.cache_sessions.get(),
+                event_source=ComSessionEventSource() if event_driven else None,
+                device_gate=self.device_gate.get(),
+                backend=backend,
+                detector=detector,
+                profiler=self.profiler,
+                watchdog=LeakWatchdog()
+            )
+            thread_audio_manager._com_initialized = True
+        self.monitor_audio_manager = thread_audio_manager
 
-        spotify_paused_by_us = False  # Tracks if WE paused Spotify
-        last_action_time = 0
-        action_cooldown = self.action_cooldown.get()
-        silence_start_time = None  # Track when other audio stopped
-        silence_threshold = 1.5  # Wait 1.5 seconds of silence before resuming
+        decider = PauseDecider(self.action_cooldown.get(), self.silence_threshold.get())
+        self.decider = decider
+        dispatcher = MediaCommandDispatcher(post_media_command)  # A hung Spotify window cannot block the loop
+        self.dispatcher = dispatcher
+        scheduler = PollScheduler()
+        self.scheduler = scheduler
         
         try:
             while self.monitoring:
                 try:
                     # Update settings on the fly
-                    thread_audio_manager._peak_threshold = self.peak_threshold.get()
-                    thread_audio_manager._cache_timeout = self.cache_timeout.get()
-                    thread_audio_manager._debug = self.debug.get()
-                    thread_audio_manager._ignored_processes = set(proc.lower() for proc in self.ignored_processes)
-                    _debug_mode = self.debug.get()
+                    thread_audio_manager.configure(
+                        peak_threshold=self.peak_threshold.get(),
+                        device_gate=self.device_gate.get(),
+                        debug=self.debug.get(),
+                        cache_timeout=self.cache_timeout.get(),
+                        cache_sessions=self.cache_sessions.get(),
+                    )
+                    set_debug_mode(self.debug.get())
+                    decider.action_cooldown = self.action_cooldown.get()
+                    decider.silence_threshold = self.silence_threshold.get()  # Seconds of silence before resuming
                     
-                    current_time = time.time()
-                    spotify_process = get_spotify_process()
+                    # Monotonic so clock adjustments cannot break the cooldowns
+                    current_time = time.monotonic()
+                    spotify_running = spotify_tracker.refresh()
+                    snapshot = None
+                    action = ACTION_NONE
                     
-                    if spotify_process:
-                        # Only check other apps audio
-                        other_apps_playing = thread_audio_manager.check_audio_sessions(check_spotify=False)
-                        
-                        # Respect cooldown to prevent rapid switching
-                        if current_time - last_action_time >= action_cooldown:
-                            if other_apps_playing and not spotify_paused_by_us:
-                                # Other app started playing - pause Spotify
-                                # Reset silence timer since other audio is playing
-                                silence_start_time = None
-                                
-                                time.sleep(0.1)
-                                spotify_playing = thread_audio_manager.check_audio_sessions(check_spotify=True)
-                                if spotify_playing:
-                                    if pause_spotify():
-                                        spotify_paused_by_us = True
-                                        last_action_time = current_time
-                                        self.log("Paused Spotify (other audio detected)")
-                            
-                            elif spotify_paused_by_us and not other_apps_playing:
-                                # Other app stopped - track silence duration
-                                if silence_start_time is None:
-                                    silence_start_time = current_time
-                                    if self.debug.get():
-                                        print(f"{time.strftime('%H:%M:%S')} - Other audio stopped, waiting {silence_threshold}s before resuming...", flush=True)
-                                
-                                # Wait for sustained silence before resuming
-                                elif current_time - silence_start_time >= silence_threshold:
-                                    if self.debug.get():
-                                        print(f"{time.strftime('%H:%M:%S')} - Silence confirmed, resuming Spotify...", flush=True)
-                                    if play_spotify():
-                                        spotify_paused_by_us = False
-                                        last_action_time = current_time
-                                        silence_start_time = None
-                                        self.log("Resumed Spotify (other audio stopped)")
-                                    else:
-                                        # Retry on next loop
-                                        if self.debug.get():
-                                            print(f"{time.strftime('%H:%M:%S')} - Resume failed, will retry...", flush=True)
-                            
-                            elif other_apps_playing and spotify_paused_by_us:
-                                # Other audio still playing, reset silence timer
-                                silence_start_time = None
+                    if spotify_running:
+                        # One pass over the sessions answers both questions; None while the probe is stale
+                        snapshot = thread_audio_manager.snapshot()
+                    if snapshot is not None:
+                        outcome = dispatcher.observe(current_time, snapshot.spotify_active, snapshot.spotify_playing)
+                        if outcome is not None and not outcome.succeeded:
+                            self.log(f"Spotify did not {outcome.command} after {outcome.attempts} attempts")
+                            if outcome.command == 'pause':
+                                decider.action_reverted(ACTION_PAUSE)
+                        elif outcome is not None and self.debug.get():
+                            logger.debug("Spotify followed %s after %.0f ms", outcome.command, outcome.latency * 1000)
+                        silence_pending = decider.silence_pending
+                        action = decider.step(current_time, snapshot.spotify_active, snapshot.other_active)
+
+                        if action == ACTION_PAUSE:
+                            # Other app started playing - pause Spotify
+                            succeeded = dispatcher.request('pause', current_time)
+                            decider.action_result(succeeded)
+                            if succeeded:
+                                self.log(f"Paused Spotify (other audio detected: {snapshot.other_process})")
+                            else:
+                                action = ACTION_NONE
+                        elif action == ACTION_RESUME:
+                            if self.debug.get():
+                                logger.debug("Silence confirmed, resuming Spotify...")
+                            succeeded = dispatcher.request('play', current_time)
+                            decider.action_result(succeeded)
+                            if succeeded:
+                                self.log("Resumed Spotify (other audio stopped)")
+                            else:
+                                action = ACTION_NONE
+                                # Retry on next loop
+                                if self.debug.get():
+                                    logger.debug("Resume failed, will retry...")
+                        elif decider.silence_pending and not silence_pending and self.debug.get():
+                            logger.debug("Other audio stopped, waiting %ss before resuming...", decider.silence_threshold)
+                    elif not spotify_running:
+                        dispatcher.cancel()
+
+                    self.last_snapshot = snapshot
+                    if recorder is not None:
+                        recorder.end_tick(current_time, action, spotify_running)
                     
-                    time.sleep(0.5)
+                    mode = scheduler.choose_mode(spotify_running, snapshot, decider.paused_by_us,
+                                                 decider.silence_pending)
+                    deadline = scheduler.next_deadline(current_time, mode)
+                    # In event mode, idle ticks block until a session changes state
+                    thread_audio_manager.wait_for_change(
+                        scheduler.remaining(deadline),
+                        idle_timeout=None if decider.paused_by_us else EVENT_IDLE_TIMEOUT)
                     
                 except Exception as e:
                     error_msg = f"Error in monitoring loop: {e}"
-                    if self.debug.get():
-                        print(error_msg, flush=True)  # Also print to console for debugging
+                    logger.warning(error_msg)
                     self.log(error_msg)
-                    time.sleep(2)  # Wait longer on error to prevent rapid restarts
+                    # Wait longer on error to prevent rapid restarts
+                    time.sleep(scheduler.remaining(scheduler.next_deadline(time.monotonic(), 'error')))
         finally:
             # Ensure cleanup happens when loop exits
             if thread_audio_manager:
                 thread_audio_manager.close()
+            if recorder is not None:
+                recorder.close()
             try:
                 pythoncom.CoUninitialize()
             except:
                 pass
                 
             if self.debug.get():
-                print("Monitoring thread exited and cleaned up", flush=True)
+                logger.debug("Monitoring thread exited and cleaned up")
         
     def run(self):
         try:
             self.root.mainloop()
         except Exception as e:
             if self.debug.get():
-                print(f"Critical GUI error: {e}", flush=True)
+                logger.debug("Critical GUI error: %s", e)
             # Don't restart, just exit gracefully
             sys.exit(1)
 
-def get_audio_session_result(check_spotify, peak_threshold=0.0005, cache_timeout=2, log_interval=5, debug=False, ignored_processes=None):
+def get_audio_snapshot(peak_threshold=0.0005, cache_timeout=2, log_interval=5, debug=False, ignored_processes=None):
     try:
+        _load_com()
         try:
             pythoncom.CoInitialize()
         except:
@@ -834,7 +4731,7 @@ def get_audio_session_result(check_spotify, peak_threshold=0.0005, cache_timeout
         )
         audio_manager._com_initialized = True
             
-        result = audio_manager.check_audio_sessions(check_spotify)
+        result = audio_manager.snapshot()
         audio_manager.close()
         
         try:
@@ -846,12 +4743,154 @@ def get_audio_session_result(check_spotify, peak_threshold=0.0005, cache_timeout
         
     except Exception as e:
         if debug:
-            print(f"{time.strftime('%H:%M:%S')} - Direct audio check error: {e}", flush=True)
-        return False
+            logger.debug("Direct audio check error: %s", e)
+        return EMPTY_SNAPSHOT
+
+def get_audio_session_result(check_spotify, peak_threshold=0.0005, cache_timeout=2, log_interval=5, debug=False, ignored_processes=None):
+    snapshot = get_audio_snapshot(
+        peak_threshold=peak_threshold,
+        cache_timeout=cache_timeout,
+        log_interval=log_interval,
+        debug=debug,
+        ignored_processes=ignored_processes
+    )
+    return snapshot.spotify_active if check_spotify else snapshot.other_active
+
+def install_profile_report(profiler):
+    """Print the profiler's report at exit and whenever SIGUSR1 (SIGBREAK on Windows) arrives."""
+    def print_report():
+        print(profiler.report(), flush=True)
+    atexit.register(print_report)
+    dump_signal = getattr(signal, 'SIGUSR1', None) or getattr(signal, 'SIGBREAK', None)
+    if dump_signal is not None and threading.current_thread() is threading.main_thread():
+        signal.signal(dump_signal, lambda signum, frame: print_report())
+        logger.info("Send signal %s to PID %s for a profile report", int(dump_signal), os.getpid())
+
+def run_daemon(simulate=False, max_ticks=None, action_cooldown=2.0, silence_threshold=1.5, metrics_port=None,
+               profiler=None, probe_process=False, control=None, async_runtime=False, cache_sessions=False,
+               device_gate=False):
+    """Run the monitor headless until interrupted; never imports the GUI libraries.
+
+    With simulate, a SimulatedAudioBackend stands in for Windows audio so
+    the loop can be measured on any machine. With metrics_port, Prometheus
+    metrics are served on the loopback interface at that port. A profiler
+    times each phase of every tick. With probe_process, the sessions are
+    probed in a supervised child process instead. An acquired ControlServer
+    answers control requests for the monitor while it runs. With
+    async_runtime, an AsyncMonitor runs the loop and closes the manager.
+    cache_sessions keeps the COM session manager across ticks and
+    device_gate checks the endpoint meter before walking the sessions;
+    both are off by default, as in the GUI.
+    """
+    started = time.perf_counter()
+    if probe_process:
+        if profiler is not None:
+            logger.info("The profiler does not see into the probe process")
+        factory = functools.partial(SimulatedAudioBackend, session_count=20, seed=0) if simulate else None
+        manager = ProbeSupervisor(factory, debug=False, cache_sessions=cache_sessions, device_gate=device_gate).start()
+        spotify_running = (lambda: True) if simulate else None
+    elif simulate:
+        backend = SimulatedAudioBackend(session_count=20, seed=0)
+        spotify_running = lambda: True
+    else:
+        if not async_runtime:  # AsyncMonitor initialises COM on its own threads
+            _load_com()
+            try:
+                pythoncom.CoInitialize()
+            except Exception:
+                pass
+        backend = None
+        spotify_running = None
+    if not probe_process:
+        manager = AudioSessionManager(debug=False, cache_sessions=cache_sessions, device_gate=device_gate, backend=backend,
+                                      profiler=profiler, watchdog=LeakWatchdog())
+        manager._com_initialized = not simulate and not async_runtime
+    metrics = MonitorMetrics() if metrics_port is not None else None
+    decider = PauseDecider(action_cooldown, silence_threshold)
+    dispatcher = MediaCommandDispatcher(manager.send_media_command)
+    if async_runtime:
+        monitor = AsyncMonitor(manager, decider, spotify_running=spotify_running, started=started, metrics=metrics,
+                               metrics_port=metrics_port, com_init=not simulate and not probe_process,
+                               dispatcher=dispatcher)
+    else:
+        monitor = HeadlessMonitor(manager, decider, spotify_running=spotify_running, started=started, metrics=metrics,
+                                  dispatcher=dispatcher)
+    metrics_server = None
+    if metrics is not None and not async_runtime:
+        metrics_server = MetricsServer(lambda: metrics.render(monitor), metrics_port).start()
+        logger.info("Serving metrics at http://127.0.0.1:%s/metrics", metrics_server.port)
+    if control is not None:
+        control.serve(monitor.control_commands())
+
+    def handle_signal(signum, frame):
+        monitor.stop()
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGINT, handle_signal)
+        signal.signal(signal.SIGTERM, handle_signal)
+
+    logger.info("Daemon started (PID %s, module imported in %.1f ms)", os.getpid(), _IMPORT_SECONDS * 1000)
+    try:
+        monitor.run(max_ticks)
+    finally:
+        if control is not None:
+            control.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        if not async_runtime:
+            manager.close()
+    logger.info("Daemon stopped after %s ticks (%s pauses, %s resumes)", monitor.ticks, monitor.pauses, monitor.resumes)
+    return monitor
 
 def clear_screen():
     os.system('cls' if os.name == 'nt' else 'clear')
 
+def _option_value(name, default=None):
+    """Return the argument following name on the command line."""
+    if name in sys.argv:
+        index = sys.argv.index(name)
+        if index + 1 < len(sys.argv):
+            return sys.argv[index + 1]
+    return default
+
+def _acquire_control():
+    """Take the single-instance lock, or exit if another monitor holds it."""
+    try:
+        return ControlServer(_option_value('--control')).acquire()
+    except InstanceAlreadyRunning as e:
+        print(f"Not starting: {e}. Use --ctl status to talk to it.")
+        sys.exit(1)
+    except ControlChannelError as e:
+        print(f"Not starting: {e}", file=sys.stderr)
+        sys.exit(1)
+
+def run_control_client(arguments):
+    """--ctl COMMAND [name=value ...]: send one request to the running monitor; returns the exit code."""
+    if not arguments:
+        print("Usage: --ctl status|snapshot|start|stop|quit|set [name=value ...]")
+        return 2
+    args = {}
+    for item in arguments[1:]:
+        name, separator, value = item.partition('=')
+        if not separator:
+            continue
+        try:
+            args[name] = json.loads(value)
+        except ValueError:
+            args[name] = value
+    try:
+        response = control_request(arguments[0], address=_option_value('--control'), **args)
+    except (OSError, EOFError, TimeoutError) as e:
+        print(f"No monitor answered: {e}", file=sys.stderr)
+        return 1
+    except ControlChannelError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    if not response.get('ok'):
+        print(f"Error: {response.get('error')}", file=sys.stderr)
+        return 1
+    print(json.dumps(response.get('result'), indent=2, sort_keys=True))
+    return 0
+
 def main():
     # Set process priority to below normal to reduce resource usage
     if hasattr(sys, 'frozen'):
@@ -860,21 +4899,67 @@ def main():
         win32api.SetConsoleCtrlHandler(None, True)
         win32process.SetPriorityClass(win32api.GetCurrentProcess(), win32process.BELOW_NORMAL_PRIORITY_CLASS)
 
+    configure_logging(
+        log_file=_option_value('--log-file'),
+        console_level=logging.DEBUG if '--verbose' in sys.argv else logging.INFO
+    )
+    profiler = None
+    if '--profile' in sys.argv:
+        profiler = PhaseProfiler()
+        install_profile_report(profiler)
+
     # Check if running in test mode
-    if len(sys.argv) > 1 and sys.argv[1] == "--test":
+    if len(sys.argv) > 1 and sys.argv[1] == "--ctl":
+        sys.exit(run_control_client(sys.argv[2:]))
+    elif len(sys.argv) > 1 and sys.argv[1] == "--test":
         print("Running in test mode for 10 seconds...")
         test_resource_usage()
     elif len(sys.argv) > 1 and sys.argv[1] == "--gui-only":
         print("Running GUI only (no monitoring)...")
         app = SpotifyControllerGUI()
         app.run()
+    elif len(sys.argv) > 1 and sys.argv[1] == "--daemon":
+        ticks = _option_value('--ticks')
+        metrics_port = _option_value('--metrics-port')
+        run_daemon(simulate='--simulate' in sys.argv, max_ticks=int(ticks) if ticks else None,
+                   action_cooldown=float(_option_value('--cooldown', 2.0)),
+                   silence_threshold=float(_option_value('--silence', 1.5)),
+                   metrics_port=int(metrics_port) if metrics_port else None, profiler=profiler,
+                   probe_process='--probe-process' in sys.argv, control=_acquire_control(),
+                   async_runtime='--async' in sys.argv, cache_sessions='--cache-sessions' in sys.argv,
+                   device_gate='--device-gate' in sys.argv)
+    elif len(sys.argv) > 2 and sys.argv[1] == "--replay":
+        decider = PauseDecider(float(_option_value('--cooldown', 2.0)), float(_option_value('--silence', 1.5)))
+        stats = replay_trace(sys.argv[2], decide=decider.decide)
+        print(f"Replayed {stats.ticks} ticks ({stats.trace_seconds:.1f}s of recording) in {stats.elapsed:.3f}s")
+        if stats.ticks:
+            print(f"Per tick: {stats.elapsed / stats.ticks * 1e6:.1f} us | Speedup: {stats.trace_seconds / max(stats.elapsed, 1e-9):.0f}x")
+        print(f"Pauses: {stats.pauses} | Resumes: {stats.resumes} | Ticks deciding unlike the recording: {stats.mismatches}")
+    elif len(sys.argv) > 2 and sys.argv[1] == "--sweep":
+        import numpy as np
+        timeline = load_sweep_timeline(sys.argv[2])
+        started = time.perf_counter()
+        result = sweep_parameters(timeline, np.geomspace(1e-4, 5e-2, 16), np.linspace(0.5, 5.0, 10),
+                                  np.linspace(0.5, 5.0, 10))
+        print(f"Evaluated {len(result.pauses)} combinations over {len(timeline.t)} ticks in {time.perf_counter() - started:.2f}s")
+        print("threshold  cooldown  silence  pauses  resumes  false  pause_lat  resume_lat")
+        for i in rank_sweep(result):
+            print(f"{result.peak_threshold[i]:9.5f}  {result.action_cooldown[i]:8.2f}  {result.silence_threshold[i]:7.2f}  "
+                  f"{result.pauses[i]:6d}  {result.resumes[i]:7d}  {result.false_pauses[i]:5d}  "
+                  f"{result.pause_latency[i]:9.2f}  {result.resume_latency[i]:10.2f}")
     elif len(sys.argv) > 1 and sys.argv[1] == "--version":
         print("Spotify Auto Controller v1.0")
         print("Built with PyInstaller")
         sys.exit(0)
     else:
-        app = SpotifyControllerGUI()
-        app.run()
+        control = _acquire_control()
+        try:
+            app = SpotifyControllerGUI(trace_path=_option_value('--record-trace'), profiler=profiler,
+                                       probe_process='--probe-process' in sys.argv, control=control,
+                                       async_runtime='--async' in sys.argv)
+            app.run()
+        finally:
+            control.close()
 
 def test_resource_usage():
     """Test function to run monitoring for 30 seconds and measure resource usage"""
@@ -884,6 +4969,7 @@ def test_resource_usage():
     print(f"Process ID: {os.getpid()}")
     print("Starting resource monitoring test...")
     
+    _load_com()
     try:
         pythoncom.CoInitialize()
     except:
@@ -892,18 +4978,16 @@ def test_resource_usage():
     audio_manager = AudioSessionManager()
     audio_manager._com_initialized = True
     
-    spotify_was_playing = False
-    last_action_time = 0
-    action_cooldown = 1.0
+    decider = PauseDecider(action_cooldown=1.0)
     
-    start_time = time.time()
+    start_time = time.monotonic()
     end_time = start_time + 30  # Run for 30 seconds
     
     process = psutil_monitor.Process(os.getpid())
     
-    while time.time() < end_time:
+    while time.monotonic() < end_time:
         try:
-            current_time = time.time()
+            current_time = time.monotonic()
             
             # Get current resource usage
             cpu_percent = process.cpu_percent(interval=0.1)
@@ -912,25 +4996,16 @@ def test_resource_usage():
             if int(current_time - start_time) % 5 == 0:  # Log every 5 seconds
                 print(f"Time: {current_time - start_time:.1f}s | CPU: {cpu_percent:.1f}% | Memory: {memory_mb:.1f} MB")
             
-            spotify_process = get_spotify_process()
+            spotify_running = spotify_tracker.refresh()
             
-            if spotify_process:
-                other_apps_playing = get_audio_session_result(check_spotify=False)
-                time.sleep(0.25)
-                spotify_playing = get_audio_session_result(check_spotify=True)
-                
-                if current_time - last_action_time >= action_cooldown:
-                    if other_apps_playing and spotify_playing:
-                        if not spotify_was_playing:
-                            # Don't actually pause, just simulate
-                            spotify_was_playing = True
-                            last_action_time = current_time
-                            print("Would pause Spotify")
-                    elif spotify_was_playing and not other_apps_playing:
-                        if not other_apps_playing:  # Only resume if no other audio
-                            spotify_was_playing = False
-                            last_action_time = current_time
-                            print("Would resume Spotify")
+            if spotify_running:
+                snapshot = get_audio_snapshot()
+                # Don't actually pause or resume, just simulate
+                action = decider.decide(current_time, snapshot)
+                if action == ACTION_PAUSE:
+                    print("Would pause Spotify")
+                elif action == ACTION_RESUME:
+                    print("Would resume Spotify")
             
             time.sleep(0.5)
             
@@ -953,5 +5028,10 @@ def test_resource_usage():
         
     print("Test completed.")
 
+_IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
+
 if __name__ == "__main__":
+    if hasattr(sys, 'frozen'):
+        import multiprocessing
+        multiprocessing.freeze_support()  # The probe process re-enters the frozen executable
     main()
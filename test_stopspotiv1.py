@@ -1,6 +1,12 @@
 import sys
 import os
 import time
+import ctypes
+import signal
+import functools
+import subprocess
+import urllib.error
+import urllib.request
 import pytest
 from unittest.mock import MagicMock, patch
 
@@ -48,8 +54,34 @@ def test_get_spotify_processes(mock_process_iter):
     assert processes[1].pid == 102
     assert stopspotiv1.get_spotify_process() is not None
 
+def test_spotify_tracker_checks_known_pids_between_rescans():
+    tracker = stopspotiv1.SpotifyProcessTracker(rescan_interval=60)
+    spotify = MagicMock(info={'pid': 100, 'name': 'Spotify.exe', 'create_time': 5.0})
+    chrome = MagicMock(info={'pid': 101, 'name': 'chrome.exe', 'create_time': 6.0})
+    restarted = MagicMock(info={'pid': 200, 'name': 'Spotify.exe', 'create_time': 9.0})
+    alive = {100: 5.0}
+
+    def fake_process(pid):
+        if pid not in alive:
+            raise stopspotiv1.psutil.NoSuchProcess(pid)
+        return MagicMock(**{'create_time.return_value': alive[pid]})
+
+    with patch('stopspotiv1.psutil.process_iter', return_value=[spotify, chrome]) as mock_iter, \
+         patch('stopspotiv1.psutil.Process', side_effect=fake_process):
+        assert tracker.refresh() is True
+        assert tracker.refresh() is True  # Liveness check only
+        assert mock_iter.call_count == 1
+        assert stopspotiv1.SPOTIFY_PIDS == [100]
+
+        # Spotify restarts under a new PID: the dead known set forces a rescan
+        del alive[100]
+        mock_iter.return_value = [chrome, restarted]
+        assert tracker.refresh() is True
+        assert mock_iter.call_count == 2
+        assert stopspotiv1.SPOTIFY_PIDS == [200]
+
 def test_audio_session_manager_initialization():
-    manager = stopspotiv1.AudioSessionManager()
+    manager = stopspotiv1.AudioSessionManager().backend
     
     # Test retry logic handling
     with patch.object(manager, '_cleanup') as mock_cleanup:
@@ -64,11 +96,39 @@ def test_audio_session_manager_initialization():
         # Since the second attempt succeeded, the manager should be initialized
         assert manager._initialized is False or manager._initialized is True
 
-@patch.object(stopspotiv1.AudioSessionManager, '_initialize_if_needed')
+def test_cached_session_enumerator_rebuilds_only_when_needed():
+    stopspotiv1.pycaw.AudioUtilities.GetSpeakers.side_effect = None
+    manager = stopspotiv1.AudioSessionManager(cache_timeout=2, debug=False, cache_sessions=True)
+    backend = manager.backend
+
+    now = [1000.0]
+    with patch('stopspotiv1.time.monotonic', side_effect=lambda: now[0]):
+        backend.begin_walk()  # Initial build
+        session_manager = backend._session_manager
+        fetches = session_manager.GetSessionEnumerator.call_count
+        enumerator = session_manager.GetSessionEnumerator.return_value
+        enumerator.GetCount.return_value = backend._session_count = 3
+        now[0] += 0.5
+        assert backend.begin_walk() == 3  # Cached manager, fresh enumerator
+        enumerator.GetCount.return_value = 4
+        now[0] += 0.5
+        assert backend.begin_walk() == 4  # A new session shows up on the very next tick
+        assert session_manager.GetSessionEnumerator.call_count == fetches + 2
+        now[0] += 2.0
+        backend._initialize_if_needed()  # Timeout: full rebuild
+        manager.invalidate('com_error')
+        backend._initialize_if_needed()  # Full rebuild after a COM failure
+
+    stats = manager.cache_stats()
+    assert stats['hits'] == 2
+    assert stats['refreshes'] == 1
+    assert stats['rebuilds'] == 3
+    assert stats['causes'] == {'initial': 1, 'session_count_changed': 1, 'timeout': 1, 'com_error': 1}
+
+@patch.object(stopspotiv1.ComAudioBackend, '_initialize_if_needed')
 def test_check_audio_sessions_ignores_specified_processes(mock_init):
     manager = stopspotiv1.AudioSessionManager(ignored_processes=['ignore.exe'])
-    manager._com_initialized = True
-    manager._initialized = True
+    manager.backend._initialized = True
     
     # Mock COM sessions
     mock_session = MagicMock()
@@ -79,17 +139,21 @@ def test_check_audio_sessions_ignores_specified_processes(mock_init):
     mock_enumerator = MagicMock()
     mock_enumerator.GetCount.return_value = 1
     mock_enumerator.GetSession.return_value = mock_session
-    manager._sessions = mock_enumerator
+    manager.backend._sessions = mock_enumerator
     
     # Test skipping ignored process
     with patch('stopspotiv1.psutil.Process') as mock_proc:
         mock_proc.return_value.name.return_value = 'ignore.exe'
+        mock_proc.return_value.create_time.return_value = 1.0
         
         result = manager.check_audio_sessions(check_spotify=False)
         assert result is False  # Because it was ignored
         
         # Test not-ignored non-spotify process actively playing
+        # PID 500 is reused by a new process, which the name cache must notice
+        manager._process_cache.validate_interval = 0
         mock_proc.return_value.name.return_value = 'other.exe'
+        mock_proc.return_value.create_time.return_value = 2.0
         mock_audio_session.GetState.return_value = stopspotiv1.AUDCLNT_SESSIONSTATE_ACTIVE
         
         mock_meter = MagicMock()
@@ -106,6 +170,448 @@ def test_check_audio_sessions_ignores_specified_processes(mock_init):
         result = manager.check_audio_sessions(check_spotify=False)
         assert result is True
 
+def test_process_info_cache_validates_create_time_and_evicts():
+    cache = stopspotiv1.ProcessInfoCache(ignored_processes={'discord.exe'}, max_size=2, validate_interval=0)
+    processes = {
+        1: MagicMock(**{'name.return_value': 'Spotify.exe', 'create_time.return_value': 10.0}),
+        2: MagicMock(**{'name.return_value': 'Discord.exe', 'create_time.return_value': 20.0}),
+        3: MagicMock(**{'name.return_value': 'chrome.exe', 'create_time.return_value': 30.0}),
+    }
+    with patch('stopspotiv1.psutil.Process', side_effect=lambda pid: processes[pid]):
+        spotify = cache.lookup(1)
+        assert spotify.is_spotify and not spotify.is_ignored and spotify.name_lower == 'spotify.exe'
+        assert cache.lookup(1) is spotify
+        assert cache.lookup(2).is_ignored
+
+        # PID 1 now belongs to a different process
+        processes[1] = MagicMock(**{'name.return_value': 'game.exe', 'create_time.return_value': 11.0})
+        assert cache.lookup(1).name == 'game.exe'
+        cache.lookup(3)  # Evicts PID 2, the least recently used
+
+    assert processes[1].name.call_count == 1
+    assert cache.stats() == {'size': 2, 'hits': 1, 'misses': 4, 'evictions': 1, 'invalidations': 1}
+
+def test_process_matcher_rules_and_memoised_manager_lookups():
+    matcher = stopspotiv1.ProcessMatcher(['FxSound.exe', 'obs', 'ScreenClipping*.exe', 're:^steam(webhelper)?\\.exe$',
+                                          'C:\\Program Files\\Games\\', 'D:/Tools/*/recorder.exe', 're:(', ' '])
+    assert matcher.matches('fxsound') and matcher.matches('obs.exe') and not matcher.matches('obsidian.exe')
+    assert matcher.matches('screenclippinghost.exe') and matcher.matches('steamwebhelper.exe')
+    assert not matcher.matches('steam2.exe')  # The invalid 're:(' rule is skipped, not fatal
+    assert matcher.needs_path and not matcher.matches('game.exe')
+    assert matcher.matches('game.exe', 'c:\\program files\\games\\Quake\\game.exe')
+    assert matcher.matches('recorder.exe', 'D:\\Tools\\v2\\Recorder.exe')
+    assert not matcher.matches('recorder.exe', 'D:\\Other\\recorder.exe')
+    assert not stopspotiv1.ProcessMatcher([]) and not stopspotiv1.ProcessMatcher(['obs']).needs_path
+
+    # Rules valid alone that break or change meaning once merged are matched on their own
+    tricky = stopspotiv1.ProcessMatcher(['re:(?i)foo.*', 're:(?P<n>a+)x', 're:(?P<n>b+)y', 're:(b)\\1', 're:zz'])
+    assert tricky.matches('foobar.exe') and tricky.matches('aax') and tricky.matches('by')
+    assert tricky.matches('bb') and not tricky.matches('b1') and tricky.matches('zz') and not tricky.matches('zzz')
+    manager = stopspotiv1.AudioSessionManager(backend=stopspotiv1.SimulatedAudioBackend(), debug=False,
+                                              ignored_processes=['re:(?i)teams', 're:(?P<n>x)', 're:(?P<n>y)'])
+    assert manager._ignored.matches('teams')
+
+    class PathBackend(stopspotiv1.SimulatedAudioBackend):
+        def process_exe(self, pid):
+            self.calls['process_exe'] = self.calls.get('process_exe', 0) + 1
+            return f'C:\\Games\\{self._by_pid[pid].name}'
+
+    backend = PathBackend(seed=1)
+    teams = backend.add_session('Teams.exe', stopspotiv1.AUDCLNT_SESSIONSTATE_ACTIVE, 0.5)
+    manager = stopspotiv1.AudioSessionManager(backend=backend, debug=False, ignored_processes=['teams'])
+    compiled = manager._ignored
+    for _ in range(3):
+        assert not manager.snapshot().other_active
+    manager.configure(ignored_processes=['teams'])
+    assert manager._ignored is compiled  # Unchanged rules are not recompiled
+    assert backend.calls['process_identity'] == 2 and 'process_exe' not in backend.calls
+
+    manager.configure(ignored_processes=['re:team.*'])
+    assert manager._ignored is not compiled and not manager.snapshot().other_active
+    manager.configure(ignored_processes=['C:/Games/'])
+    for _ in range(3):
+        assert not manager.snapshot().other_active
+    assert backend.calls['process_exe'] == 2  # Once per PID, then memoised
+    manager.configure(ignored_processes=['discord.exe'])
+    assert manager.snapshot().other_pid == teams
+
+@patch.object(stopspotiv1.ComAudioBackend, '_initialize_if_needed')
+def test_snapshot_reports_spotify_and_other_apps_in_one_pass(mock_init):
+    manager = stopspotiv1.AudioSessionManager()
+    manager.backend._initialized = True
+
+    def make_session(pid, peak):
+        audio_session = MagicMock()
+        audio_session.GetProcessId.return_value = pid
+        audio_session.GetState.return_value = stopspotiv1.AUDCLNT_SESSIONSTATE_ACTIVE
+        meter = MagicMock()
+        meter.GetPeakValue.return_value = peak
+        session = MagicMock()
+        session.QueryInterface.side_effect = lambda iid: meter if iid is stopspotiv1.pycaw.IAudioMeterInformation else audio_session
+        return session
+
+    sessions = [make_session(1, 0.3), make_session(2, 0.4)]
+    mock_enumerator = MagicMock()
+    mock_enumerator.GetCount.return_value = 2
+    mock_enumerator.GetSession.side_effect = lambda i: sessions[i]
+    manager.backend._sessions = mock_enumerator
+
+    names = {1: 'Spotify.exe', 2: 'chrome.exe'}
+    with patch('stopspotiv1.psutil.Process') as mock_proc:
+        mock_proc.side_effect = lambda pid: MagicMock(**{'name.return_value': names[pid]})
+        snapshot = manager.snapshot()
+
+    assert snapshot.spotify_active is True
+    assert snapshot.other_active is True
+    assert snapshot.other_process == 'chrome.exe'
+    assert snapshot.other_pid == 2
+    assert snapshot.spotify_peak == 0.3
+    assert mock_enumerator.GetSession.call_count == 2
+    assert mock_enumerator.GetCount.call_count == 1
+
+def test_simulated_backend_drives_manager_without_com():
+    backend = stopspotiv1.SimulatedAudioBackend(session_count=200, seed=7, active_ratio=0.0)
+    manager = stopspotiv1.AudioSessionManager(debug=False, backend=backend)
+
+    snapshot = manager.snapshot()
+    assert snapshot.spotify_active and not snapshot.other_active
+    assert snapshot.session_count == 201
+
+    pid = backend.add_session('Teams.exe', stopspotiv1.AUDCLNT_SESSIONSTATE_ACTIVE, 0.5)
+    snapshot = manager.snapshot()
+    assert snapshot.other_active and snapshot.other_pid == pid
+    assert manager.send_media_command('pause') is True
+    assert not manager.snapshot().spotify_active
+    assert backend.commands == ['pause']
+
+    # The same seed gives the same churn and failures; failures read as silence
+    sleeps = []
+    runs = []
+    for _ in range(2):
+        flaky = stopspotiv1.SimulatedAudioBackend(session_count=50, seed=3, active_ratio=0.5, churn_rate=0.1,
+                                                  failure_rate=0.02, latencies={'begin_walk': 0.001}, sleep=sleeps.append)
+        flaky_manager = stopspotiv1.AudioSessionManager(debug=False, backend=flaky)
+        runs.append([flaky_manager.snapshot() for _ in range(30)])
+    assert runs[0] == runs[1]
+    assert stopspotiv1.EMPTY_SNAPSHOT in runs[0]
+    assert flaky.failures > 0 and flaky.churned > 0
+    assert sleeps == [0.001] * 60
+
+def test_phase_profiler_times_every_backend_call():
+    profiler = stopspotiv1.PhaseProfiler()
+    backend = stopspotiv1.SimulatedAudioBackend(session_count=10, seed=1, active_ratio=0.0)
+    manager = stopspotiv1.AudioSessionManager(debug=False, backend=backend, profiler=profiler, gc_interval=0)
+
+    for _ in range(5):
+        manager.snapshot()
+    manager.send_media_command('pause')
+
+    counts = {phase: histogram.count for phase, histogram in profiler.histograms.items()}
+    assert counts['snapshot'] == 5 and counts['begin_walk'] == 5 and counts['gc'] == 5
+    assert counts['open_session'] == counts['session_pid'] == counts['release_session'] == 5 * 11
+    assert counts['send_media_command'] == 1
+    assert backend.commands == ['pause']
+    assert profiler.quantile('snapshot', 0.5) <= profiler.maxima['snapshot']
+
+    report = profiler.report().splitlines()
+    assert report[0].split() == ['Phase', 'Calls', 'Total', 'ms', 'Mean', 'us', 'p50', 'us', 'p95', 'us', 'Max', 'us']
+    assert report[1].split()[:2] == ['snapshot', '5']
+
+def test_session_trace_round_trips_through_replay(tmp_path):
+    path = tmp_path / 'session.trace'
+    simulated = stopspotiv1.SimulatedAudioBackend(session_count=20, seed=5, active_ratio=0.0)
+    recorder = stopspotiv1.TraceRecorder(str(path), flush_bytes=64)
+    manager = stopspotiv1.AudioSessionManager(debug=False, backend=stopspotiv1.RecordingBackend(simulated, recorder))
+
+    teams = None
+    recorded = []
+    for tick in range(6):
+        if tick == 2:
+            teams = simulated.add_session('Teams.exe', stopspotiv1.AUDCLNT_SESSIONSTATE_ACTIVE, 0.5)
+        if tick == 4:
+            simulated.remove_session(teams)
+        spotify_running = tick != 5
+        snapshot = manager.snapshot() if spotify_running else None
+        action = stopspotiv1.ACTION_PAUSE if tick == 2 else stopspotiv1.ACTION_NONE
+        recorder.end_tick(100.0 + tick * 0.5, action, spotify_running)
+        recorded.append(snapshot)
+    recorder.close()
+
+    replayed = []
+    stats = stopspotiv1.replay_trace(str(path), on_tick=lambda tick, snapshot, action: replayed.append(snapshot))
+    assert stats.ticks == 6 and stats.pauses == 1 and stats.mismatches == 0
+    assert stats.trace_seconds == 2.5
+    assert [s and (s.spotify_active, s.other_active, s.other_pid, s.session_count) for s in replayed] == \
+           [s and (s.spotify_active, s.other_active, s.other_pid, s.session_count) for s in recorded]
+    assert replayed[2].other_process == 'teams.exe'
+
+    # A decision function replaces the recorded actions
+    stats = stopspotiv1.replay_trace(str(path), decide=lambda t, snapshot, tick: stopspotiv1.ACTION_NONE)
+    assert stats.pauses == 0 and stats.mismatches == 1
+
+def test_gated_trace_replays_with_the_recorded_options(tmp_path):
+    path = tmp_path / 'gated.trace'
+    simulated = stopspotiv1.SimulatedAudioBackend(session_count=5, seed=2, active_ratio=0.0)
+    recorder = stopspotiv1.TraceRecorder(str(path), options={'device_gate': True, 'cache_sessions': True,
+                                                             'cache_timeout': 2, 'debug': True})
+    manager = stopspotiv1.AudioSessionManager(debug=False, device_gate=True,
+                                              backend=stopspotiv1.RecordingBackend(simulated, recorder))
+    recorded = []
+    for tick in range(6):
+        snapshot = manager.snapshot()
+        recorder.end_tick(tick * 0.5)
+        recorded.append((snapshot.spotify_active, snapshot.other_active))
+    recorder.close()
+    assert recorded == [(True, False)] * 6 and manager.gate_stats()['spotify_only'] > 0
+
+    def replay(**options):
+        replayed = []
+        stopspotiv1.replay_trace(str(path), on_tick=lambda tick, s, action: replayed.append((s.spotify_active, s.other_active)),
+                                 **options)
+        return replayed
+
+    assert stopspotiv1.TraceReader(str(path)).options == {'device_gate': True, 'cache_sessions': True, 'cache_timeout': 2}
+    assert replay() == recorded
+    assert replay(device_gate=False) != recorded  # Gated ticks hold no sessions to walk
+
+def test_activity_detector_ignores_blips_and_short_gaps():
+    detector = stopspotiv1.ActivityDetector(peak_threshold=0.01, window=4, min_on=0.5, min_off=1.0)
+
+    assert detector.update(1, 0.0, 0.3) is False  # Above the on threshold, waiting for min_on
+    assert detector.update(1, 0.25, 0.0) is False  # Only a blip
+    assert detector.update(1, 1.0, 0.3) is False
+    assert detector.update(1, 1.25, 0.3) is False
+    assert detector.update(1, 1.5, 0.3) is True
+    for now in (1.75, 2.0, 2.25, 2.5, 2.75):  # A gap in speech shorter than min_off
+        assert detector.update(1, now, 0.0) is True
+    assert detector.update(1, 3.0, 0.3) is True
+    states = [detector.update(1, 3.0 + 0.25 * i, 0.0) for i in range(1, 9)]
+    # The window empties after four silent samples, then min_off runs
+    assert states == [True] * 7 + [False]
+    assert not detector.any_active()
+
+    ema = stopspotiv1.ActivityDetector(peak_threshold=0.1, mode='ema', alpha=0.5, min_off=0.0)
+    assert ema.update(2, 0.0, 0.4) is True
+    assert ema.update(2, 0.5, 0.0) is True  # The level halves to 0.1, still above the off threshold
+    assert ema.update(2, 1.0, 0.0) is True
+    assert ema.update(2, 1.5, 0.0) is False
+    assert len(ema) == 1 and ema.prune(100.0) == 1 and len(ema) == 0
+
+def test_manager_holds_other_audio_through_a_gap_with_detector():
+    backend = stopspotiv1.SimulatedAudioBackend(seed=1)
+    teams = backend.add_session('Teams.exe', stopspotiv1.AUDCLNT_SESSIONSTATE_ACTIVE, 0.2)
+    detector = stopspotiv1.ActivityDetector(peak_threshold=0.0005, window=4, min_off=1.0)
+    manager = stopspotiv1.AudioSessionManager(debug=False, backend=backend, device_gate=True, detector=detector)
+
+    now = [0.0]
+    with patch('stopspotiv1.time.monotonic', side_effect=lambda: now[0]):
+        assert manager.snapshot().other_active
+        backend.set_session(teams, state=stopspotiv1.AUDCLNT_SESSIONSTATE_INACTIVE)
+        backend.set_session(backend.spotify_pid, state=stopspotiv1.AUDCLNT_SESSIONSTATE_INACTIVE)
+        other_active = []
+        for tick in range(1, 13):
+            now[0] = tick * 0.25
+            other_active.append(manager.snapshot().other_active)
+    # The device is silent at once, but the detector holds Teams for four samples plus min_off
+    assert other_active == [True] * 7 + [False] * 5
+    assert manager.gate_stats()['silent'] == 4
+
+    # Teams closes while playing: its held level must not keep forcing walks
+    teams = backend.add_session('Teams.exe', stopspotiv1.AUDCLNT_SESSIONSTATE_ACTIVE, 0.2)
+    with patch('stopspotiv1.time.monotonic', side_effect=lambda: now[0]):
+        now[0] = 10.0
+        assert manager.snapshot().other_active
+        backend.remove_session(teams)
+        before = manager.gate_stats()
+        for tick in range(1, 121):
+            now[0] = 10.0 + tick * 0.25
+            assert not manager.snapshot().other_active
+    after = manager.gate_stats()
+    assert after['full_walks'] - before['full_walks'] == 1 and after['silent'] - before['silent'] == 119
+
+def test_event_driven_snapshot_follows_scripted_events():
+    spotify_meter = MagicMock(**{'GetPeakValue.return_value': 0.2})
+    chrome_meter = MagicMock(**{'GetPeakValue.return_value': 0.4})
+    active = stopspotiv1.AUDCLNT_SESSIONSTATE_ACTIVE
+    source = stopspotiv1.ScriptedEventSource([
+        ('session_created', ('spotify', 1, active, spotify_meter)),
+        ('session_created', ('chrome', 2, stopspotiv1.AUDCLNT_SESSIONSTATE_INACTIVE, chrome_meter)),
+        ('state_changed', ('chrome', active)),
+        ('session_removed', ('chrome',)),
+    ])
+    manager = stopspotiv1.AudioSessionManager(debug=False, event_source=source)
+    names = {1: 'Spotify.exe', 2: 'chrome.exe'}
+
+    with patch('stopspotiv1.psutil.Process') as mock_proc:
+        mock_proc.side_effect = lambda pid: MagicMock(**{'name.return_value': names[pid]})
+        assert manager.snapshot() == stopspotiv1.EMPTY_SNAPSHOT
+        assert manager.wait_for_change(0.01, idle_timeout=0.01) is False
+
+        source.step(2)
+        assert manager.wait_for_change(0.01) is True
+        snapshot = manager.snapshot()
+        assert snapshot.spotify_active and not snapshot.other_active
+        chrome_meter.GetPeakValue.assert_not_called()  # Inactive sessions are never metered
+
+        source.step()
+        snapshot = manager.snapshot()
+        assert snapshot.other_active and snapshot.other_process == 'chrome.exe'
+
+        source.step()
+        snapshot = manager.snapshot()
+        assert not snapshot.other_active and snapshot.session_count == 1
+    manager.close()
+
+def test_failed_event_source_start_leaves_nothing_registered():
+    controls = [MagicMock(**{'GetSessionInstanceIdentifier.return_value': key, 'GetProcessId.return_value': pid,
+                             'GetState.return_value': stopspotiv1.AUDCLNT_SESSIONSTATE_ACTIVE})
+                for key, pid in (('spotify', 1), ('chrome', 2))]
+    meters = [MagicMock() for _ in controls]
+    sessions = [MagicMock(**{'QueryInterface.side_effect': lambda iid, control=control, meter=meter:
+                             control if iid is stopspotiv1.pycaw.IAudioSessionControl2 else meter})
+                for control, meter in zip(controls, meters)]
+    session_manager = MagicMock()
+    session_manager.GetSessionEnumerator.return_value = MagicMock(**{
+        'GetCount.return_value': 2, 'GetSession.side_effect': sessions.__getitem__})
+    session_manager.RegisterSessionNotification.side_effect = OSError('audio service restarted')
+    speakers = stopspotiv1.pycaw.AudioUtilities.GetSpeakers
+    speakers.side_effect = None
+    speakers.return_value.Activate.return_value.QueryInterface.return_value = session_manager
+
+    source = stopspotiv1.ComSessionEventSource()
+    tracker = stopspotiv1.SessionEventTracker(source)
+    with patch('comtypes.COMObject', object):
+        for _ in range(2):  # A retry on the next tick must not register the sessions twice
+            with pytest.raises(OSError):
+                tracker.start()
+            assert source._registrations == {} and tracker.session_count() == 0
+    for control, meter, session in zip(controls, meters, sessions):
+        assert control.RegisterAudioSessionNotification.call_count == 2
+        assert control.UnregisterAudioSessionNotification.call_count == 2
+        # Every COM reference taken by a failed start is released again
+        assert control.Release.call_count == meter.Release.call_count == session.Release.call_count == 2
+    assert session_manager.Release.call_count == 2
+    assert session_manager.GetSessionEnumerator.return_value.Release.call_count == 2
+
+    tracker.session_created('spotify', 1, stopspotiv1.AUDCLNT_SESSIONSTATE_ACTIVE, None)
+    assert tracker.wait(0) is True and tracker.wait(0) is False
+
+class FakeWindowBackend(stopspotiv1.WindowBackend):
+    def __init__(self, windows):
+        self.windows = windows  # hwnd -> owning pid
+        self.sent = []
+        self.find_calls = 0
+
+    def find_window(self, pids):
+        self.find_calls += 1
+        return next((hwnd for hwnd, pid in self.windows.items() if pid in pids), None)
+
+    def is_window(self, hwnd):
+        return hwnd in self.windows
+
+    def window_pid(self, hwnd):
+        return self.windows[hwnd]
+
+    def post_message(self, hwnd, message, wparam, lparam):
+        self.sent.append((hwnd, message, wparam, lparam))
+
+def test_spotify_window_cache_reuses_handle_until_invalid():
+    backend = FakeWindowBackend({10: 100})
+    cache = stopspotiv1.SpotifyWindowCache(backend)
+    with patch.object(stopspotiv1, 'SPOTIFY_PIDS', [100]):
+        assert cache.get() == 10
+        assert cache.get() == 10
+        assert backend.find_calls == 1
+
+        # Spotify restarted: old window is gone, new one belongs to the new PID
+        backend.windows = {20: 200}
+        stopspotiv1.SPOTIFY_PIDS[:] = [200]
+        assert cache.get() == 20
+        assert backend.find_calls == 2
+    assert cache.stats() == {'hits': 1, 'enumerations': 2, 'invalidations': 1}
+
+def test_device_gate_skips_session_walk():
+    manager = stopspotiv1.AudioSessionManager(debug=False, device_gate=True)
+    backend = manager.backend
+    spotify_meter = MagicMock(**{'GetPeakValue.return_value': 0.3})
+
+    with patch.object(backend, 'device_peak', return_value=0.0), \
+         patch.object(backend, '_initialize_if_needed') as mock_init:
+        snapshot = manager.snapshot()
+        assert not snapshot.spotify_active and not snapshot.other_active
+        mock_init.assert_not_called()
+
+    with patch.object(backend, 'device_peak', return_value=0.3), \
+         patch.object(backend, '_initialize_if_needed'):
+        backend._initialized = True
+        backend._sessions = MagicMock(**{'GetCount.return_value': 0})
+        manager.snapshot()  # Device is loud and nothing is known: full walk
+        # As if that walk had found Spotify playing
+        manager._spotify_session = stopspotiv1._ComSession(MagicMock(), MagicMock(), spotify_meter)
+
+        # Spotify's own meter explains the device level, twice, then a full walk is forced
+        assert manager.snapshot().spotify_active
+        assert manager.snapshot().spotify_active
+        manager.snapshot()
+
+    assert manager.gate_stats() == {'checks': 5, 'silent': 1, 'spotify_only': 2, 'full_walks': 2}
+
+def test_logging_keeps_debug_records_off_the_console(capsys):
+    ring = stopspotiv1.configure_logging(ring_capacity=3)
+    try:
+        stopspotiv1.log_rate_limiter.set_interval('test', 60)
+        for i in range(5):
+            stopspotiv1.logger.debug("tick %d", i)
+        stopspotiv1.logger.debug("rate limited", extra={'category': 'test'})
+        stopspotiv1.logger.debug("rate limited", extra={'category': 'test'})
+        stopspotiv1.logger.info("visible")
+
+        assert [record.getMessage() for record in ring.records] == ["tick 4", "rate limited", "visible"]
+        assert stopspotiv1.log_rate_limiter.suppressed['test'] == 1
+        out = capsys.readouterr().out
+        assert "visible" in out and "tick" not in out
+
+        # Debug mode shows debug records on the console and in the GUI log, but not the GUI's own INFO lines
+        gui_lines = []
+        stopspotiv1.logger.addHandler(stopspotiv1.CallbackHandler(gui_lines.append))
+        stopspotiv1.set_debug_mode(True)
+        stopspotiv1.logger.debug("walking sessions")
+        stopspotiv1.logger.info("paused")
+        stopspotiv1.set_debug_mode(False)
+        stopspotiv1.logger.debug("hidden again")
+        assert gui_lines == ["walking sessions"]
+        out = capsys.readouterr().out
+        assert "walking sessions" in out and "hidden again" not in out
+    finally:
+        for handler in list(stopspotiv1.logger.handlers):
+            stopspotiv1.logger.removeHandler(handler)
+
+class FakeComPointer(ctypes.c_void_p):
+    def Release(self):
+        self.releases = getattr(self, 'releases', 0) + 1
+
+def test_com_scope_releases_each_pointer_once():
+    released = FakeComPointer(1)
+    kept = FakeComPointer(2)
+    with stopspotiv1.ComScope() as scope:
+        scope.track(released)
+        scope.track(kept)
+        scope.keep(kept)
+
+    assert released.releases == 1
+    assert not released  # Nulled, so a second release (or comtypes' __del__) is a no-op
+    stopspotiv1.release_com(released)
+    assert released.releases == 1
+    assert kept and not hasattr(kept, 'releases')
+
+def test_gc_policy_is_rate_limited():
+    with patch('stopspotiv1.gc.collect', return_value=3) as mock_collect:
+        assert stopspotiv1.GcPolicy().maybe_collect() == 0
+        policy = stopspotiv1.GcPolicy(interval=0, generation=0)
+        assert policy.maybe_collect() == 3
+        mock_collect.assert_called_once_with(0)
+    assert policy.stats()['collections'] == 1 and policy.stats()['collected'] == 3
+
 @patch('stopspotiv1.send_appcommand_to_spotify')
 def test_pause_play_spotify(mock_send):
     mock_send.return_value = True
@@ -116,6 +622,448 @@ def test_pause_play_spotify(mock_send):
     assert stopspotiv1.play_spotify() is True
     mock_send.assert_called_with(stopspotiv1.APPCOMMAND_MEDIA_PLAY)
 
+def test_poll_scheduler_adapts_interval_to_state():
+    now = [100.0]
+    scheduler = stopspotiv1.PollScheduler(clock=lambda: now[0])
+    snapshot = stopspotiv1.AudioSnapshot
+
+    only_spotify = snapshot(True, 0.3, False, 0.0, None, None, 1)
+    other_starting = snapshot(True, 0.3, True, 0.4, 'chrome.exe', 2, 2)
+    other_while_paused = snapshot(False, 0.0, True, 0.4, 'chrome.exe', 2, 2)
+
+    assert scheduler.choose_mode(False, None, False, False) == 'idle'
+    assert scheduler.choose_mode(True, only_spotify, False, False) == 'slow'
+    assert scheduler.choose_mode(True, other_starting, False, False) == 'fast'
+    assert scheduler.choose_mode(True, other_while_paused, True, False) == 'normal'
+    assert scheduler.choose_mode(True, stopspotiv1.EMPTY_SNAPSHOT, True, True) == 'fast'
+
+    deadline = scheduler.next_deadline(now[0], 'slow')
+    now[0] += 0.25
+    assert scheduler.remaining(deadline) == 0.75
+    now[0] += 5
+    assert scheduler.remaining(deadline) == 0.0
+    scheduler.next_deadline(now[0], 'fast')
+    metrics = scheduler.metrics()
+    assert metrics['ticks']['slow'] == 1 and metrics['ticks']['fast'] == 1
+    assert metrics['last_mode'] == 'fast'
+    assert metrics['average_interval'] == 0.55
+
+def test_pause_decider_waits_for_cooldown_and_silence():
+    decider = stopspotiv1.PauseDecider(action_cooldown=2.0, silence_threshold=1.5)
+    NONE, PAUSE, RESUME = stopspotiv1.ACTION_NONE, stopspotiv1.ACTION_PAUSE, stopspotiv1.ACTION_RESUME
+
+    assert decider.step(0.0, True, False) == NONE
+    assert decider.step(1.0, True, True) == PAUSE
+    decider.action_result(False)  # The pause did not reach Spotify: retried next tick
+    assert not decider.paused_by_us
+    assert decider.step(1.5, True, True) == PAUSE
+    decider.action_result(True)
+    assert decider.paused_by_us
+
+    assert decider.step(2.0, False, False) == NONE  # Within the cooldown
+    assert decider.step(3.5, False, False) == NONE  # Silence starts
+    assert decider.silence_pending
+    assert decider.step(4.0, False, True) == NONE  # Other audio again: silence resets
+    assert not decider.silence_pending
+    assert decider.step(4.5, False, False) == NONE
+    assert decider.step(5.9, False, False) == NONE
+    assert decider.step(6.0, False, False) == RESUME
+    decider.action_result(True)
+    assert not decider.paused_by_us and not decider.silence_pending
+    assert decider.step(7.0, True, True) == NONE  # Cooldown after the resume
+
+    decider.reset()
+    snapshot = stopspotiv1.AudioSnapshot(True, 0.3, True, 0.4, 'chrome.exe', 2, 2)
+    assert decider.decide(0.0, snapshot) == PAUSE and decider.paused_by_us
+    assert decider.decide(10.0, None) == NONE
+
+def test_parameter_sweep_matches_pause_decider():
+    np = pytest.importorskip('numpy')
+    # Spotify plays throughout; a short blip at 5s and a real call from 20s to 40s
+    t = np.arange(0.0, 60.0, 0.5)
+    other_peak = np.where((t >= 20) & (t < 40), 0.2, 0.0)
+    other_peak[t == 5.0] = 0.004
+    timeline = stopspotiv1.SweepTimeline(t, np.full(len(t), 0.3), other_peak)
+    thresholds, cooldowns, silences = [0.001, 0.01], [0.5, 3.0], [1.0, 4.0]
+
+    result = stopspotiv1.sweep_parameters(timeline, thresholds, cooldowns, silences, workers=1, chunk_size=3)
+    assert len(result.pauses) == 8
+
+    for i in range(8):
+        decider = stopspotiv1.PauseDecider(result.action_cooldown[i], result.silence_threshold[i])
+        paused = False
+        pauses = resumes = 0
+        for now, level, other in zip(t, timeline.spotify_level, other_peak):
+            threshold = result.peak_threshold[i]
+            action = decider.step(now, not paused and level > threshold, other > threshold)
+            if action:
+                decider.action_result(True)
+                paused = action == stopspotiv1.ACTION_PAUSE
+                pauses += paused
+                resumes += not paused
+        assert (result.pauses[i], result.resumes[i]) == (pauses, resumes)
+
+    low = (result.peak_threshold == 0.001) & (result.action_cooldown == 0.5) & (result.silence_threshold == 1.0)
+    assert result.false_pauses[low].tolist() == [1]  # The blip paused Spotify
+    assert result.pause_latency[low].tolist() == [0.0]
+    assert result.resume_latency[low].tolist() == [1.0]
+    high = (result.peak_threshold == 0.01) & (result.action_cooldown == 0.5) & (result.silence_threshold == 1.0)
+    assert result.false_pauses[high].tolist() == [0] and result.toggles[high].tolist() == [2]
+    best = stopspotiv1.rank_sweep(result, top=1)[0]
+    assert result.false_pauses[best] == 0
+
+    pooled = stopspotiv1.sweep_parameters(timeline, thresholds, cooldowns, silences, workers=2, chunk_size=3)
+    assert pooled.toggles.tolist() == result.toggles.tolist()
+
+def test_import_loads_no_gui_or_com_libraries():
+    code = ("import sys, stopspotiv1; "
+            "print(sorted(m for m in ('customtkinter', 'PIL', 'pystray', 'pycaw', 'comtypes', 'pythoncom', 'numpy', 'http.server') "
+            "if m in sys.modules), stopspotiv1.SPOTIFY_PIDS)")
+    output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(stopspotiv1.__file__)),
+                            capture_output=True, text=True, check=True).stdout
+    assert output.strip() == "[] []"
+
+def test_headless_monitor_pauses_and_resumes_simulated_spotify():
+    backend = stopspotiv1.SimulatedAudioBackend(seed=2)
+    manager = stopspotiv1.AudioSessionManager(debug=False, backend=backend, device_gate=True)
+    monitor = stopspotiv1.HeadlessMonitor(manager, stopspotiv1.PauseDecider(action_cooldown=1.0, silence_threshold=1.0),
+                                          spotify_running=lambda: True)
+
+    assert monitor.tick(0.0) == stopspotiv1.ACTION_NONE
+    teams = backend.add_session('Teams.exe', stopspotiv1.AUDCLNT_SESSIONSTATE_ACTIVE, 0.4)
+    assert monitor.tick(0.5) == stopspotiv1.ACTION_PAUSE
+    backend.remove_session(teams)
+    actions = [monitor.tick(1.0 + 0.5 * i) for i in range(4)]
+    assert actions == [stopspotiv1.ACTION_NONE] * 3 + [stopspotiv1.ACTION_RESUME]
+    assert backend.commands == ['pause', 'play']
+    assert (monitor.ticks, monitor.pauses, monitor.resumes) == (6, 1, 1)
+    assert monitor.first_tick_seconds is not None
+
+    # run() ticks on its own schedule until stopped
+    with patch.object(monitor._stop, 'wait', side_effect=lambda timeout: monitor.stop()):
+        monitor.run()
+    assert monitor.ticks == 7
+
+def test_media_dispatcher_coalesces_verifies_and_escalates():
+    backend = stopspotiv1.SimulatedAudioBackend(seed=2)
+    spotify = lambda: backend._by_pid[backend.spotify_pid].state == stopspotiv1.AUDCLNT_SESSIONSTATE_ACTIVE
+    dispatcher = stopspotiv1.MediaCommandDispatcher(backend.send_media_command, verify_timeout=1.0, backoff=0.5,
+                                                    max_attempts=4, escalate_after=2)
+
+    assert dispatcher.request('pause', 0.0) and dispatcher.request('pause', 0.1)
+    outcome = dispatcher.observe(0.3, spotify())
+    assert outcome == stopspotiv1.CommandOutcome('pause', True, 0.3, 1)
+    assert backend.commands == ['pause'] and dispatcher.counts['coalesced'] == 1
+
+    # A hung window takes the message but nothing happens: a play is only ever retried as a play
+    backend.unresponsive = True
+    dispatcher.request('play', 10.0)
+    assert [dispatcher.observe(t, spotify()) for t in (10.5, 11.0, 12.0)] == [None] * 3
+    assert backend.commands == ['pause', 'play', 'play']
+    backend.unresponsive = False
+    assert dispatcher.observe(12.5, spotify()) is None  # After the backoff, the third attempt
+    assert backend.commands == ['pause', 'play', 'play', 'play']
+    assert dispatcher.observe(12.6, spotify()).attempts == 3
+    assert dispatcher.latencies['play'].count == 1 and dispatcher.counts['escalated'] == 0
+
+    # An unheeded pause escalates to the toggle exactly once before giving up
+    backend.unresponsive = True
+    dispatcher.request('pause', 20.0)
+    outcomes = [dispatcher.observe(20.0 + 0.25 * i, spotify()) for i in range(60)]
+    assert stopspotiv1.CommandOutcome('pause', False, None, 4) in outcomes
+    assert backend.commands[-4:] == ['pause', 'pause', 'toggle', 'pause']
+    assert dispatcher.pending is None and dispatcher.counts['failed'] == 1 and dispatcher.counts['escalated'] == 1
+
+def test_media_dispatcher_confirms_a_silent_play_by_session_state():
+    backend = stopspotiv1.SimulatedAudioBackend(seed=2)
+    manager = stopspotiv1.AudioSessionManager(debug=False, backend=backend)
+    dispatcher = stopspotiv1.MediaCommandDispatcher(manager.send_media_command, verify_timeout=0.5, backoff=0.0,
+                                                    max_attempts=4, escalate_after=1)
+    assert dispatcher.request('pause', 0.0)
+    assert dispatcher.observe(0.1, manager.snapshot().spotify_active) is not None
+
+    # The track starts on a silent stretch: the session is active but its peak stays at zero
+    backend.set_session(backend.spotify_pid, level=0.0)
+    assert dispatcher.request('play', 1.0)
+    snapshot = manager.snapshot()
+    assert not snapshot.spotify_active and snapshot.spotify_peak == 0.0 and snapshot.spotify_playing
+    outcome = dispatcher.observe(2.0, snapshot.spotify_active, snapshot.spotify_playing)
+    assert outcome == stopspotiv1.CommandOutcome('play', True, 1.0, 1)
+    assert backend.commands == ['pause', 'play'] and dispatcher.counts['escalated'] == 0
+
+def test_headless_monitor_repauses_when_spotify_ignores_a_pause():
+    backend = stopspotiv1.SimulatedAudioBackend(seed=2)
+    manager = stopspotiv1.AudioSessionManager(debug=False, backend=backend)
+    dispatcher = stopspotiv1.MediaCommandDispatcher(manager.send_media_command, verify_timeout=0.5, backoff=0.0,
+                                                    max_attempts=2, escalate_after=5)
+    monitor = stopspotiv1.HeadlessMonitor(manager, stopspotiv1.PauseDecider(action_cooldown=1.0),
+                                          spotify_running=lambda: True, dispatcher=dispatcher)
+    backend.unresponsive = True
+    backend.add_session('Teams.exe', stopspotiv1.AUDCLNT_SESSIONSTATE_ACTIVE, 0.4)
+    actions = [monitor.tick(0.25 * i) for i in range(8)]
+    assert actions.count(stopspotiv1.ACTION_PAUSE) == 2
+    assert backend.commands == ['pause'] * 4 and dispatcher.counts['failed'] == 1
+
+def test_headless_monitor_skips_ticks_while_the_probe_is_stale():
+    backend = stopspotiv1.SimulatedAudioBackend(seed=2)
+    manager = stopspotiv1.AudioSessionManager(debug=False, backend=backend)
+    dispatcher = stopspotiv1.MediaCommandDispatcher(manager.send_media_command, verify_timeout=0.5)
+    decider = stopspotiv1.PauseDecider(action_cooldown=1.0, silence_threshold=0.5)
+    monitor = stopspotiv1.HeadlessMonitor(manager, decider, spotify_running=lambda: True, dispatcher=dispatcher)
+    teams = backend.add_session('Teams.exe', stopspotiv1.AUDCLNT_SESSIONSTATE_ACTIVE, 0.4)
+    assert monitor.tick(0.0) == stopspotiv1.ACTION_PAUSE
+    backend.remove_session(teams)
+
+    # A hung or restarting probe has no snapshot: not silence, so no resume and the pause stays pending
+    with patch.object(manager, 'snapshot', return_value=None):
+        assert [monitor.tick(0.25 * i) for i in range(1, 9)] == [stopspotiv1.ACTION_NONE] * 8
+    assert dispatcher.pending is not None and not decider.silence_pending
+    assert backend.commands == ['pause']
+    assert monitor.tick(2.5) == stopspotiv1.ACTION_NONE and dispatcher.pending is None
+
+def test_async_monitor_keeps_probing_while_a_command_hangs():
+    import threading
+    backend = stopspotiv1.SimulatedAudioBackend(seed=2)
+    manager = stopspotiv1.AudioSessionManager(debug=False, backend=backend)
+    release = threading.Event()
+    sent = backend.send_media_command
+    calls = []
+    manager.send_media_command = lambda command: calls.append(command) or (release.wait(5) and sent(command))
+    scheduler = stopspotiv1.PollScheduler({mode: 0.01 for mode in stopspotiv1.PollScheduler.INTERVALS})
+    dispatcher = stopspotiv1.MediaCommandDispatcher(manager.send_media_command, verify_timeout=0.05, backoff=0.0)
+    monitor = stopspotiv1.AsyncMonitor(manager, stopspotiv1.PauseDecider(action_cooldown=0.0, silence_threshold=0.05),
+                                       scheduler, spotify_running=lambda: True, tracker_interval=0.01,
+                                       command_timeout=0.2, dispatcher=dispatcher)
+    backend.add_session('Teams.exe', stopspotiv1.AUDCLNT_SESSIONSTATE_ACTIVE, 0.4)
+    runner = threading.Thread(target=monitor.run)
+    runner.start()
+    try:
+        # The pause hangs past its timeout, yet ticks go on and the pause is retried
+        _wait_until(lambda: monitor.timeouts['command'] >= 1)
+        ticks = monitor.ticks
+        _wait_until(lambda: monitor.ticks > ticks + 5)
+        assert monitor.pauses == 0 and monitor.pause_failures >= 1
+        assert calls == ['pause']  # Retries wait for the stuck call instead of queueing behind it
+        workers = [t for t in threading.enumerate() if t.name in ('spotify-check', 'audio-probe', 'media-command')]
+        assert len(workers) >= 3 and all(t.daemon for t in workers)  # Never joined at exit
+        release.set()
+        _wait_until(lambda: dispatcher.counts['confirmed'] == 1)  # Checked against the probe's snapshots
+        assert monitor.pauses == 1 and monitor.decider.paused_by_us
+        assert len(calls) <= 2 and dispatcher.latencies['pause'].count == 1
+
+        # Spotify now ignores commands: the resume is re-posted as a play, never the toggle, and given up
+        backend.unresponsive = True
+        backend.remove_session(next(pid for pid in backend._by_pid if pid != backend.spotify_pid))
+        _wait_until(lambda: dispatcher.counts['failed'] == 1)
+        assert calls[-4:] == ['play'] * 4 and dispatcher.counts['escalated'] == 0
+    finally:
+        release.set()
+        started = time.monotonic()
+        monitor.stop()
+        runner.join(5)
+    assert not runner.is_alive() and time.monotonic() - started < 1.0
+    assert backend.commands[0] == 'pause'
+
+class _Leaked:
+    pass
+
+def test_leak_watchdog_resets_only_after_growth():
+    clock = [0.0]
+    rss = [100 * 1024 * 1024]
+    watchdog = stopspotiv1.LeakWatchdog(interval=60.0, rss_limit=10 * 1024 * 1024, object_limit=10 ** 9,
+                                        clock=lambda: clock[0], rss=lambda: MagicMock(rss=rss[0]))
+    backend = stopspotiv1.SimulatedAudioBackend(seed=4)
+    manager = stopspotiv1.AudioSessionManager(debug=False, backend=backend, watchdog=watchdog)
+
+    with patch.object(backend, 'invalidate') as invalidate:
+        manager.snapshot()  # Baseline
+        rss[0] += 20 * 1024 * 1024
+        clock[0] = 30.0
+        manager.snapshot()  # Not due yet
+        assert not invalidate.called
+
+        clock[0] = 61.0
+        leaked = [_Leaked() for _ in range(5000)]
+        manager.snapshot()
+        invalidate.assert_called_once_with('leak_suspected')
+
+        clock[0] = 122.0
+        manager.snapshot()  # Fresh baseline after the reset
+        assert invalidate.call_count == 1
+
+    report, = watchdog.reports
+    assert report.reasons == ('rss',) and report.rss_growth == 20 * 1024 * 1024
+    assert ('_Leaked', len(leaked)) in report.grown_types
+    assert manager.watchdog_stats()['resets'] == 1
+
+def test_leak_watchdog_scans_the_heap_once_per_check():
+    clock = [0.0]
+    watchdog = stopspotiv1.LeakWatchdog(interval=60.0, rss_limit=10 ** 12, object_limit=10 ** 9,
+                                        clock=lambda: clock[0], rss=lambda: MagicMock(rss=0))
+    with patch.object(stopspotiv1.gc, 'get_objects', wraps=stopspotiv1.gc.get_objects) as get_objects:
+        for check in range(3):
+            clock[0] = check * 61.0
+            assert watchdog.check() is None
+    assert get_objects.call_count == watchdog.checks == 3
+
+def _wait_until(condition, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        time.sleep(0.02)
+
+def test_probe_block_readers_never_see_a_torn_write():
+    buffer = bytearray(stopspotiv1.PROBE_BLOCK_SIZE)
+    block = stopspotiv1.ProbeBlock(buffer)
+    assert block.read() is None
+
+    snapshot = stopspotiv1.AudioSnapshot(False, 0.25, True, 0.5, 'vlc.exe', 4242, 7)
+    block.write(12.5, snapshot)
+    assert block.read() == (2, 12.5, snapshot)
+
+    buffer[0] += 1  # A writer in the middle of an update
+    assert block.read(retries=3) is None
+
+def test_probe_supervisor_restarts_a_crashed_worker():
+    factory = functools.partial(stopspotiv1.SimulatedAudioBackend, session_count=5, seed=1, active_ratio=0.0)
+    supervisor = stopspotiv1.ProbeSupervisor(factory, interval=0.05, debug=False).start()
+    try:
+        _wait_until(lambda: supervisor.snapshot() is not None and supervisor.snapshot().spotify_active)
+        assert supervisor.snapshot().session_count == 6
+        assert supervisor.send_media_command('pause') is True
+        _wait_until(lambda: not supervisor.snapshot().spotify_active)
+
+        first_pid = supervisor.worker_pid
+        os.kill(first_pid, signal.SIGKILL if hasattr(signal, 'SIGKILL') else signal.SIGTERM)
+        # A fresh worker starts a fresh simulation, with Spotify playing again
+        _wait_until(lambda: supervisor.restarts == 1 and supervisor.snapshot() is not None
+                    and supervisor.snapshot().spotify_active)
+        assert supervisor.worker_pid != first_pid
+        assert supervisor.probe_stats()['crashes'] == 1
+    finally:
+        supervisor.close()
+    assert not supervisor._process.is_alive()
+
+@pytest.mark.skipif(os.name == 'nt', reason="exercises the Unix socket flavour of the control channel")
+def test_control_channel_is_single_instance_and_changes_settings(tmp_path):
+    import socket
+    address = str(tmp_path / 'ctl.sock')
+    manager = stopspotiv1.AudioSessionManager(debug=False, backend=stopspotiv1.SimulatedAudioBackend(seed=3))
+    monitor = stopspotiv1.HeadlessMonitor(manager, spotify_running=lambda: True)
+    monitor.tick(0.0)
+
+    server = stopspotiv1.ControlServer(address).acquire().serve(monitor.control_commands())
+    try:
+        with pytest.raises(stopspotiv1.InstanceAlreadyRunning):
+            stopspotiv1.ControlServer(address).acquire()
+
+        response = stopspotiv1.control_request('set', address=address, peak_threshold=0.01, silence_threshold=3)
+        assert response['ok'] and response['result']['silence_threshold'] == 3.0
+        assert manager._peak_threshold == 0.01
+        assert stopspotiv1.control_request('set', address=address, colour='red') == {
+            'ok': False, 'error': "unknown setting 'colour'"}
+        assert not stopspotiv1.control_request('bogus', address=address)['ok']
+        assert stopspotiv1.control_request('snapshot', address=address)['result']['spotify_active'] is True
+
+        # Only this user can reach the socket or read the key, and a client without the key is turned away
+        key_path = stopspotiv1.control_key_path(address)
+        assert os.stat(address).st_mode & 0o077 == 0 and os.stat(key_path).st_mode & 0o777 == 0o600
+        with open(key_path, 'wb') as f:
+            f.write(b'not the key')
+        with pytest.raises(stopspotiv1.ControlChannelError):
+            stopspotiv1.control_request('status', address=address)
+        with open(key_path, 'wb') as f:
+            f.write(server._authkey)
+
+        assert stopspotiv1.control_request('stop', address=address) == {'ok': True, 'result': False}
+        monitor.tick(1.0)
+        assert monitor.last_snapshot is None and monitor.ticks == 1
+        assert stopspotiv1.control_request('status', address=address)['result']['monitoring'] is False
+    finally:
+        server.close()
+    assert not os.path.exists(address) and not os.path.exists(key_path)
+
+    # A socket left behind by a monitor that died does not block the next one
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(address)
+    stale.close()
+    stopspotiv1.ControlServer(address).acquire().close()
+
+    # A stale path that cannot be removed is a clear startup error
+    with patch.object(stopspotiv1.os, 'unlink', side_effect=PermissionError(13, 'Permission denied')), \
+            patch.object(stopspotiv1.ControlServer, '_listen', side_effect=OSError(98, 'Address in use')):
+        with pytest.raises(stopspotiv1.ControlChannelError, match='cannot listen'):
+            stopspotiv1.ControlServer(address).acquire()
+
+@pytest.mark.skipif(os.name == 'nt', reason="the Unix socket lives in a private directory")
+def test_control_address_needs_a_private_directory(tmp_path, monkeypatch):
+    import tempfile
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path))
+    assert os.path.dirname(stopspotiv1.control_address()) == str(tmp_path)
+
+    monkeypatch.delenv('XDG_RUNTIME_DIR')
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    address = stopspotiv1.control_address()
+    directory = os.path.dirname(address)
+    assert os.path.dirname(directory) == str(tmp_path) and os.stat(directory).st_mode & 0o777 == 0o700
+    assert stopspotiv1.control_address() == address
+
+    os.chmod(directory, 0o755)
+    with pytest.raises(stopspotiv1.ControlChannelError, match='0700'):
+        stopspotiv1.control_address()
+
+def test_metrics_endpoint_serves_prometheus_text():
+    backend = stopspotiv1.SimulatedAudioBackend(seed=2)
+    manager = stopspotiv1.AudioSessionManager(debug=False, backend=backend)
+    metrics = stopspotiv1.MonitorMetrics()
+    monitor = stopspotiv1.HeadlessMonitor(manager, spotify_running=lambda: True, metrics=metrics)
+    monitor.tick(0.0)
+    backend.add_session('Teams.exe', stopspotiv1.AUDCLNT_SESSIONSTATE_ACTIVE, 0.4)
+    monitor.tick(0.5)
+
+    server = stopspotiv1.MetricsServer(lambda: metrics.render(monitor), 0).start()
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.port}/metrics', timeout=5) as response:
+            assert response.headers['Content-Type'].startswith('text/plain')
+            lines = response.read().decode('utf-8').splitlines()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f'http://127.0.0.1:{server.port}/', timeout=5)
+    finally:
+        server.close()
+
+    assert 'stopspoti_tick_duration_seconds_bucket{le="+Inf"} 2' in lines
+    assert 'stopspoti_tick_duration_seconds_count 2' in lines
+    assert 'stopspoti_phase_duration_seconds_count{phase="command"} 1' in lines
+    assert 'stopspoti_pauses_total 1' in lines
+    assert 'stopspoti_paused_by_us 1' in lines
+    assert 'stopspoti_sessions 2' in lines
+    assert 'stopspoti_process_lookups_total 2' in lines
+    assert '# TYPE stopspoti_resume_failures_total counter' in lines
+
+    histogram = stopspotiv1.Histogram(buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value)
+    assert histogram.cumulative() == [(0.1, 2), (1.0, 3), ('+Inf', 4)]
+
+def test_log_buffer_is_bounded_and_drained_in_batches():
+    buffer = stopspotiv1.LogBuffer(max_lines=3)
+    for i in range(5):
+        buffer.append(f"line {i}")
+
+    assert buffer.drain() == ["line 2", "line 3", "line 4"]
+    assert buffer.drain() == []
+    assert buffer.dropped == 2
+
+    for i in range(5, 8):
+        buffer.append(f"line {i}")
+    buffer.set_max_lines(2)  # Trims what the UI has not picked up yet
+    assert buffer.drain() == ["line 6", "line 7"]
+    buffer.append("line 8")
+    buffer.append("line 9")
+    buffer.append("line 10")
+    assert buffer.drain() == ["line 9", "line 10"]
+    assert buffer.dropped == 3
+
 def test_monitor_loop_state_transitions():
     # Setup App
     app = stopspotiv1.SpotifyControllerGUI()
@@ -128,29 +1076,34 @@ def test_monitor_loop_state_transitions():
         fake_time[0] += 1.0 # Advance time by 1s every call
         return fake_time[0]
 
-    with patch('stopspotiv1.get_spotify_process', return_value=MagicMock()), \
+    # Spotify follows the commands, as the dispatcher checks
+    playing = [True]
+    def follow(state):
+        playing[0] = state
+        return True
+
+    with patch.object(stopspotiv1.spotify_tracker, 'refresh', return_value=True), \
          patch('stopspotiv1.AudioSessionManager') as MockManager, \
-         patch('stopspotiv1.pause_spotify', return_value=True) as mock_pause, \
-         patch('stopspotiv1.play_spotify', return_value=True) as mock_play, \
+         patch('stopspotiv1.pause_spotify', side_effect=lambda: follow(False)) as mock_pause, \
+         patch('stopspotiv1.play_spotify', side_effect=lambda: follow(True)) as mock_play, \
          patch('stopspotiv1.time.sleep'), \
-         patch('stopspotiv1.time.time', side_effect=fake_time_func):
+         patch('stopspotiv1.time.monotonic', side_effect=fake_time_func):
          
         mock_manager_instance = MockManager.return_value
         
         # We need to artificially break out of the while loop after some iterations
         call_count = [0]
-        def fake_check(check_spotify=False):
+        def fake_snapshot():
             call_count[0] += 1
             if call_count[0] > 10:
                 app.monitoring = False # Break the loop
                 
-            if check_spotify:
-                return True # Spotify is theoretically always playing when we check it in the test loop
-                
             # Simulate other audio turning ON at count 2, and OFF at count 6
-            return 2 <= call_count[0] <= 5
+            other_active = 2 <= call_count[0] <= 5
+            return stopspotiv1.AudioSnapshot(playing[0], 0.5 if playing[0] else 0.0, other_active, 0.5 if other_active else 0.0,
+                                             'other.exe' if other_active else None, None, 2, playing[0])
         
-        mock_manager_instance.check_audio_sessions.side_effect = fake_check
+        mock_manager_instance.snapshot.side_effect = fake_snapshot
         
         app.monitor_loop()
         
@@ -158,3 +1111,4 @@ def test_monitor_loop_state_transitions():
         mock_pause.assert_called()
         # Ensure play was called when other audio stopped and silence timeout reached
         mock_play.assert_called()
+        assert app.dispatcher.counts['confirmed'] == 2 and app.dispatcher.counts['retried'] == 0